@@ -0,0 +1,55 @@
+"""
+Time matching Adobe usernames against exclude_users patterns, trying each compiled pattern in turn
+and with the ExclusionMatcher.
+
+    python tests/benchmark/exclusion_match.py [user count] [pattern count]
+"""
+import random
+import re
+import sys
+import time
+
+from user_sync.helper import ExclusionMatcher
+
+
+def build(user_count, pattern_count):
+    generator = random.Random(1)
+    # mostly literal service accounts, as in a typical configuration, then prefixes, suffixes and general patterns
+    literal_count = pattern_count * 8 // 10
+    patterns = ['svc-account-%d@example.com' % i for i in range(literal_count)]
+    patterns.extend('batch%d-.*' % i for i in range((pattern_count - literal_count) // 2))
+    patterns.extend(r'.*@robot%d\.example\.com' % i for i in range(pattern_count - len(patterns) - 5))
+    patterns.extend(r'temp[0-9]+-%d@example\.com' % i for i in range(5))
+    usernames = []
+    for i in range(user_count):
+        choice = generator.random()
+        if choice < 0.01:
+            usernames.append('svc-account-%d@example.com' % generator.randrange(literal_count))
+        elif choice < 0.02:
+            usernames.append('batch0-user%d@example.com' % i)
+        else:
+            usernames.append('user%d@example.com' % i)
+    return patterns, usernames
+
+
+def run_regexes(patterns, usernames):
+    regexes = [re.compile(r'\A' + pattern + r'\Z', re.UNICODE | re.IGNORECASE) for pattern in patterns]
+    return sum(1 for username in usernames if any(regex.match(username) for regex in regexes))
+
+
+def run_matcher(patterns, usernames):
+    matcher = ExclusionMatcher(patterns)
+    return sum(1 for username in usernames if matcher.match(username))
+
+
+def main(user_count, pattern_count):
+    patterns, usernames = build(user_count, pattern_count)
+    for label, run in (('regexes', run_regexes), ('matcher', run_matcher)):
+        start = time.time()
+        matches = run(patterns, usernames)
+        print('%-8s %d users x %d patterns: %.2fs (%d excluded)' %
+              (label, user_count, pattern_count, time.time() - start, matches))
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 100000, int(sys.argv[2]) if len(sys.argv) > 2 else 250)
@@ -0,0 +1,71 @@
+"""
+Time the work of diffing Adobe users' groups against their desired groups, with sets and with the
+bitset engine.
+
+    python tests/benchmark/group_diff.py [user count] [group count]
+"""
+import random
+import sys
+import time
+
+from user_sync.rules import GroupBitsetEngine, RuleProcessor, UmapiTargetInfo
+
+
+def build(user_count, group_count, combination_count=500):
+    generator = random.Random(1)
+    umapi_info = UmapiTargetInfo(None)
+    groups = ['Group %d' % i for i in range(group_count)]
+    for group in groups:
+        umapi_info.add_mapped_group(group)
+    combinations = [generator.sample(groups, generator.randint(1, 12)) for _ in range(combination_count)]
+    adobe_users = []
+    for i in range(user_count):
+        user_key = 'federatedID,user%d,example.com' % i
+        desired = generator.choice(combinations)
+        for group in desired:
+            umapi_info.add_desired_group_for(user_key, group)
+        current = list(desired)
+        if generator.random() < 0.2:
+            current.append(generator.choice(groups))
+        if generator.random() < 0.2 and current:
+            current.pop(0)
+        current.append('Unmapped %d' % (i % 100))
+        adobe_users.append((user_key, current))
+    umapi_info.finalize_desired_groups()
+    return umapi_info, adobe_users
+
+
+def run_sets(umapi_info, adobe_users):
+    desired = umapi_info.get_desired_groups_by_user_key()
+    changes = 0
+    for user_key, raw_groups in adobe_users:
+        current_groups = umapi_info.get_group_set(RuleProcessor.normalize_groups(raw_groups))
+        to_add, to_remove = umapi_info.get_group_changes(desired[user_key], current_groups)
+        changes += len(to_add) + len(to_remove)
+    return changes
+
+
+def run_bitset(umapi_info, adobe_users):
+    desired = umapi_info.get_desired_groups_by_user_key()
+    engine = GroupBitsetEngine(umapi_info)
+    changes = 0
+    for user_key, raw_groups in adobe_users:
+        current_mask = engine.encode_groups(raw_groups)
+        engine.decode(current_mask)
+        to_add, to_remove = engine.get_group_changes(engine.encode_desired(desired[user_key]), current_mask)
+        changes += len(to_add) + len(to_remove)
+    return changes
+
+
+def main(user_count, group_count):
+    umapi_info, adobe_users = build(user_count, group_count)
+    for label, run in (('sets', run_sets), ('bitset', run_bitset)):
+        umapi_info.group_changes = {}
+        start = time.time()
+        changes = run(umapi_info, adobe_users)
+        print('%-8s %d users x %d groups: %.2fs (%d group changes)' %
+              (label, user_count, group_count, time.time() - start, changes))
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 100000, int(sys.argv[2]) if len(sys.argv) > 2 else 2000)
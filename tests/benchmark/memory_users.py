@@ -0,0 +1,59 @@
+"""
+Compare the memory used by directory and UMAPI users held as plain dicts and as compact records.
+
+    python tests/benchmark/memory_users.py [user count]
+"""
+import sys
+import tracemalloc
+
+from user_sync.connector.helper import UserRecordCompactor
+
+
+def make_directory_user(i):
+    return {
+        'identity_type': 'federatedID',
+        'username': 'user%d@example.com' % i,
+        'domain': 'example.com',
+        'firstname': 'First%d' % i,
+        'lastname': 'Last%d' % i,
+        'email': 'user%d@example.com' % i,
+        'groups': ['Group %d' % (i % 50), 'All Staff'],
+        'country': 'US',
+        'source_attributes': {'email': 'user%d@example.com' % i, 'givenName': 'First%d' % i, 'c': 'US'},
+    }
+
+
+def make_umapi_user(i):
+    return {
+        'email': 'user%d@example.com' % i,
+        'status': 'active',
+        'groups': ['Group %d' % (i % 50), 'All Staff', 'Product Profile %d' % (i % 7)],
+        'username': 'user%d@example.com' % i,
+        'domain': 'example.com',
+        'firstname': 'First%d' % i,
+        'lastname': 'Last%d' % i,
+        'country': 'US',
+        'type': 'federatedID',
+    }
+
+
+def measure(label, build):
+    tracemalloc.start()
+    users = build()
+    current, _peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print('%-20s %8d users %10.1f MB %8.0f bytes/user' % (label, len(users), current / 1e6, current / len(users)))
+    return users
+
+
+def main(count):
+    compactor = UserRecordCompactor(keep_source_attributes=False)
+    measure('directory dicts', lambda: [make_directory_user(i) for i in range(count)])
+    measure('directory records', lambda: [compactor.compact_directory_user(make_directory_user(i))
+                                          for i in range(count)])
+    measure('umapi dicts', lambda: [make_umapi_user(i) for i in range(count)])
+    measure('umapi records', lambda: [compactor.compact_umapi_user(make_umapi_user(i)) for i in range(count)])
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 100000)
@@ -1,6 +1,11 @@
 import os
+
+import ldap3
 import pytest
+
+import user_sync.connector.directory_ldap
 from user_sync import config
+from user_sync.connector.directory import DirectoryConnector
 
 
 @pytest.fixture
@@ -25,3 +30,33 @@ def cli_args():
             args_out[k] = v
         return args_out
     return _cli_args
+
+
+@pytest.fixture
+def mock_ldap_connector(monkeypatch):
+    def _mock_ldap_connector(emails):
+        """
+        A real LDAP directory connector, on ldap3's mock strategy, with a user entry for each email
+        :type emails: list(str)
+        :rtype DirectoryConnector
+        """
+        connection_class = ldap3.Connection
+
+        def mock_connection(server, **kwargs):
+            # the mock strategy can't bind anonymously, so it binds as a user of its own
+            connection = connection_class(server, client_strategy=ldap3.MOCK_SYNC,
+                                          user=u'cn=admin,dc=example,dc=com', password=u'secret', read_only=True)
+            connection.strategy.add_entry(u'cn=admin,dc=example,dc=com', {'userPassword': u'secret'})
+            for email in emails:
+                connection.strategy.add_entry(u'cn=%s,dc=example,dc=com' % email.split('@')[0], {
+                    'objectClass': [u'user'], 'mail': [email], 'givenName': [u'First'], 'sn': [u'Last'],
+                    'c': [u'US']})
+            connection.bind()
+            return connection
+
+        monkeypatch.setattr(ldap3, 'Connection', mock_connection)
+        connector = DirectoryConnector(user_sync.connector.directory_ldap)
+        connector.initialize({'host': u'ldap://fake', 'base_dn': u'dc=example,dc=com',
+                              'all_users_filter': u'(objectClass=user)'})
+        return connector
+    return _mock_ldap_connector
@@ -162,3 +162,30 @@ def test_adobe_users_config(tmp_config_files, modify_root_config, cli_args):
     options = config_loader.load_invocation_options()
     assert 'adobe_users' in options
     assert options['adobe_users'] == ['mapped']
+
+
+def test_config_signature(tmp_config_files, cli_args):
+    (root_config_file, ldap_config_file, _) = tmp_config_files
+    args = cli_args({'config_filename': root_config_file})
+    config_loader = ConfigLoader(args)
+    config_loader.get_directory_connector_options('ldap')
+    assert config_loader.get_config_file_paths() == sorted([root_config_file, ldap_config_file])
+
+    signature = app.get_config_signature(config_loader)
+    assert app.get_config_signature(config_loader) == signature
+    mtime = os.path.getmtime(ldap_config_file)
+    os.utime(ldap_config_file, (mtime + 10, mtime + 10))
+    assert app.get_config_signature(config_loader) != signature
+
+
+def test_keyring_values_are_read_again_when_the_config_is_reloaded(tmp_config_files, cli_args, monkeypatch):
+    import keyring
+    passwords = ['first', 'second']
+    monkeypatch.setattr(keyring, 'get_password', lambda service_name, username: passwords.pop(0))
+    args = cli_args({'config_filename': tmp_config_files[0]})
+    ConfigLoader(args)
+    config = DictConfig('ldap', {'secure_password_key': 'ldap service'})
+    assert config.get_credential('password', 'admin') == 'first'
+    assert config.get_credential('password', 'admin') == 'first'
+    ConfigLoader(args)
+    assert config.get_credential('password', 'admin') == 'second'
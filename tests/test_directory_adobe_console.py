@@ -0,0 +1,90 @@
+import logging
+import threading
+import time
+
+from user_sync.connector.directory_adobe_console import AdobeConsoleConnector
+
+
+def record(name, groups=()):
+    return {'username': name, 'email': name + '@example.com', 'domain': 'example.com', 'type': 'federatedID',
+            'firstname': name.title(), 'lastname': 'Smith', 'country': 'US', 'groups': list(groups)}
+
+
+class PagedConnection(object):
+    """Answers user queries two records a page, and one group's pages more slowly than the others"""
+    page_size = 2
+
+    def __init__(self, members_by_group, all_users, slow_group=None):
+        self.members_by_group = members_by_group
+        self.all_users = all_users
+        self.slow_group = slow_group
+        self.lock = threading.Lock()
+        self.queries = []
+
+    def query_multiple(self, object_type, page, url_params, query_params):
+        assert object_type == 'user'
+        with self.lock:
+            self.queries.append((tuple(url_params), dict(query_params), page))
+        if url_params:
+            records = self.members_by_group[url_params[0]]
+            if url_params[0] == self.slow_group:
+                time.sleep(0.05)
+        else:
+            records = self.all_users
+        start = page * self.page_size
+        return records[start:start + self.page_size], start + self.page_size >= len(records)
+
+
+def make_connector(connection, groups, threads=3):
+    connector = AdobeConsoleConnector.__new__(AdobeConsoleConnector)
+    connector.connection = connection
+    connector.logger = logging.getLogger('test-adobe-console')
+    connector.options = {'group_query_threads': threads}
+    connector.filter_by_identity_type = 'all'
+    connector.user_by_usr_key = {}
+    connector.iter_umapi_groups = lambda: iter(groups)
+    return connector
+
+
+def test_group_members_are_queried_in_parallel_and_merged_in_group_order():
+    members_by_group = {
+        'a': [record('ann'), record('bob'), record('cy')],
+        'b': [record('bob'), record('dee')],
+        'c': [record('cy'), record('ann'), record('eve'), record('fay'), record('gus')],
+    }
+    connection = PagedConnection(members_by_group, [], slow_group='c')
+    connector = make_connector(connection, ['a', 'b', 'c'])
+    users = list(connector.load_users_and_groups(['c', 'a', 'missing', 'b'], [], False))
+
+    # each user appears once, with its groups in the order they were asked for, even though
+    # the first group's query finishes last
+    groups_by_email = dict((user['email'], user['groups']) for user in users)
+    assert groups_by_email == {
+        'ann@example.com': ['c', 'a'],
+        'bob@example.com': ['a', 'b'],
+        'cy@example.com': ['c', 'a'],
+        'dee@example.com': ['b'],
+        'eve@example.com': ['c'],
+        'fay@example.com': ['c'],
+        'gus@example.com': ['c'],
+    }
+    assert [user['email'] for user in users][:3] == ['cy@example.com', 'ann@example.com', 'eve@example.com']
+
+    # each group found is queried for its direct members, a page at a time
+    pages_by_group = {}
+    for url_params, query_params, page in connection.queries:
+        assert query_params == {'directOnly': True}
+        pages_by_group.setdefault(url_params, []).append(page)
+    assert dict((group, sorted(pages)) for group, pages in pages_by_group.items()) == {
+        ('a',): [0, 1], ('b',): [0], ('c',): [0, 1, 2]}
+
+
+def test_all_users_are_streamed_with_their_requested_groups():
+    all_users = [record('ann', ['b', 'x']), record('bob'), record('cy', ['a', 'b']), record('dee', ['x'])]
+    connection = PagedConnection({'a': [], 'b': []}, all_users)
+    connector = make_connector(connection, ['a', 'b', 'x'])
+    users = list(connector.load_users_and_groups(['b', 'a'], [], True))
+    assert [(user['email'], user['groups']) for user in users] == [
+        ('ann@example.com', ['b']), ('bob@example.com', []), ('cy@example.com', ['b', 'a']),
+        ('dee@example.com', [])]
+    assert [(url_params, page) for url_params, _, page in connection.queries] == [((), 0), ((), 1)]
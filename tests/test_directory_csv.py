@@ -0,0 +1,148 @@
+import pytest
+
+from user_sync.connector.directory_csv import CSVDirectoryConnector
+from user_sync.helper import CSVAdapter
+
+
+@pytest.fixture
+def csv_file(tmpdir):
+    def _csv_file(text, name='users.csv'):
+        path = tmpdir.join(name)
+        path.write_text(text, encoding='utf8')
+        return str(path)
+    return _csv_file
+
+
+def test_read_csv_columns_matches_rows(csv_file):
+    file_path = csv_file(u'email,firstname,groups,email,extra\n'
+                         u'a@example.com,Ann,"g1,g2",b@example.com,x\n'
+                         u'\n'
+                         u'c@example.com,,g3\n'
+                         u'd@example.com,Dee,,e@example.com,y,overflow\n'
+                         u'"f@example.com","Félix ""Fe""",,,\n')
+    names = ['email', 'firstname', 'groups', 'country', 'extra']
+    expected = [tuple(row.get(name) or None for name in names) for row in CSVAdapter.read_csv_rows(file_path, names)]
+    assert list(CSVAdapter.read_csv_columns(file_path, names)) == expected
+    assert expected[0] == ('b@example.com', 'Ann', 'g1,g2', None, 'x')
+    assert expected[1] == (None, None, 'g3', None, None)
+    assert expected[3] == (None, u'Félix "Fe"', None, None, None)
+
+
+def test_read_csv_columns_single_and_empty(csv_file):
+    assert list(CSVAdapter.read_csv_columns(csv_file(u'email\na@example.com\n'), ['email'])) == [('a@example.com',)]
+    assert list(CSVAdapter.read_csv_columns(csv_file(u''), ['email'])) == []
+
+
+def test_read_users(csv_file):
+    file_path = csv_file(u'email\tfirstname\tlastname\tcountry\tgroups\ttype\tusername\tdomain\tdept\n'
+                         u'a@example.com\tAnn\tAdams\tus\tg1,g2\tfederatedID\tann\t\tsales\n'
+                         u'a@example.com\t\t\t\tg3\t\t\t\t\n'
+                         u'no-email\tBob\n'
+                         u'c@example.com\tCy\tCole\tgb\t\tbogusID\t\t\t\n', name='users.tsv')
+    connector = CSVDirectoryConnector({'file_path': file_path})
+    users = connector.read_users(file_path, ['dept'])
+    assert list(users) == ['a@example.com']
+    user = users['a@example.com']
+    assert user['firstname'] == 'Ann'
+    assert user['lastname'] == 'Adams'
+    assert user['country'] == 'US'
+    assert user['groups'] == ['g1', 'g2', 'g3']
+    assert user['username'] == 'a@example.com'
+    assert user['identity_type'] is None
+    assert user['domain'] == 'example.com'
+    assert user['source_attributes'] == {'email': 'a@example.com', 'firstname': None, 'lastname': None,
+                                         'country': None, 'groups': 'g3', 'type': None, 'username': None,
+                                         'domain': None, 'dept': None}
+
+
+def test_split_csv_file_keeps_quoted_newlines(csv_file):
+    rows = [u'"u%d@example.com","line one\nline ""two""\nline three",g%d' % (i, i) for i in range(50)]
+    file_path = csv_file(u'email,firstname,groups\n' + u'\n'.join(rows) + u'\n')
+    header, ranges = CSVAdapter.split_csv_file(file_path, 7)
+    assert header == ['email', 'firstname', 'groups']
+    assert len(ranges) > 1
+    names = ['email', 'firstname', 'groups']
+    chunked = [values for start, end in ranges
+               for values in CSVAdapter.read_csv_chunk(file_path, start, end, header, names)]
+    assert chunked == list(CSVAdapter.read_csv_columns(file_path, names))
+    assert len(chunked) == 50
+
+
+def test_split_csv_file_ignores_quotes_inside_fields(csv_file):
+    # a quote in the middle of an unquoted field is part of the value, so it doesn't open a quoted value
+    rows = [u'u%d@example.com,%s,"g%d\nh%d"' % (i, u'O"Brien' if i % 7 == 3 else u'Ann', i, i) for i in range(50)]
+    file_path = csv_file(u'email,firstname,groups\n' + u'\n'.join(rows) + u'\n')
+    header, ranges = CSVAdapter.split_csv_file(file_path, 7)
+    assert len(ranges) > 1
+    names = ['email', 'firstname', 'groups']
+    chunked = [values for start, end in ranges
+               for values in CSVAdapter.read_csv_chunk(file_path, start, end, header, names)]
+    assert chunked == list(CSVAdapter.read_csv_columns(file_path, names))
+    assert len(chunked) == 50
+    assert chunked[3] == (u'u3@example.com', u'O"Brien', u'g3\nh3')
+
+
+def test_split_csv_file_falls_back_on_quotes_it_cannot_follow(csv_file):
+    # a quoted value closed before the end of its field is read by the csv module in a way that isn't followed
+    rows = [u'u%d@example.com,%s,g%d' % (i, u'"Ann"ie' if i == 20 else u'Ann', i) for i in range(50)]
+    file_path = csv_file(u'email,firstname,groups\n' + u'\n'.join(rows) + u'\n')
+    assert CSVAdapter.split_csv_file(file_path, 7) is None
+    connector = CSVDirectoryConnector({'file_path': file_path, 'parallel_workers': 2})
+    connector.max_chunk_size = 256
+    assert len(connector.read_users(file_path, [])) == 50
+
+
+def test_read_users_in_parallel(csv_file):
+    lines = [u'email,firstname,lastname,groups,type,username,domain']
+    for i in range(300):
+        email = u'user%d@example.com' % (i % 37)
+        identity_type = u'bogus' if i % 53 == 0 else (u'federatedID' if i % 2 else u'')
+        username = u'name%d' % i if i % 5 == 0 else u''
+        lines.append(u'%s,"First\n%d",,"g%d,h%d",%s,%s,' % (email, i, i, i % 3, identity_type, username))
+        if i % 41 == 0:
+            lines.append(u'not-an-email,x')
+    file_path = csv_file(u'\n'.join(lines) + u'\n')
+    sequential = CSVDirectoryConnector({'file_path': file_path})
+    parallel = CSVDirectoryConnector({'file_path': file_path, 'parallel_workers': 3})
+    parallel.max_chunk_size = 512
+    expected = sequential.read_users(file_path, [])
+    users = parallel.read_users(file_path, [])
+    assert users == expected
+    assert list(users) == list(expected)
+
+
+@pytest.mark.parametrize('extension', ['.gz', '.bz2', '.xz'])
+def test_compressed_csv_round_trip(tmpdir, extension):
+    file_path = str(tmpdir.join('users.tsv' + extension))
+    rows = [{'email': 'a@example.com', 'groups': 'g1,g2'}, {'email': u'b@example.com', 'groups': u'Grüppe'}]
+    CSVAdapter.write_csv_rows(file_path, ['email', 'groups'], [dict(row) for row in rows])
+    assert CSVAdapter.get_compression(file_path) is not None
+    assert CSVAdapter.guess_delimiter_from_filename(file_path) == '\t'
+    assert list(CSVAdapter.read_csv_rows(file_path, ['email', 'groups'])) == rows
+    assert CSVAdapter.split_csv_file(file_path, 4) is None
+    connector = CSVDirectoryConnector({'file_path': file_path, 'parallel_workers': 2})
+    assert connector.read_users(file_path, [])['b@example.com']['groups'] == [u'Grüppe']
+
+
+def test_read_users_with_index(csv_file, tmpdir):
+    file_path = csv_file(u'email,firstname,groups\na@example.com,Ann,g1\nb@example.com,Bob,g2\n')
+    index_path = str(tmpdir.join('users.index'))
+    connector = CSVDirectoryConnector({'file_path': file_path, 'index_path': index_path})
+    users = list(connector.load_users_and_groups([], []))
+    assert connector.changed_users is None
+    connector.write_index()
+
+    connector = CSVDirectoryConnector({'file_path': file_path, 'index_path': index_path})
+    assert list(connector.load_users_and_groups([], [])) == users
+    assert connector.changed_users == []
+    assert connector.pending_index is None
+
+    csv_file(u'email,firstname,groups\na@example.com,Ann,g1\nb@example.com,Rob,g2\nc@example.com,Cy,g3\n')
+    connector = CSVDirectoryConnector({'file_path': file_path, 'index_path': index_path})
+    connector.load_users_and_groups([], [])
+    assert sorted(user['email'] for user in connector.changed_users) == ['b@example.com', 'c@example.com']
+
+    connector = CSVDirectoryConnector({'file_path': file_path, 'index_path': index_path,
+                                       'user_identity_type': 'adobeID'})
+    connector.load_users_and_groups([], [])
+    assert connector.changed_users is None
@@ -0,0 +1,102 @@
+import logging
+import time
+
+from user_sync.connector.directory_ldap import LDAPChangeSubscriber, LDAPDirectoryConnector, LDAPValueFormatter
+
+
+class StubConnector(object):
+    logger = logging.getLogger('test-ldap')
+    user_email_formatter = LDAPValueFormatter(u'{mail}')
+    user_username_formatter = LDAPValueFormatter(None)
+    get_cn_from_dn = staticmethod(LDAPDirectoryConnector.get_cn_from_dn)
+    options = {'all_users_filter': u'(objectClass=user)', 'two_steps_enabled': False}
+
+    def __init__(self):
+        self.user_by_dn = {u'cn=gone,dc=example,dc=com': {'email': u'gone@example.com'}}
+        self.member_emails_by_group_dn = {}
+
+
+def test_subscriber_reports_changed_users_and_groups():
+    changes = []
+    subscriber = LDAPChangeSubscriber(StubConnector(), lambda users, groups: changes.append((users, groups)),
+                                      {'mode': 'persistent_search'})
+    assert set(subscriber.attribute_names) == {u'objectClass', u'mail', u'member', u'uniqueMember'}
+    assert subscriber.get_filter().startswith(u'(|(objectClass=user)(objectClass=group)')
+    subscriber.handle_change(u'cn=Ann,dc=example,dc=com',
+                             {'objectClass': [u'top', u'user'], 'mail': [u'ann@example.com']}, None)
+    subscriber.handle_change(u'cn=Staff,dc=example,dc=com', {'objectClass': [u'top', u'groupOfNames']}, None)
+    # a deleted user's entry has no attributes, so the user is found by DN
+    subscriber.handle_change(u'cn=gone,dc=example,dc=com', {}, None)
+    subscriber.handle_change(u'cn=other,dc=example,dc=com', {}, None)
+    assert changes == [([u'ann@example.com'], []), ([], [u'Staff']), ([u'gone@example.com'], [])]
+
+
+def test_subscriber_reports_removed_group_members():
+    changes = []
+    connector = StubConnector()
+    connector.member_emails_by_group_dn = {u'cn=staff,dc=example,dc=com': {
+        u'cn=ann,dc=example,dc=com': u'ann@example.com',
+        u'cn=bob,dc=example,dc=com': u'bob@example.com',
+    }}
+    subscriber = LDAPChangeSubscriber(connector, lambda users, groups: changes.append((users, groups)),
+                                      {'mode': 'persistent_search'})
+    subscriber.handle_change(u'cn=Staff,dc=example,dc=com',
+                             {'objectClass': [u'groupOfNames'], 'member': [u'CN=Ann,dc=example,dc=com']}, None)
+    # a group with no members left lists none, so all the members the last run loaded are reported
+    subscriber.handle_change(u'cn=Staff,dc=example,dc=com', {'objectClass': [u'groupOfNames']}, None)
+    assert changes == [([u'bob@example.com'], [u'Staff']), ([u'ann@example.com', u'bob@example.com'], [u'Staff'])]
+
+
+class FailingSearch(object):
+    def next(self, block, timeout):
+        raise IOError('connection reset')
+
+    def stop(self):
+        pass
+
+
+def test_subscriber_catches_up_from_when_the_search_opened():
+    subscriber = LDAPChangeSubscriber(StubConnector(), lambda users, groups: None,
+                                      {'mode': 'persistent_search', 'reconnect_delay': 0})
+    catch_up_times = []
+
+    def catch_up(since):
+        catch_up_times.append(since)
+        subscriber.stop_event.set()
+
+    opened = []
+
+    def open_search():
+        # give up after a few tries, rather than loop for ever if the changes are never caught up with
+        opened.append(1)
+        if len(opened) == 3:
+            subscriber.stop_event.set()
+        return FailingSearch()
+
+    subscriber.open_search = open_search
+    subscriber.catch_up = catch_up
+    start = time.time()
+    subscriber.run()
+    # the search failed before any event came, but the changes since it opened are still searched for
+    assert len(catch_up_times) == 1 and catch_up_times[0] >= start
+
+
+def test_selection_does_not_outlast_its_run(mock_ldap_connector):
+    from user_sync.rules import RuleProcessor
+
+    emails = [u'ann@example.com', u'bob@example.com', u'cy@example.com']
+    connector = mock_ldap_connector(emails)
+    targeted = RuleProcessor({'selected_usernames': [u'bob@example.com']})
+    targeted.read_desired_user_groups({}, connector)
+    assert [user['email'] for user in targeted.filtered_directory_user_by_user_key.values()] == [u'bob@example.com']
+    assert connector.state.selected_users_filter is not None
+
+    # a full run on the same connector, as a daemon makes after a targeted one, reads all the users again
+    full = RuleProcessor({})
+    full.read_desired_user_groups({}, connector)
+    assert sorted(user['email'] for user in full.filtered_directory_user_by_user_key.values()) == emails
+
+    # reconnecting between runs drops the selection too
+    connector.select_users([u'bob@example.com'])
+    connector.prepare_run()
+    assert connector.state.get_all_users_filter() == u'(objectClass=user)'
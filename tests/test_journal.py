@@ -0,0 +1,90 @@
+import logging
+
+import umapi_client
+
+from user_sync.connector.umapi import ActionManager
+from user_sync.journal import ActionJournal
+
+
+class BatchingConnection(object):
+    """Sends queued actions two at a time, like a UMAPI connection with a tiny batch size"""
+    def __init__(self):
+        self.queued = 0
+
+    def execute_single(self, action):
+        self.queued += 1
+        if self.queued < 2:
+            return self.queued, 0, 0
+        return self.execute_queued()
+
+    def execute_queued(self):
+        sent, self.queued = self.queued, 0
+        return 0, sent, sent
+
+
+def make_action(user):
+    return umapi_client.Action(user=user, requestID='action_' + user).append(add={'product': ['p1']})
+
+
+def test_unanswered_actions_are_resumed(tmpdir):
+    path = str(tmpdir.join('journal.jsonl'))
+    action_manager = ActionManager(BatchingConnection(), 'org', logging.getLogger('test'))
+    journal = ActionJournal(path)
+    action_manager.set_journal(journal, 'umapi')
+    for user in ('a', 'b', 'c'):
+        action_manager.add_action(make_action(user))
+    # the run dies before the last action is sent, in the middle of writing a record
+    journal.file.write(u'{"event": "do')
+    journal.close()
+    assert ActionJournal.read_unacknowledged(path) == [('umapi', make_action('c').wire_dict())]
+
+    journal = ActionJournal(path, resume=True)
+    action_manager.set_journal(journal, 'umapi')
+    action_manager.add_action(make_action('d'))
+    journal.close()
+    assert ActionJournal.read_unacknowledged(path) == []
+
+
+class JournalConfigLoader(object):
+    def __init__(self, path):
+        self.path = path
+
+    def get_invocation_options(self):
+        return {'action_journal': self.path}
+
+
+def test_daemon_adds_to_a_journal_until_its_actions_are_answered(tmpdir):
+    from user_sync import app
+    from user_sync.connector.umapi import UmapiConnector
+    from user_sync.rules import UmapiConnectors
+
+    path = str(tmpdir.join('journal.jsonl'))
+    connector = UmapiConnector.__new__(UmapiConnector)
+    connector.name = 'umapi'
+    connector.snapshot_dir = None
+    connector.action_manager = ActionManager(BatchingConnection(), 'org', logging.getLogger('test'))
+    umapi_connectors = UmapiConnectors(connector, {})
+    config_loader = JournalConfigLoader(path)
+
+    # the first run starts a journal, and dies before the last of its actions is answered
+    journal = app.continue_journal(config_loader, umapi_connectors)
+    for user in ('a', 'b', 'c'):
+        connector.action_manager.add_action(make_action(user))
+    app.close_journal(umapi_connectors, journal)
+    assert ActionJournal.read_unacknowledged(path) == [('umapi', make_action('c').wire_dict())]
+
+    # the next run, with connectors made afresh, sends it again first, and adds its own actions to the same journal
+    connector.action_manager = ActionManager(BatchingConnection(), 'org', logging.getLogger('test'))
+    journal = app.continue_journal(config_loader, umapi_connectors)
+    assert ActionJournal.read_unacknowledged(path) == []
+    connector.action_manager.add_action(make_action('d'))
+    connector.action_manager.flush()
+    app.close_journal(umapi_connectors, journal)
+    with open(path) as journal_file:
+        assert journal_file.read().count('"queued"') == 5
+
+    # once everything in it has been answered, a run starts a new journal
+    journal = app.continue_journal(config_loader, umapi_connectors)
+    app.close_journal(umapi_connectors, journal)
+    with open(path) as journal_file:
+        assert journal_file.read() == ''
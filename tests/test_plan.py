@@ -0,0 +1,39 @@
+import logging
+
+import pytest
+import umapi_client
+
+from user_sync.connector.umapi import ActionManager
+from user_sync.error import AssertionException
+from user_sync.plan import SyncPlan
+
+
+class NoConnection(object):
+    def execute_single(self, action):
+        raise AssertionError('a plan must not send anything')
+
+
+def test_planned_actions_are_written_and_read_back(tmpdir):
+    path = str(tmpdir.join('plan.jsonl'))
+    sync_plan = SyncPlan()
+    action_manager = ActionManager(NoConnection(), 'org', logging.getLogger('test'))
+    action_manager.set_plan(sync_plan.get_actions('umapi.primary'))
+    action_manager.add_action(umapi_client.Action(user='a', requestID='action_1').append(add={'group': ['g1']}))
+    action_manager.add_action(umapi_client.Action(user='b', requestID='action_2').append(removeFromOrg={}))
+    sync_plan.get_actions('umapi.secondary.other')
+    assert action_manager.get_statistics() == (2, 0)
+    assert not action_manager.has_work()
+    sync_plan.write(path)
+    assert not tmpdir.join('plan.jsonl.tmp').check()
+
+    read_plan = SyncPlan.read(path)
+    assert len(read_plan) == 2
+    assert read_plan.created == sync_plan.created
+    assert read_plan.get_actions('umapi.primary') == sync_plan.get_actions('umapi.primary')
+
+
+def test_other_files_are_not_plans(tmpdir):
+    path = tmpdir.join('users.csv')
+    path.write('email\na@example.com\n')
+    with pytest.raises(AssertionException):
+        SyncPlan.read(str(path))
@@ -0,0 +1,378 @@
+import re
+
+import pytest
+
+from user_sync.rules import UmapiTargetInfo
+
+
+def test_desired_group_sets_are_shared():
+    umapi_info = UmapiTargetInfo(None)
+    for group in ('Group A', 'Group B'):
+        umapi_info.add_mapped_group(group)
+    for user_key in ('federatedID,a,example.com', 'federatedID,b,example.com'):
+        umapi_info.add_desired_group_for(user_key, 'Group A')
+        umapi_info.add_desired_group_for(user_key, 'Group B')
+    umapi_info.add_desired_group_for('federatedID,c,example.com', None)
+    umapi_info.finalize_desired_groups()
+
+    desired = umapi_info.get_desired_groups_by_user_key()
+    assert desired['federatedID,a,example.com'] == frozenset(['group a', 'group b'])
+    assert desired['federatedID,a,example.com'] is desired['federatedID,b,example.com']
+    assert desired['federatedID,c,example.com'] == frozenset()
+
+    current = umapi_info.get_group_set(['group b', 'other'])
+    changes = umapi_info.get_group_changes(desired['federatedID,a,example.com'], current)
+    assert changes == (frozenset(['group a']), frozenset())
+    assert umapi_info.get_group_changes(desired['federatedID,b,example.com'], current) is changes
+    assert umapi_info.get_group_changes(desired['federatedID,c,example.com'], current) == (frozenset(),
+                                                                                          frozenset(['group b']))
+
+    umapi_info.add_desired_group_for('federatedID,a,example.com', 'Group C')
+    assert desired['federatedID,a,example.com'] == set(['group a', 'group b', 'group c'])
+    assert desired['federatedID,b,example.com'] == frozenset(['group a', 'group b'])
+
+
+def test_bitset_engine_matches_sets():
+    import random
+    from user_sync.helper import normalize_string
+    from user_sync.rules import GroupBitsetEngine, RuleProcessor
+
+    generator = random.Random(7)
+    umapi_info = UmapiTargetInfo(None)
+    mapped = ['Mapped %d' % i for i in range(40)]
+    for group in mapped:
+        umapi_info.add_mapped_group(group)
+    for i in range(200):
+        user_key = 'federatedID,user%d,example.com' % i
+        umapi_info.add_desired_group_for(user_key, None)
+        for group in generator.sample(mapped, generator.randint(0, 5)):
+            umapi_info.add_desired_group_for(user_key, group)
+    umapi_info.finalize_desired_groups()
+    exclude_groups = RuleProcessor.normalize_groups(['Excluded'])
+    engine = GroupBitsetEngine(umapi_info, exclude_groups)
+
+    others = ['Other %d' % i for i in range(10)] + ['Excluded']
+    for desired_groups in umapi_info.get_desired_groups_by_user_key().values():
+        raw_groups = [group.upper() if generator.random() < 0.5 else group
+                      for group in generator.sample(mapped + others, generator.randint(0, 8))]
+        current_groups = umapi_info.get_group_set(RuleProcessor.normalize_groups(raw_groups))
+        current_mask = engine.encode_groups(raw_groups)
+        assert (engine.get_group_changes(engine.encode_desired(desired_groups), current_mask) ==
+                umapi_info.get_group_changes(desired_groups, current_groups))
+        relevant = umapi_info.get_mapped_groups() | exclude_groups
+        assert engine.decode(current_mask) & relevant == current_groups & relevant
+        assert normalize_string('Excluded') in engine.decode(engine.encode_groups(['EXCLUDED']))
+
+
+def test_normalization_cache_is_bounded():
+    from user_sync.helper import NormalizationCache
+
+    cache = NormalizationCache(max_size=2)
+    assert cache.normalize(' Group A ') == 'group a'
+    assert cache.normalize(' Group A ') == 'group a'
+    assert cache.normalize(None) is None
+    assert cache.get_statistics() == (1, 2, 2)
+    assert cache.normalize('Group B') == 'group b'
+    assert cache.get_statistics() == (1, 3, 1)
+    cache.resize(1)
+    assert cache.normalize('Group B') == 'group b'
+    assert cache.get_statistics() == (2, 3, 1)
+
+
+def test_user_key_table_interns_keys():
+    from user_sync.rules import RuleProcessor
+
+    processor = RuleProcessor({})
+    key = processor.get_user_key('federatedID', 'User@Example.com', 'ignored.com')
+    again = processor.get_user_key('FederatedID', ' user@example.com ', None)
+    assert key == 'federatedID,user@example.com,'
+    assert again is key
+    assert processor.user_key_table.intern(('federatedID', 'user@example.com', '')) is key
+    assert processor.parse_user_key(key) == ('federatedID', 'user@example.com', '')
+    assert processor.get_user_key('enterpriseID', 'jdoe', 'Example.com') == 'enterpriseID,jdoe,example.com'
+    assert processor.get_username_from_user_key('enterpriseID,jdoe,example.com') == 'jdoe'
+    assert processor.parse_user_key('adobeID,other@example.com,') == ('adobeID', 'other@example.com', '')
+    assert len(processor.user_key_table) == 2
+
+
+class RecordingConnector(object):
+    def __init__(self, users):
+        self.users = users
+        self.commands = []
+
+    def iter_users(self, in_group=None):
+        return iter(self.users)
+
+    def send_commands(self, commands, callback=None):
+        self.commands.append((commands.username, commands.do_list))
+
+
+def run_comparison(diff_processes, group_diff_engine, directory_users, umapi_users, secondary_umapi_users):
+    import re
+    from user_sync.rules import RuleProcessor
+
+    processor = RuleProcessor({'process_groups': True, 'update_user_info': True, 'remove_strays': True,
+                               'diff_processes': diff_processes, 'diff_batch_size': 7,
+                               'group_diff_engine': group_diff_engine, 'exclude_users': [re.compile('excluded.*')]})
+    umapi_info = processor.get_umapi_info(None)
+    secondary_info = processor.get_umapi_info('secondary')
+    umapi_info.add_mapped_group('Group A')
+    umapi_info.add_mapped_group('Group B')
+    secondary_info.add_mapped_group('Group C')
+    for user in directory_users:
+        user_key = processor.get_directory_user_key(user)
+        processor.directory_user_by_user_key[user_key] = user
+        processor.filtered_directory_user_by_user_key[user_key] = user
+        umapi_info.add_desired_group_for(user_key, None)
+        for group in user['groups']:
+            umapi_info.add_desired_group_for(user_key, group)
+            secondary_info.add_desired_group_for(user_key, 'Group C')
+    umapi_info.finalize_desired_groups()
+    secondary_info.finalize_desired_groups()
+    connector = RecordingConnector(umapi_users)
+    to_create = processor.update_umapi_users_for_connector(umapi_info, connector)
+    secondary_connector = RecordingConnector(secondary_umapi_users)
+    secondary_to_create = processor.update_umapi_users_for_connector(secondary_info, secondary_connector)
+    return (connector.commands, sorted(to_create), secondary_connector.commands, sorted(secondary_to_create),
+            processor.excluded_user_count, sorted(processor.included_user_keys), processor.stray_key_map)
+
+
+@pytest.mark.parametrize('group_diff_engine', ['sets', 'bitset'])
+def test_sharded_comparison_matches_single_process(group_diff_engine):
+    def user(name, firstname, groups, identity_type='federatedID'):
+        return {'identity_type': identity_type, 'type': identity_type, 'username': name, 'email': name,
+                'domain': 'example.com', 'firstname': firstname, 'lastname': 'Smith', 'country': 'US',
+                'groups': groups}
+
+    directory_users = [user('user%d@example.com' % i, 'First', ['Group A'] if i % 3 else ['Group B'])
+                       for i in range(40)]
+    umapi_users = [user('user%d@example.com' % i, 'First' if i % 4 else 'Old', ['group a'] if i % 2 else [])
+                   for i in range(10, 60)]
+    umapi_users.append(user('excluded@example.com', 'Ex', ['Group A']))
+    # a user read twice, a user with no key, and one whose type has to be defaulted
+    umapi_users.append(user('user12@example.com', 'Twice', []))
+    umapi_users.append(user('', 'Nokey', []))
+    untyped = user('user13@example.com', 'First', ['Group B'])
+    del untyped['type']
+    umapi_users.insert(0, untyped)
+    secondary_umapi_users = [user('user%d@example.com' % i, 'First', ['group c'] if i % 2 else [])
+                             for i in range(0, 70, 3)]
+    secondary_umapi_users.append(user('user5@example.com', 'Other', [], 'adobeID'))
+
+    single = run_comparison(1, 'sets', directory_users, umapi_users, secondary_umapi_users)
+    assert single[0]
+    assert single[2]
+    assert single[4] == 1
+    assert len(single[6][None]) == 21
+    assert run_comparison(1, group_diff_engine, directory_users, umapi_users, secondary_umapi_users) == single
+    assert run_comparison(3, group_diff_engine, directory_users, umapi_users, secondary_umapi_users) == single
+
+
+def test_exclusion_matcher_matches_each_pattern():
+    import random
+    import re
+    from user_sync.helper import ExclusionMatcher
+
+    patterns = ['svc-backup', r'admin\.account', 'test-.*', r'.*@service\.example\.com', '.*', 'x', 'Ops',
+                r'build\d+', '(a|b)c', r'(q)\1', '[jk]oe.*', r'a\*', 'é-user', r'app\.', 'ca.*e', 'ñ.*']
+    regexes = [re.compile(r'\A' + pattern + r'\Z', re.UNICODE | re.IGNORECASE) for pattern in patterns]
+    alphabet = u'abcijkoqstxéñK.-@*\n'
+    generator = random.Random(3)
+    usernames = [u'svc-backup', u'SVC-BACKUP', u'admin.account', u'adminxaccount', u'test-', u'Test-1',
+                 u'me@service.example.com', u'me@servicexexample.com', u'build42', u'build', u'ac', u'bc', u'qq',
+                 u'joe', u'KOE2', u'a*', u'é-user', u'É-USER', u'app.', u'cake', u'ca', u'ñu', u'Ñ', u'test-\n',
+                 u'Koe', u'']
+    usernames.extend(u''.join(generator.choice(alphabet) for _ in range(generator.randint(0, 6)))
+                     for _ in range(2000))
+    for count in (0, 1, 5, len(patterns)):
+        for chosen in (patterns[:count], patterns[-count:] if count else []):
+            matcher = ExclusionMatcher(chosen)
+            chosen_regexes = [regexes[patterns.index(pattern)] for pattern in chosen]
+            for username in usernames:
+                assert matcher.match(username) == any(regex.match(username) for regex in chosen_regexes), \
+                    (chosen, username)
+    matcher = ExclusionMatcher(patterns)
+    assert 'svc-backup' in matcher.literals
+    assert 'test-' in matcher.prefixes_by_length[5]
+    assert '@service.example.com' in matcher.suffixes_by_length[20]
+    assert [regex.pattern for regex in matcher.separate_regexes] == [r'\A(q)\1\Z']
+    with pytest.raises(re.error):
+        matcher.add('(unclosed')
+
+
+def test_additional_groups_are_evaluated_once_per_member_group():
+    import re
+    from user_sync.rules import AdobeGroup, RuleProcessor
+
+    source = re.compile(r'CN=(.+?),.*')
+    calls = []
+
+    class CountingSource(object):
+        def match(self, member_group):
+            calls.append(member_group)
+            return source.match(member_group)
+
+        def sub(self, target_name, member_group):
+            return source.sub(target_name, member_group)
+
+    rules = [{'source': CountingSource(), 'target': AdobeGroup.create(r'ACL-\1', index=False)}]
+    processor = RuleProcessor({'additional_groups': rules})
+    umapi_info = processor.get_umapi_info(None)
+    for member_group in ('CN=Sales,DC=example', 'CN=sales,OU=x,DC=example', 'CN=Sales,DC=example', 'Other'):
+        for umapi_info_for_group, rename_group in processor.get_additional_groups_for(member_group):
+            umapi_info_for_group.add_desired_group_for('federatedID,a,example.com', rename_group)
+    assert calls == ['CN=Sales,DC=example', 'CN=sales,OU=x,DC=example', 'Other']
+    assert umapi_info.get_mapped_groups() == {'acl-sales'}
+    assert umapi_info.get_additional_group_map() == {'acl-sales': ['CN=Sales,DC=example', 'CN=sales,OU=x,DC=example']}
+    assert umapi_info.get_desired_groups('federatedID,a,example.com') == {'acl-sales'}
+
+
+HOOK_MODULE = '''
+calls = []
+
+
+def map_users(users):
+    calls.append(len(users))
+    for user in users:
+        department = user['source_attributes'].get('department')
+        if department:
+            user['target_groups'].add('Hook ' + department)
+        # the chunk size, which doesn't depend on which process ran the chunk
+        user['target_attributes']['country'] = str(len(users))
+'''
+
+
+class ListDirectoryConnector(object):
+    def __init__(self, users):
+        self.users = users
+
+    def select_users(self, names):
+        return False
+
+    def load_users_and_groups(self, groups, extended_attributes, all_users):
+        return iter(self.users)
+
+    def get_changed_users(self):
+        return None
+
+
+@pytest.mark.parametrize('processes', [1, 2])
+def test_after_mapping_hook_module(tmpdir, processes):
+    from user_sync.rules import AdobeGroup, RuleProcessor
+
+    hook_path = tmpdir.join('hook.py')
+    hook_path.write(HOOK_MODULE)
+    for name in ('Hook Sales', 'Hook Ops', 'Hooked Users'):
+        AdobeGroup.create(name)
+    directory_users = []
+    for i in range(5):
+        directory_users.append({'identity_type': 'federatedID', 'username': 'user%d@example.com' % i,
+                                'email': 'user%d@example.com' % i, 'domain': 'example.com', 'firstname': 'F',
+                                'lastname': 'L', 'country': 'US', 'groups': ['everyone'],
+                                'source_attributes': {'department': 'Sales' if i % 2 else 'Ops'}})
+    processor = RuleProcessor({'after_mapping_hook_module': str(hook_path), 'after_mapping_hook_batch_size': 2,
+                               'after_mapping_hook_processes': processes})
+    mappings = {'everyone': [AdobeGroup.lookup('Hooked Users')]}
+    processor.read_desired_user_groups(mappings, ListDirectoryConnector(directory_users))
+
+    desired = processor.get_umapi_info(None).get_desired_groups_by_user_key()
+    assert desired['federatedID,user1@example.com,'] == {'hooked users', 'hook sales'}
+    assert desired['federatedID,user4@example.com,'] == {'hooked users', 'hook ops'}
+    countries = [user['country'] for user in processor.directory_user_by_user_key.values()]
+    assert countries == ['2', '2', '2', '2', '1']
+    if processes == 1:
+        assert processor.after_mapping_hook_module.calls == [2, 2, 1]
+    else:
+        # the workers have their own copies of the module, so the main process makes no calls
+        assert processor.after_mapping_hook_module.calls == []
+
+
+class SelectingDirectoryConnector(ListDirectoryConnector):
+    def select_users(self, names):
+        self.selected_names = names
+        return False
+
+
+class SingleUserConnector(RecordingConnector):
+    name = 'umapi'
+
+    def iter_users(self, in_group=None):
+        raise AssertionError('the whole org should not be read')
+
+    def get_user(self, email):
+        self.fetched.append(email)
+        return dict((user['email'], user) for user in self.users).get(email)
+
+
+def test_selected_users_are_fetched_one_by_one():
+    from user_sync.rules import RuleProcessor
+
+    def user(name, firstname):
+        return {'identity_type': 'federatedID', 'type': 'federatedID', 'username': name, 'email': name,
+                'domain': 'example.com', 'firstname': firstname, 'lastname': 'Smith', 'country': 'US',
+                'groups': []}
+
+    directory_users = [user('user%d@example.com' % i, 'New') for i in range(5)]
+    processor = RuleProcessor({'update_user_info': True, 'remove_strays': True,
+                               'selected_usernames': ['gone@example.com', 'user1@example.com', 'user3@example.com']})
+    directory_connector = SelectingDirectoryConnector(directory_users)
+    processor.read_desired_user_groups({}, directory_connector)
+    assert directory_connector.selected_names == ['gone@example.com', 'user1@example.com', 'user3@example.com']
+    assert sorted(processor.filtered_directory_user_by_user_key) == ['federatedID,user1@example.com,',
+                                                                     'federatedID,user3@example.com,']
+
+    umapi_info = processor.get_umapi_info(None)
+    umapi_info.finalize_desired_groups()
+    connector = SingleUserConnector([user('user1@example.com', 'Old'), user('gone@example.com', 'Gone'),
+                                     user('user2@example.com', 'Old')])
+    connector.fetched = []
+    to_create = processor.update_umapi_users_for_connector(umapi_info, connector)
+    assert sorted(connector.fetched) == ['gone@example.com', 'user1@example.com', 'user3@example.com']
+    assert list(to_create) == ['federatedID,user3@example.com,']
+    assert 'user1@example.com' in [username for username, _ in connector.commands]
+    assert list(processor.stray_key_map[None]) == ['federatedID,gone@example.com,']
+
+
+class IdleUmapiConnectors(object):
+    """UMAPI connectors that sent nothing, as far as commit_directory_changes can tell"""
+    class Connector(object):
+        def get_action_manager(self):
+            return self
+
+        def get_statistics(self):
+            return 0, 0
+
+    def get_primary_connector(self):
+        return self.Connector()
+
+    def get_secondary_connectors(self):
+        return {}
+
+
+@pytest.mark.parametrize('filter_options', [
+    {'username_filter_regex': re.compile('a.*')},
+    {'directory_group_filter': ['g1']},
+])
+def test_filtered_run_leaves_csv_index_unchanged(tmpdir, filter_options):
+    import user_sync.connector.directory_csv
+    from user_sync.connector.directory import DirectoryConnector
+    from user_sync.rules import RuleProcessor
+
+    file_path = tmpdir.join('users.csv')
+    index_path = tmpdir.join('users.index')
+
+    def sync(options):
+        directory_connector = DirectoryConnector(user_sync.connector.directory_csv)
+        directory_connector.initialize({'file_path': str(file_path), 'index_path': str(index_path)})
+        processor = RuleProcessor(dict(options, update_user_info=True))
+        processor.read_desired_user_groups({}, directory_connector)
+        processor.commit_directory_changes(directory_connector, IdleUmapiConnectors())
+
+    file_path.write('email,firstname,groups\na@example.com,Ann,g1\nb@example.com,Bob,g2\n')
+    sync({})
+    index = index_path.read()
+    file_path.write('email,firstname,groups\na@example.com,Ann,g1\nb@example.com,Rob,g2\n')
+    sync(filter_options)
+    assert index_path.read() == index
+    sync({})
+    assert index_path.read() != index
@@ -0,0 +1,116 @@
+import pytest
+
+from user_sync.connector.helper import create_blank_user
+from user_sync.error import AssertionException
+from user_sync.snapshot import load_snapshot, save_snapshot
+
+
+def make_directory_users():
+    users = []
+    for i in range(20):
+        user = create_blank_user()
+        user['identity_type'] = 'federatedID'
+        user['email'] = u'user%d@example.com' % i
+        user['username'] = user['email'] if i % 3 else u'user%d' % i
+        user['domain'] = u'example.com' if i % 3 == 0 else None
+        user['firstname'] = u'Frédéric %d' % i
+        user['groups'] = [u'Group %d' % (i % 4), u'All'] if i % 5 else []
+        user['country'] = u'US' if i % 2 else None
+        user['source_attributes'] = {u'email': user['email'], u'dept': None if i % 2 else u'Sales'}
+        users.append(user)
+    return users
+
+
+def test_round_trip_directory_users(tmpdir):
+    file_path = str(tmpdir.join('users.snapshot'))
+    users = make_directory_users()
+    save_snapshot(file_path, users)
+    with load_snapshot(file_path) as snapshot:
+        assert len(snapshot) == len(users)
+        assert list(snapshot) == users
+        assert snapshot[-1] == users[-1]
+        assert snapshot.get_column('country') == [user['country'] for user in users]
+
+
+def test_round_trip_umapi_users(tmpdir):
+    file_path = str(tmpdir.join('umapi.snapshot'))
+    users = [
+        {'email': 'a@example.com', 'status': 'active', 'groups': ['g1', 'g2'], 'username': 'a@example.com',
+         'domain': 'example.com', 'firstname': 'A', 'lastname': 'B', 'country': 'US', 'type': 'federatedID',
+         'adminRoles': ['org']},
+        {'email': 'b@example.com', 'status': 'active', 'username': 'b@example.com', 'domain': 'example.com',
+         'type': 'adobeID', 'tags': {'count': 1, 'edu': True}},
+        {},
+    ]
+    save_snapshot(file_path, users)
+    with load_snapshot(file_path) as snapshot:
+        assert list(snapshot) == users
+        assert snapshot.get_column('groups', []) == [['g1', 'g2'], [], []]
+
+
+def test_not_a_snapshot(tmpdir):
+    file_path = tmpdir.join('users.csv')
+    file_path.write('email\n')
+    with pytest.raises(AssertionException):
+        load_snapshot(str(file_path))
+
+
+class UnsentActions(object):
+    """An action manager that makes no actions, so nothing is sent"""
+    def create_action(self, commands):
+        return None
+
+
+def test_umapi_connector_keeps_users_between_full_reads(tmpdir):
+    import logging
+    import time
+    from user_sync.connector.umapi import Commands, UmapiConnector
+
+    org = dict((email, {'email': email, 'username': email, 'domain': 'example.com', 'type': 'federatedID',
+                        'groups': ['g1']}) for email in ('a@example.com', 'b@example.com', 'c@example.com'))
+    reads = []
+    connector = UmapiConnector.__new__(UmapiConnector)
+    connector.logger = logging.getLogger('test')
+    connector.query_users = lambda in_group=None: reads.append(in_group) or iter(list(org.values()))
+    connector.get_user = lambda email: reads.append(email) or org.get(email)
+    connector.action_manager = UnsentActions()
+    connector.keep_user_snapshot(str(tmpdir), 60)
+
+    def emails_read():
+        return sorted(user['email'] for user in connector.iter_users())
+
+    assert emails_read() == sorted(org)
+    assert reads == [None]
+    assert len(tmpdir.listdir()) == 1
+
+    # the next run reads again only the users it was sent actions for
+    org['b@example.com'] = dict(org['b@example.com'], groups=[])
+    commands = Commands(email='B@example.com', username='B@example.com')
+    commands.remove_groups(['g1'])
+    connector.send_commands(commands)
+    del org['c@example.com']
+    commands = Commands(email='c@example.com', username='c@example.com')
+    commands.remove_from_org(False)
+    connector.send_commands(commands)
+    reads[:] = []
+    users = list(connector.iter_users())
+    assert sorted(reads) == ['b@example.com', 'c@example.com']
+    assert dict((user['email'], user['groups']) for user in users) == {'a@example.com': ['g1'], 'b@example.com': []}
+
+    # group queries and users that can't be looked up by email go to the server
+    reads[:] = []
+    list(connector.iter_users(in_group='g1'))
+    assert reads == ['g1']
+    commands = Commands(username='d', domain='example.com')
+    commands.add_groups(['g1'])
+    connector.send_commands(commands)
+    reads[:] = []
+    assert emails_read() == ['a@example.com', 'b@example.com']
+    assert reads == [None]
+    assert len(tmpdir.listdir()) == 1
+
+    # and so are all the users, once the snapshot is too old
+    connector.snapshot_time = time.time() - 60
+    reads[:] = []
+    emails_read()
+    assert reads == [None]
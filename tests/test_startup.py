@@ -0,0 +1,44 @@
+import os
+import subprocess
+import sys
+
+# these are only needed once a connector is actually made, so loading the app must not import them
+deferred_modules = ['umapi_client', 'jwt', 'Crypto', 'ldap3', 'okta', 'pkg_resources', 'keyring', 'http']
+
+# the budget is generous so that a slow machine doesn't fail the test; a regression in the deferred
+# imports roughly triples the startup time
+startup_budget_seconds = 2.0
+
+
+def import_app(module='user_sync.app'):
+    """
+    Import the app, or one of its modules, in a fresh interpreter with -X importtime, returning the
+    top-level modules loaded and the total import time in seconds.
+    :rtype: (set(str), float)
+    """
+    root_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    process = subprocess.Popen([sys.executable, '-X', 'importtime', '-c', 'import ' + module],
+                               cwd=root_dir, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    _, report = process.communicate()
+    assert process.returncode == 0, report
+    modules = set()
+    total = 0
+    for line in report.decode('utf8').splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        self_time, _, name = line[len('import time:'):].split('|')
+        total += int(self_time)
+        modules.add(name.strip().split('.')[0])
+    return modules, total / 1e6
+
+
+def test_startup_defers_connector_imports():
+    modules, seconds = import_app()
+    assert not modules.intersection(deferred_modules)
+    assert 'user_sync' in modules
+    assert seconds < startup_budget_seconds
+
+
+def test_umapi_connector_module_defers_umapi_client():
+    modules, _ = import_app('user_sync.connector.umapi')
+    assert 'umapi_client' not in modules
@@ -0,0 +1,185 @@
+import json
+import threading
+
+import pytest
+from six.moves import http_client
+
+from user_sync import app
+from user_sync.lockfile import ProcessLock
+from user_sync.trigger import TriggerQueue, TriggerServer
+
+
+@pytest.fixture
+def trigger_server():
+    server = TriggerServer(TriggerQueue(window=0.2), 0)
+    server.start()
+    yield server
+    server.stop()
+
+
+def request(server, method, path, body=None):
+    connection = http_client.HTTPConnection(*server.server_address[:2])
+    connection.request(method, path, body=json.dumps(body) if body is not None else None)
+    response = connection.getresponse()
+    result = response.status, response.read().decode('utf8')
+    connection.close()
+    return result
+
+
+def test_requests_are_coalesced(trigger_server):
+    queue = trigger_server.trigger_queue
+    assert queue.take(0.01) is None
+    assert request(trigger_server, 'POST', '/sync', {'users': ['JDoe@example.com']})[0] == 202
+    assert request(trigger_server, 'POST', '/sync', {'users': ['jdoe@example.com', 'b@example.com'],
+                                                     'groups': ['Sales']})[0] == 202
+    assert request(trigger_server, 'POST', '/sync', {'users': 'jdoe@example.com'})[0] == 400
+    assert request(trigger_server, 'POST', '/sync', {})[0] == 400
+    assert request(trigger_server, 'GET', '/sync')[0] == 404
+    assert 'user_sync_trigger_queue_depth 2' in request(trigger_server, 'GET', '/metrics')[1]
+
+    # a request that comes in during the window joins the batch
+    timer = threading.Timer(0.05, queue.add, (['c@example.com'], []))
+    timer.start()
+    batch = queue.take(1)
+    timer.join()
+    assert len(batch) == 3
+    assert batch.users == ['b@example.com', 'c@example.com', 'jdoe@example.com']
+    assert batch.groups == ['Sales']
+
+
+def test_triggered_runs(trigger_server, tmpdir, monkeypatch):
+    runs = []
+    monkeypatch.setattr(app, 'run_work', lambda work, rule_overrides=None: runs.append(rule_overrides))
+    queue = trigger_server.trigger_queue
+    request(trigger_server, 'POST', '/sync', {'users': ['a@example.com'], 'groups': ['Sales']})
+    batch = queue.take(1)
+    lock = ProcessLock(str(tmpdir.join('lockfile')))
+    assert app.run_triggered_work(None, lock, batch)
+    queue.record_run(batch)
+    assert runs == [{'selected_usernames': ['a@example.com']},
+                    {'directory_group_filter': ['Sales'], 'exclude_strays': True}]
+    assert not lock.is_locked()
+
+    metrics = request(trigger_server, 'GET', '/metrics')[1]
+    assert 'user_sync_trigger_queue_depth 0' in metrics
+    assert 'user_sync_trigger_requests_handled_total 1' in metrics
+    assert 'user_sync_trigger_runs_total 1' in metrics
+    assert queue.max_latency >= 0.2
+
+
+class CommitRecordingDirectoryConnector(object):
+    def __init__(self, users):
+        self.users = users
+        self.commits = 0
+        self.prepared_runs = 0
+
+    def prepare_run(self):
+        self.prepared_runs += 1
+
+    def select_users(self, names):
+        return False
+
+    def load_users_and_groups(self, groups, extended_attributes, all_users):
+        return iter([user for user in self.users if all_users or set(user['groups']) & set(groups)])
+
+    def get_changed_users(self):
+        return None
+
+    def commit(self):
+        self.commits += 1
+
+
+class IdleUmapiConnector(object):
+    name = 'umapi'
+    trusted = False
+
+    def __init__(self, users):
+        self.users = users
+        self.commands = []
+
+    def iter_users(self, in_group=None):
+        return iter(self.users)
+
+    def get_user(self, email):
+        return dict((user['email'], user) for user in self.users).get(email)
+
+    def send_commands(self, commands, callback=None):
+        if len(commands) > 0:
+            self.commands.append(commands.username)
+
+    def prepare_run(self):
+        pass
+
+    def get_action_manager(self):
+        return self
+
+    def get_statistics(self):
+        return len(self.commands), 0
+
+    def get_retried_count(self):
+        return 0
+
+    def has_work(self):
+        return False
+
+    def flush(self):
+        pass
+
+    def set_journal(self, journal, journal_name):
+        pass
+
+
+class NoJournalConfigLoader(object):
+    def get_invocation_options(self):
+        return {'action_journal': None}
+
+
+def test_triggered_group_run_does_not_commit_directory_changes(tmpdir):
+    from user_sync.rules import AdobeGroup, RuleProcessor, UmapiConnectors
+    from user_sync.trigger import TriggerBatch
+
+    users = [{'identity_type': 'federatedID', 'username': name, 'email': name, 'domain': 'example.com',
+              'firstname': 'F', 'lastname': 'L', 'country': 'US', 'groups': [group]}
+             for name, group in (('a@example.com', 'Sales'), ('b@example.com', 'Ops'))]
+    directory_connector = CommitRecordingDirectoryConnector(users)
+    umapi_connector = IdleUmapiConnector([dict(user, type='federatedID', firstname='Old', groups=[])
+                                          for user in users])
+    directory_groups = {'Sales': [AdobeGroup.create('Sales Users')], 'Ops': [AdobeGroup.create('Ops Users')]}
+    rule_config = dict(RuleProcessor.default_options, update_user_info=True, process_groups=True,
+                       exclude_unmapped_users=False)
+    work = app.SyncWork(NoJournalConfigLoader(), directory_groups, rule_config, directory_connector,
+                        UmapiConnectors(umapi_connector, {}))
+    lock = ProcessLock(str(tmpdir.join('lockfile')))
+
+    assert app.run_triggered_work(work, lock, TriggerBatch([(0, [], ['Sales'])]))
+    assert umapi_connector.commands == ['a@example.com']
+    assert directory_connector.commits == 0
+
+    # a full run still commits, and the directory connection is renewed for it
+    app.run_work(work)
+    assert directory_connector.commits == 1
+    assert directory_connector.prepared_runs == 1
+
+
+def test_triggered_user_run_leaves_later_runs_unfiltered(tmpdir, mock_ldap_connector):
+    from user_sync.rules import RuleProcessor, UmapiConnectors
+    from user_sync.trigger import TriggerBatch
+
+    emails = ['ann@example.com', 'bob@example.com', 'cy@example.com']
+    directory_connector = mock_ldap_connector(emails)
+    # the directory users have no identity type, so they are taken to be Enterprise IDs
+    umapi_connector = IdleUmapiConnector([{'identity_type': 'enterpriseID', 'type': 'enterpriseID', 'username': email,
+                                           'email': email, 'domain': 'example.com', 'firstname': 'Old',
+                                           'lastname': 'Last', 'country': 'US', 'groups': []} for email in emails])
+    rule_config = dict(RuleProcessor.default_options, update_user_info=True, exclude_unmapped_users=False)
+    work = app.SyncWork(NoJournalConfigLoader(), {}, rule_config, directory_connector,
+                        UmapiConnectors(umapi_connector, {}))
+    lock = ProcessLock(str(tmpdir.join('lockfile')))
+
+    assert app.run_triggered_work(work, lock, TriggerBatch([(0, ['bob@example.com'], [])]))
+    assert umapi_connector.commands == ['bob@example.com']
+
+    # the scheduled run that follows, on the same directory connector, reads every user
+    umapi_connector.commands = []
+    app.run_work(work)
+    assert sorted(umapi_connector.commands) == emails
@@ -0,0 +1,114 @@
+import logging
+
+import umapi_client
+
+from user_sync.connector.umapi import ActionManager
+
+
+class RejectingConnection(object):
+    """
+    Sends actions four at a time, rejects as a whole any batch with a bad action in it, and reports
+    an error on each action for a user whose name starts with err
+    """
+    throttle_actions = 4
+
+    def __init__(self):
+        self.action_queue = []
+        self.batches = []
+
+    def execute_single(self, action):
+        return self.execute_multiple([action], immediate=False)
+
+    def execute_queued(self):
+        return self.execute_multiple([], immediate=True)
+
+    def execute_multiple(self, actions, immediate=True):
+        actions = self.action_queue + actions
+        sent = 0
+        causes = []
+        while actions and (immediate or len(actions) >= self.throttle_actions):
+            batch, actions = actions[:self.throttle_actions], actions[self.throttle_actions:]
+            sent += len(batch)
+            try:
+                self.send_batch(batch)
+            except Exception as e:
+                causes.append(e)
+        self.action_queue = actions
+        if causes:
+            raise umapi_client.BatchError(causes, len(actions), sent, 0)
+        return len(actions), sent, sent
+
+    def send_batch(self, batch):
+        self.batches.append([action.frame['user'] for action in batch])
+        if any(action.frame['user'].startswith('bad') for action in batch):
+            raise umapi_client.ClientError('bad request', None)
+        for index, action in enumerate(batch):
+            if action.frame['user'].startswith('err'):
+                action.report_command_error({'index': index, 'step': 0, 'errorCode': 'error.user.nonexistent',
+                                             'message': 'no such user'})
+        return len(batch)
+
+
+def send(users, batch_retries):
+    connection = RejectingConnection()
+    action_manager = ActionManager(connection, 'org', logging.getLogger('test'), batch_retries)
+    results = {}
+    for user in users:
+        action = umapi_client.Action(user=user).append(add={'group': ['g1']})
+        action_manager.add_action(action, lambda result, user=user: results.update({user: result['is_success']}))
+    action_manager.flush()
+    return action_manager, connection, results
+
+
+def test_failed_batch_is_split_until_the_bad_action_is_found():
+    action_manager, connection, results = send(['a', 'b', 'bad', 'c', 'd'], 10)
+    assert results == {'a': True, 'b': True, 'bad': False, 'c': True, 'd': True}
+    assert action_manager.get_statistics() == (5, 1)
+    assert action_manager.get_retried_count() == 3
+    assert connection.batches == [['a', 'b', 'bad', 'c'], ['a', 'b'], ['bad', 'c'], ['bad'], ['c'], ['d']]
+
+
+def test_retries_stop_when_the_budget_is_spent():
+    action_manager, _, results = send(['a', 'b', 'bad', 'c'], 2)
+    assert results == {'a': True, 'b': True, 'bad': False, 'c': False}
+    assert action_manager.get_statistics() == (4, 2)
+    assert action_manager.get_retried_count() == 2
+
+
+def test_only_the_failed_batches_of_a_call_are_sent_again():
+    connection = RejectingConnection()
+    action_manager = ActionManager(connection, 'org', logging.getLogger('test'), 10)
+    results = {}
+    users = ['a', 'err', 'c', 'd', 'bad', 'e', 'f', 'g']
+    # the queued actions are sent in two batches by one call: the first is answered with an error
+    # on one action, and the second fails as a whole
+    for user in users:
+        action = umapi_client.Action(user=user).append(add={'group': ['g1']})
+        callback = lambda result, user=user: results.update({user: result['is_success']})
+        action_manager.items.append({'action': action, 'callback': callback})
+        connection.action_queue.append(action)
+    action_manager.flush()
+    assert results == dict((user, user not in ('err', 'bad')) for user in users)
+    assert action_manager.get_statistics() == (0, 2)
+    assert action_manager.get_retried_count() == 3
+    assert connection.batches == [['a', 'err', 'c', 'd'], ['bad', 'e', 'f', 'g'], ['bad', 'e'], ['bad'], ['e'],
+                                  ['f', 'g']]
+
+
+def test_queued_actions_are_sent_before_a_failed_batch_is_sent_again():
+    connection = RejectingConnection()
+    action_manager = ActionManager(connection, 'org', logging.getLogger('test'), 10)
+    results = {}
+    users = ['a', 'b', 'bad', 'c', 'd', 'e', 'f']
+    for user in users:
+        action = umapi_client.Action(user=user).append(add={'group': ['g1']})
+        callback = lambda result, user=user: results.update({user: result['is_success']})
+        if user == 'f':
+            # adding this action sends a batch of the first four, and leaves the rest queued
+            action_manager.add_action(action, callback)
+        else:
+            action_manager.items.append({'action': action, 'callback': callback})
+            connection.action_queue.append(action)
+    assert results == dict((user, user != 'bad') for user in users)
+    assert action_manager.get_statistics() == (1, 1)
+    assert connection.batches == [['a', 'b', 'bad', 'c'], ['d', 'e', 'f'], ['a', 'b'], ['bad', 'c'], ['bad'], ['c']]
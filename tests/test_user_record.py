@@ -0,0 +1,46 @@
+import pickle
+
+import pytest
+
+from user_sync.connector.helper import create_blank_user, DirectoryUserRecord, UmapiUserRecord, UserRecordCompactor
+
+
+def test_record_acts_like_dict():
+    user = create_blank_user()
+    expected = {'identity_type': None, 'username': None, 'domain': None, 'firstname': None, 'lastname': None,
+                'email': None, 'groups': [], 'country': None}
+    assert user == expected
+    user['uid'] = '1234'
+    user.update({'email': 'a@example.com'})
+    user['groups'].append('g1')
+    expected.update({'uid': '1234', 'email': 'a@example.com', 'groups': ['g1']})
+    assert dict(user) == expected
+    assert len(user) == len(expected)
+    assert user.get('source_attributes') is None
+    assert 'uid' in user and 'member_groups' not in user
+    del user['country']
+    with pytest.raises(KeyError):
+        user['country']
+    with pytest.raises(KeyError):
+        del user['nothing']
+    assert pickle.loads(pickle.dumps(user)) == user
+    assert user.copy() == user and user.copy() is not user
+
+
+def test_compactor_shares_values():
+    compactor = UserRecordCompactor(keep_source_attributes=False)
+    first = {'email': 'a@example.com', 'domain': ''.join(['example', '.com']), 'groups': ['g1', 'g2'],
+             'identity_type': 'federatedID', 'source_attributes': {'email': 'a@example.com'}}
+    second = dict(first, email='b@example.com', domain=''.join(['example', '.com']), groups=['g1', 'g2'])
+    first = compactor.compact_directory_user(first)
+    second = compactor.compact_directory_user(second)
+    assert isinstance(first, DirectoryUserRecord)
+    assert first['groups'] == ('g1', 'g2') and first['groups'] is second['groups']
+    assert first['domain'] is second['domain']
+    assert 'source_attributes' not in first
+
+    umapi_user = compactor.compact_umapi_user({'email': 'a@example.com', 'type': 'federatedID',
+                                               'groups': ['g1', 'g2'], 'adminRoles': ['org']})
+    assert isinstance(umapi_user, UmapiUserRecord)
+    assert umapi_user['groups'] is first['groups']
+    assert umapi_user['adminRoles'] == ['org']
@@ -22,6 +22,9 @@ import argparse
 import logging
 import os
 import sys
+import tempfile
+import threading
+import time
 import click
 import shutil
 from click_default_group import DefaultGroup
@@ -32,17 +35,25 @@ import six
 import user_sync.config
 import user_sync.connector.directory
 import user_sync.connector.umapi
+import user_sync.connector.umapi_util
 import user_sync.helper
+import user_sync.journal
 import user_sync.lockfile
+import user_sync.plan
 import user_sync.rules
 import user_sync.cli
-import user_sync.resource
 from user_sync.error import AssertionException
 from user_sync.version import __version__ as app_version
 
 LOG_STRING_FORMAT = '%(asctime)s %(process)d %(levelname)s %(name)s - %(message)s'
 LOG_DATE_FORMAT = '%Y-%m-%d %H:%M:%S'
 
+# seconds between the starts of daemon runs, unless --interval says otherwise
+DAEMON_DEFAULT_INTERVAL = 3600
+
+# seconds that the daemon waits after a sync request for others to join it
+TRIGGER_DEFAULT_WINDOW = 5
+
 # file logger, defined early so later functions can refer to it.
 logger = logging.getLogger('main')
 
@@ -59,6 +70,9 @@ def init_console_log():
 # console logger, initialized early so there is at least one logger available.
 console_log_handler = init_console_log()
 
+# file loggers, added by init_log
+file_log_handlers = []
+
 
 @click.group(cls=DefaultGroup, default='sync', default_if_no_args=True)
 @click.help_option('-h', '--help')
@@ -81,81 +95,151 @@ def main():
     pass
 
 
+action_journal_option = click.option('--action-journal',
+                                     help="record each action sent to Adobe, and its result, in this file, so "
+                                          "that a run which stops partway through can be finished with --resume "
+                                          "(the daemon sends any unanswered actions again before its next run)",
+                                     type=str,
+                                     nargs=1,
+                                     metavar='path-to-file')
+config_encoding_option = click.option('--config-file-encoding', 'encoding_name',
+                                      help="encoding of your configuration files",
+                                      type=str,
+                                      nargs=1,
+                                      metavar='encoding-name')
+config_filename_option = click.option('-c', '--config-filename',
+                                      help="path to your main configuration file",
+                                      type=str,
+                                      nargs=1,
+                                      metavar='path-to-file')
+test_mode_option = click.option('-t/-T', '--test-mode/--no-test-mode', default=None,
+                                help='enable test mode (API calls do not execute changes on the Adobe side).')
+
+# the options shared by the sync, daemon and plan commands
+sync_options = [
+    action_journal_option,
+    config_encoding_option,
+    config_filename_option,
+    click.option('--adobe-only-user-action',
+                 help="specify what action to take on Adobe users that don't match users from the "
+                      "directory.  Options are 'exclude' (from all changes), "
+                      "'preserve' (as is except for --process-groups, the default), "
+                      "'write-file f' (preserve and list them), "
+                      "'remove-adobe-groups' (but do not remove users)"
+                      "'remove' (users but preserve cloud storage), "
+                      "'delete' (users and their cloud storage), ",
+                 cls=user_sync.cli.OptionMulti,
+                 type=list,
+                 metavar='exclude|preserve|delete|remove|remove-adobe-groups|write-file [path-to-file.csv]'),
+    click.option('--adobe-only-user-list',
+                 help="instead of computing Adobe-only users (Adobe users with no matching users "
+                      "in the directory) by comparing Adobe users with directory users, "
+                      "the list is read from a file (see --adobe-only-user-action write-file). "
+                      "When using this option, you must also specify what you want done with Adobe-only "
+                      "users by also including --adobe-only-user-action and one of its arguments",
+                 type=str,
+                 nargs=1,
+                 metavar='input_path'),
+    click.option('--adobe-users',
+                 help="specify the adobe users to pull from UMAPI. Legal values are 'all' (the default), "
+                      "'group names' (one or more specified groups), 'mapped' (all groups listed in "
+                      "the configuration file)",
+                 cls=user_sync.cli.OptionMulti,
+                 type=list,
+                 metavar='all|mapped|group [group list]'),
+    click.option('--connector',
+                 help='specify a connector to use; default is LDAP (or CSV if --users file is specified)',
+                 cls=user_sync.cli.OptionMulti,
+                 type=list,
+                 metavar='ldap|okta|csv|adobe_console [path-to-file.csv]'),
+    click.option('--exclude-unmapped-users/--include-unmapped-users', default=None,
+                 help='Exclude users that is not part of a mapped group from being created on Adobe side'),
+    click.option('--process-groups/--no-process-groups', default=None,
+                 help='if membership in mapped groups differs between the enterprise directory and Adobe sides, '
+                      'the group membership is updated on the Adobe side so that the memberships in mapped '
+                      'groups match those on the enterprise directory side.'),
+    click.option('--strategy',
+                 help="whether to fetch and sync the Adobe directory against the customer directory "
+                      "or just to push each customer user to the Adobe side.  Default is to fetch and sync.",
+                 nargs=1,
+                 type=str,
+                 metavar='sync|push'),
+    test_mode_option,
+    click.option('--user-filter',
+                 help='limit the selected set of users that may be examined for syncing, with the pattern '
+                      'being a regular expression.',
+                 nargs=1,
+                 type=str,
+                 metavar='pattern'),
+    click.option('--users',
+                 help="specify the users to be considered for sync. Legal values are 'all' (the default), "
+                      "'group names' (one or more specified groups), 'mapped' (all groups listed in "
+                      "the configuration file), 'file f' (a specified input file), 'keys names' (the users "
+                      "with these usernames or emails, comma-separated, or '-' to read them from standard input; "
+                      "only these users are read from the directory and from Adobe).",
+                 cls=user_sync.cli.OptionMulti,
+                 type=list,
+                 metavar='all|file|mapped|group|keys [group list, path-to-file.csv or user list]'),
+    click.option('--update-user-info/--no-update-user-info', default=None,
+                 help='user attributes on the Adobe side are updated from the directory.'),
+]
+
+
+# the options of the apply command, which only sends to Adobe what a plan says
+apply_options = [
+    action_journal_option,
+    config_encoding_option,
+    config_filename_option,
+    test_mode_option,
+]
+
+
+def add_options(options):
+    def add(command):
+        for option in reversed(options):
+            command = option(command)
+        return command
+    return add
+
+
+add_sync_options = add_options(sync_options)
+
+
 @main.command()
 @click.help_option('-h', '--help')
-@click.option('--config-file-encoding', 'encoding_name',
-              help="encoding of your configuration files",
-              type=str,
-              nargs=1,
-              metavar='encoding-name')
-@click.option('-c', '--config-filename',
-              help="path to your main configuration file",
-              type=str,
-              nargs=1,
-              metavar='path-to-file')
-@click.option('--adobe-only-user-action',
-              help="specify what action to take on Adobe users that don't match users from the "
-                   "directory.  Options are 'exclude' (from all changes), "
-                   "'preserve' (as is except for --process-groups, the default), "
-                   "'write-file f' (preserve and list them), "
-                   "'remove-adobe-groups' (but do not remove users)"
-                   "'remove' (users but preserve cloud storage), "
-                   "'delete' (users and their cloud storage), ",
-              cls=user_sync.cli.OptionMulti,
-              type=list,
-              metavar='exclude|preserve|delete|remove|remove-adobe-groups|write-file [path-to-file.csv]')
-@click.option('--adobe-only-user-list',
-              help="instead of computing Adobe-only users (Adobe users with no matching users "
-                   "in the directory) by comparing Adobe users with directory users, "
-                   "the list is read from a file (see --adobe-only-user-action write-file). "
-                   "When using this option, you must also specify what you want done with Adobe-only "
-                   "users by also including --adobe-only-user-action and one of its arguments",
-              type=str,
-              nargs=1,
-              metavar='input_path')
-@click.option('--adobe-users',
-              help="specify the adobe users to pull from UMAPI. Legal values are 'all' (the default), "
-                   "'group names' (one or more specified groups), 'mapped' (all groups listed in "
-                   "the configuration file)",
-              cls=user_sync.cli.OptionMulti,
-              type=list,
-              metavar='all|mapped|group [group list]')
-@click.option('--connector',
-              help='specify a connector to use; default is LDAP (or CSV if --users file is specified)',
-              cls=user_sync.cli.OptionMulti,
-              type=list,
-              metavar='ldap|okta|csv|adobe_console [path-to-file.csv]')
-@click.option('--exclude-unmapped-users/--include-unmapped-users', default=None,
-              help='Exclude users that is not part of a mapped group from being created on Adobe side')
-@click.option('--process-groups/--no-process-groups', default=None,
-              help='if membership in mapped groups differs between the enterprise directory and Adobe sides, '
-                   'the group membership is updated on the Adobe side so that the memberships in mapped '
-                   'groups match those on the enterprise directory side.')
-@click.option('--strategy',
-              help="whether to fetch and sync the Adobe directory against the customer directory "
-                   "or just to push each customer user to the Adobe side.  Default is to fetch and sync.",
-              nargs=1,
-              type=str,
-              metavar='sync|push')
-@click.option('-t/-T', '--test-mode/--no-test-mode', default=None,
-              help='enable test mode (API calls do not execute changes on the Adobe side).')
-@click.option('--user-filter',
-              help='limit the selected set of users that may be examined for syncing, with the pattern '
-                   'being a regular expression.',
-              nargs=1,
-              type=str,
-              metavar='pattern')
-@click.option('--users',
-              help="specify the users to be considered for sync. Legal values are 'all' (the default), "
-                   "'group names' (one or more specified groups), 'mapped' (all groups listed in "
-                   "the configuration file), 'file f' (a specified input file).",
-              cls=user_sync.cli.OptionMulti,
-              type=list,
-              metavar='all|file|mapped|group [group list or path-to-file.csv]')
-@click.option('--update-user-info/--no-update-user-info', default=None,
-              help='user attributes on the Adobe side are updated from the directory.')
+@add_sync_options
+@click.option('--resume', is_flag=True, default=None,
+              help="instead of a run, send again the actions in the --action-journal that Adobe never "
+                   "answered for, as when the run that recorded them stopped partway through")
 def sync(**kwargs):
     """Run User Sync [default command]"""
+    run_command(kwargs, begin_work)
+
+
+@main.command()
+@click.help_option('-h', '--help')
+@add_sync_options
+@click.argument('plan-path', metavar='plan-file')
+def plan(plan_path, **kwargs):
+    """Work out what a sync would change on the Adobe side, and write it to a plan file"""
+    run_command(kwargs, lambda config_loader: plan_work(config_loader, plan_path))
+
+
+@main.command()
+@click.help_option('-h', '--help')
+@add_options(apply_options)
+@click.argument('plan-path', metavar='plan-file')
+def apply(plan_path, **kwargs):
+    """Make the changes in a plan file, without reading the directory or the Adobe users"""
+    run_command(kwargs, lambda config_loader: apply_plan(config_loader, plan_path))
+
+
+def run_command(kwargs, work_function):
+    """
+    Load the configuration, start the logs, and do the command's work while holding the lock
+    :type kwargs: dict: the command line options
+    :type work_function: callable(user_sync.config.ConfigLoader)
+    """
     run_stats = None
     try:
         # load the config files and start the file logger
@@ -167,12 +251,10 @@ def sync(**kwargs):
         run_stats.log_start(logger)
         log_parameters(sys.argv[1:], config_loader)
 
-        script_dir = os.path.dirname(os.path.realpath(sys.argv[0]))
-        lock_path = os.path.join(script_dir, 'lockfile')
-        lock = user_sync.lockfile.ProcessLock(lock_path)
+        lock = user_sync.lockfile.ProcessLock(get_lock_path())
         if lock.set_lock():
             try:
-                begin_work(config_loader)
+                work_function(config_loader)
             finally:
                 lock.unlock()
         else:
@@ -198,6 +280,205 @@ def sync(**kwargs):
             run_stats.log_end(logger)
 
 
+@main.command()
+@click.help_option('-h', '--help')
+@add_sync_options
+@click.option('--interval',
+              help="how often to run the sync, in seconds (default %d).  A run that is due while "
+                   "the previous one is still going starts as soon as it ends." % DAEMON_DEFAULT_INTERVAL,
+              type=int,
+              nargs=1,
+              metavar='seconds')
+@click.option('--trigger-port',
+              help="listen on this port of the local host for requests to sync particular users or directory "
+                   "groups between scheduled runs (POST /sync), and serve metrics (GET /metrics)",
+              type=int,
+              nargs=1,
+              metavar='port')
+@click.option('--trigger-window',
+              help="how long to wait after a sync request or directory change for others to join it, "
+                   "in seconds (default %d)" % TRIGGER_DEFAULT_WINDOW,
+              type=float,
+              nargs=1,
+              metavar='seconds')
+@click.option('--adobe-refresh-interval',
+              help="keep each Adobe organization's users between runs, and only read them all again this often, "
+                   "in seconds.  In between, runs only read again the users they sent changes for, so changes "
+                   "made in other ways are seen at the next full read (default: read them all for every run)",
+              type=int,
+              nargs=1,
+              metavar='seconds')
+def daemon(**kwargs):
+    """Run User Sync on a schedule, keeping connections open between runs"""
+    interval = kwargs.pop('interval') or DAEMON_DEFAULT_INTERVAL
+    if interval <= 0:
+        raise click.BadParameter('must be positive', param_hint='--interval')
+    adobe_refresh_interval = kwargs.pop('adobe_refresh_interval')
+    if adobe_refresh_interval is not None and adobe_refresh_interval <= 0:
+        raise click.BadParameter('must be positive', param_hint='--adobe-refresh-interval')
+    trigger_port = kwargs.pop('trigger_port')
+    trigger_window = kwargs.pop('trigger_window')
+    if trigger_window is None:
+        trigger_window = TRIGGER_DEFAULT_WINDOW
+    # the HTTP server modules are only loaded when they are needed
+    import user_sync.trigger
+    # requests from the HTTP listener and changes reported by the directory connector both come in here
+    trigger_queue = user_sync.trigger.TriggerQueue(trigger_window)
+    trigger_server = None
+    subscriber = None
+    if trigger_port is not None:
+        try:
+            trigger_server = user_sync.trigger.TriggerServer(trigger_queue, trigger_port)
+        except (IOError, OSError) as e:
+            raise click.BadParameter("can't listen on port %d: %s" % (trigger_port, e), param_hint='--trigger-port')
+        trigger_server.start()
+    # the snapshots of the Adobe users kept between runs are only needed while the daemon runs
+    snapshot_dir = tempfile.mkdtemp(prefix='user-sync-') if adobe_refresh_interval else None
+    lock = user_sync.lockfile.ProcessLock(get_lock_path())
+    work = None
+    config_signature = None
+    try:
+        while True:
+            start_time = time.time()
+            run_stats = user_sync.helper.JobStats('Run (User Sync version: ' + app_version + ')', divider='=')
+            try:
+                if work is not None and get_config_signature(work.config_loader) != config_signature:
+                    logger.info('Configuration files have changed, reloading them')
+                    work = None
+                if work is None and subscriber is not None:
+                    subscriber.stop()
+                    subscriber = None
+                if work is None:
+                    # the groups are indexed as the configuration is read, so start over with them
+                    user_sync.rules.AdobeGroup.clear_index()
+                    config_loader = user_sync.config.ConfigLoader(kwargs)
+                    init_log(config_loader.get_logging_config())
+                    run_stats.log_start(logger)
+                    log_parameters(sys.argv[1:], config_loader)
+                    work = prepare_work(config_loader)
+                    work.keep_journal = True
+                    if snapshot_dir is not None:
+                        for umapi_connector in work.umapi_connectors.connectors:
+                            umapi_connector.keep_user_snapshot(snapshot_dir, adobe_refresh_interval)
+                    config_signature = get_config_signature(config_loader)
+                    if work.directory_connector is not None:
+                        subscriber = work.directory_connector.subscribe(trigger_queue.add)
+                else:
+                    run_stats.log_start(logger)
+                # the lock is only held during runs, so a scheduled sync can go in between them
+                if lock.set_lock():
+                    try:
+                        run_work(work)
+                    finally:
+                        lock.unlock()
+                else:
+                    logger.warning("A different User Sync process is currently running, skipping this run.")
+            except AssertionException as e:
+                if not e.is_reported():
+                    logger.critical("%s", e)
+                    e.set_reported()
+                # connections may be what failed, so don't keep them
+                work = None
+            except KeyboardInterrupt:
+                raise
+            except:
+                try:
+                    logger.error('Unhandled exception', exc_info=sys.exc_info())
+                except:
+                    pass
+                work = None
+            finally:
+                run_stats.log_end(logger)
+            next_run_time = start_time + interval
+            if work is not None:
+                logger.info('Next run in %d seconds, or sooner if requested', max(next_run_time - time.time(), 0))
+                while work is not None and time.time() < next_run_time:
+                    batch = trigger_queue.take(next_run_time - time.time())
+                    if batch is None:
+                        break
+                    if not run_triggered_work(work, lock, batch):
+                        work = None
+                    trigger_queue.record_run(batch)
+            wait = next_run_time - time.time()
+            if wait > 0:
+                logger.info('Next run in %d seconds', wait)
+                time.sleep(wait)
+    except KeyboardInterrupt:
+        try:
+            logger.critical('Keyboard interrupt, exiting immediately.')
+        except:
+            pass
+    finally:
+        if subscriber is not None:
+            subscriber.stop()
+        if trigger_server is not None:
+            trigger_server.stop()
+        if snapshot_dir is not None:
+            shutil.rmtree(snapshot_dir, ignore_errors=True)
+
+
+def run_triggered_work(work, lock, batch):
+    """
+    Do targeted runs for the users and the directory groups in a batch of sync requests.  Adobe-only
+    users are left alone in a run for groups, as it only reads some of the directory users.
+    :type work: SyncWork
+    :type lock: user_sync.lockfile.ProcessLock
+    :type batch: user_sync.trigger.TriggerBatch
+    :rtype bool: False if a run failed, in which case the work shouldn't be kept
+    """
+    run_stats = user_sync.helper.JobStats('Requested run (%d requests)' % len(batch), divider='=')
+    run_stats.log_start(logger)
+    try:
+        if not lock.set_lock():
+            logger.warning("A different User Sync process is currently running, skipping the requested run.")
+            return True
+        try:
+            if batch.users:
+                logger.info('Syncing requested users: %s', ', '.join(batch.users))
+                run_work(work, {'selected_usernames': batch.users})
+            if batch.groups:
+                logger.info('Syncing requested groups: %s', ', '.join(batch.groups))
+                run_work(work, {'directory_group_filter': batch.groups, 'exclude_strays': True})
+        finally:
+            lock.unlock()
+    except AssertionException as e:
+        if not e.is_reported():
+            logger.critical("%s", e)
+            e.set_reported()
+        return False
+    except KeyboardInterrupt:
+        raise
+    except:
+        try:
+            logger.error('Unhandled exception', exc_info=sys.exc_info())
+        except:
+            pass
+        return False
+    finally:
+        run_stats.log_end(logger)
+    return True
+
+
+def get_lock_path():
+    script_dir = os.path.dirname(os.path.realpath(sys.argv[0]))
+    return os.path.join(script_dir, 'lockfile')
+
+
+def get_config_signature(config_loader):
+    """
+    The modification times of the configuration files, which change when any of them is edited
+    :type config_loader: user_sync.config.ConfigLoader
+    :rtype list(tuple(str, float))
+    """
+    signature = []
+    for file_path in config_loader.get_config_file_paths():
+        try:
+            signature.append((file_path, os.path.getmtime(file_path)))
+        except OSError:
+            signature.append((file_path, None))
+    return signature
+
+
 @main.command()
 @click.help_option('-h', '--help')
 @click.option('--root', help="Filename of root user sync config file",
@@ -214,6 +495,7 @@ def example_config(**kwargs):
         'ldap': os.path.join('examples', 'connector-ldap.yml'),
     }
 
+    import user_sync.resource
     for k, fname in kwargs.items():
         assert k in res_files, "Invalid option specified"
         res_file = user_sync.resource.get_resource(res_files[k])
@@ -226,6 +508,7 @@ def example_config(**kwargs):
 @click.help_option('-h', '--help')
 def docs():
     """Open user manual in browser"""
+    import user_sync.resource
     res_file = user_sync.resource.get_resource('manual_url')
     assert res_file is not None, "User Manual URL file not found"
     with click.open_file(res_file) as f:
@@ -237,6 +520,12 @@ def init_log(logging_config):
     """
     :type logging_config: user_sync.config.DictConfig
     """
+    # the daemon calls this again when the configuration changes, and the new settings replace the old
+    while file_log_handlers:
+        file_handler = file_log_handlers.pop()
+        logging.getLogger().removeHandler(file_handler)
+        file_handler.close()
+
     builder = user_sync.config.OptionsBuilder(logging_config)
     builder.set_bool_value('log_to_file', False)
     builder.set_string_value('file_log_directory', 'logs')
@@ -274,6 +563,7 @@ def init_log(logging_config):
         file_handler.setLevel(file_log_level)
         file_handler.setFormatter(logging.Formatter(LOG_STRING_FORMAT, LOG_DATE_FORMAT))
         logging.getLogger().addHandler(file_handler)
+        file_log_handlers.append(file_handler)
         if unknown_file_log_level:
             logger.log(logging.WARNING, 'Unknown file log level: %s setting to info' % options['file_log_level'])
 
@@ -296,10 +586,44 @@ def log_parameters(argv, config_loader):
     logger.info('-------------------------------------')
 
 
+class SyncWork(object):
+    """
+    What a run needs that can be kept from one run to the next: the settings and the connectors
+    """
+    def __init__(self, config_loader, directory_groups, rule_config, directory_connector, umapi_connectors):
+        """
+        :type config_loader: user_sync.config.ConfigLoader
+        :type directory_groups: dict(str, list(user_sync.rules.AdobeGroup))
+        :type rule_config: dict
+        :type directory_connector: user_sync.connector.directory.DirectoryConnector
+        :type umapi_connectors: user_sync.rules.UmapiConnectors
+        """
+        self.config_loader = config_loader
+        self.directory_groups = directory_groups
+        self.rule_config = rule_config
+        self.directory_connector = directory_connector
+        self.umapi_connectors = umapi_connectors
+        self.run_count = 0
+        # a daemon keeps adding to its action journal until the UMAPI has answered for all of its actions
+        self.keep_journal = False
+
+
 def begin_work(config_loader):
     """
     :type config_loader: user_sync.config.ConfigLoader
     """
+    if config_loader.get_invocation_options()['resume']:
+        resume_work(config_loader)
+    else:
+        run_work(prepare_work(config_loader))
+
+
+def prepare_work(config_loader):
+    """
+    Read the settings and open the connections
+    :type config_loader: user_sync.config.ConfigLoader
+    :rtype SyncWork
+    """
     directory_groups = config_loader.get_directory_groups()
     rule_config = config_loader.get_rule_options()
 
@@ -338,6 +662,17 @@ def begin_work(config_loader):
     if directory_connector is not None:
         directory_connector.state.additional_group_filters = additional_group_filters
 
+    umapi_connectors = create_umapi_connectors(config_loader)
+    return SyncWork(config_loader, directory_groups, rule_config, directory_connector, umapi_connectors)
+
+
+def create_umapi_connectors(config_loader):
+    """
+    :type config_loader: user_sync.config.ConfigLoader
+    :rtype user_sync.rules.UmapiConnectors
+    """
+    user_sync.connector.umapi_util.token_cache.set_file_path(config_loader.get_token_cache_path())
+    primary_umapi_config, secondary_umapi_configs = config_loader.get_umapi_options()
     primary_name = '.primary' if secondary_umapi_configs else ''
     umapi_primary_connector = user_sync.connector.umapi.UmapiConnector(primary_name, primary_umapi_config)
     umapi_other_connectors = {}
@@ -345,12 +680,199 @@ def begin_work(config_loader):
         umapi_secondary_conector = user_sync.connector.umapi.UmapiConnector(".secondary.%s" % secondary_umapi_name,
                                                                             secondary_config)
         umapi_other_connectors[secondary_umapi_name] = umapi_secondary_conector
-    umapi_connectors = user_sync.rules.UmapiConnectors(umapi_primary_connector, umapi_other_connectors)
+    return user_sync.rules.UmapiConnectors(umapi_primary_connector, umapi_other_connectors)
 
+
+def run_work(work, rule_overrides=None):
+    """
+    Do one run.  Only the connections are reused between runs: the users are read afresh each time,
+    except for the Adobe users the daemon keeps in snapshots between full reads.
+    :type work: SyncWork
+    :type rule_overrides: dict: rule options to change for this run only
+    """
+    if work.run_count > 0:
+        if work.directory_connector is not None:
+            work.directory_connector.prepare_run()
+        for umapi_connector in work.umapi_connectors.connectors:
+            umapi_connector.prepare_run()
+        user_sync.helper.normalization_cache.reset_statistics()
+    work.run_count += 1
+
+    rule_config = work.rule_config
+    if rule_overrides:
+        rule_config = dict(rule_config)
+        rule_config.update(rule_overrides)
     rule_processor = user_sync.rules.RuleProcessor(rule_config)
-    if len(directory_groups) == 0 and rule_processor.will_process_groups():
+    if len(work.directory_groups) == 0 and rule_processor.will_process_groups():
         logger.warning('No group mapping specified in configuration but --process-groups requested on command line')
-    rule_processor.run(directory_groups, directory_connector, umapi_connectors)
+    # a plan sends nothing, so there's nothing to record
+    journal = None
+    if not rule_config['plan_only']:
+        if work.keep_journal:
+            journal = continue_journal(work.config_loader, work.umapi_connectors)
+        else:
+            journal = open_journal(work.config_loader, work.umapi_connectors, resume=False)
+    try:
+        rule_processor.run(work.directory_groups, work.directory_connector, work.umapi_connectors)
+    finally:
+        close_journal(work.umapi_connectors, journal)
+
+
+def plan_work(config_loader, plan_path):
+    """
+    Do a run that puts the actions in a plan file rather than sending them
+    :type config_loader: user_sync.config.ConfigLoader
+    :type plan_path: str
+    """
+    work = prepare_work(config_loader)
+    sync_plan = user_sync.plan.SyncPlan()
+    for connector in work.umapi_connectors.connectors:
+        connector.get_action_manager().set_plan(sync_plan.get_actions(connector.name))
+    run_work(work, {'plan_only': True})
+    sync_plan.write(plan_path)
+    logger.info('Wrote %d actions to the plan file %s', len(sync_plan), plan_path)
+
+
+def apply_plan(config_loader, plan_path):
+    """
+    Send the actions in a plan file, without reading any users
+    :type config_loader: user_sync.config.ConfigLoader
+    :type plan_path: str
+    """
+    sync_plan = user_sync.plan.SyncPlan.read(plan_path)
+    logger.info('Applying %d actions from the plan file %s (planned %s)', len(sync_plan), plan_path,
+                sync_plan.created)
+    umapi_connectors = create_umapi_connectors(config_loader)
+    journal = open_journal(config_loader, umapi_connectors, resume=False)
+    try:
+        send_actions(umapi_connectors, sync_plan.actions_by_umapi)
+    finally:
+        close_journal(umapi_connectors, journal)
+
+
+def resume_work(config_loader):
+    """
+    Send the actions that the run which recorded the action journal didn't get answers for, without
+    reading any users.
+    :type config_loader: user_sync.config.ConfigLoader
+    """
+    journal_path = config_loader.get_invocation_options()['action_journal']
+    unacknowledged = user_sync.journal.ActionJournal.read_unacknowledged(journal_path)
+    logger.info('Resuming %d unanswered actions from the action journal %s', len(unacknowledged), journal_path)
+    umapi_connectors = create_umapi_connectors(config_loader)
+    journal = open_journal(config_loader, umapi_connectors, resume=True)
+    try:
+        send_actions(umapi_connectors, group_actions_by_umapi(unacknowledged))
+    finally:
+        close_journal(umapi_connectors, journal)
+
+
+def continue_journal(config_loader, umapi_connectors):
+    """
+    Open the action journal for a daemon run.  A journal whose actions were all answered for is
+    started over; otherwise the run adds to it, after sending again the actions that weren't.
+    :type config_loader: user_sync.config.ConfigLoader
+    :type umapi_connectors: user_sync.rules.UmapiConnectors
+    :rtype user_sync.journal.ActionJournal
+    """
+    journal_path = config_loader.get_invocation_options()['action_journal']
+    if not journal_path:
+        return None
+    unacknowledged = []
+    if os.path.exists(journal_path):
+        unacknowledged = user_sync.journal.ActionJournal.read_unacknowledged(journal_path)
+    journal = open_journal(config_loader, umapi_connectors, resume=bool(unacknowledged))
+    if unacknowledged:
+        logger.info('Sending again %d unanswered actions from the action journal %s before the run',
+                    len(unacknowledged), journal_path)
+        try:
+            send_actions(umapi_connectors, group_actions_by_umapi(unacknowledged))
+        except:
+            close_journal(umapi_connectors, journal)
+            raise
+    return journal
+
+
+def group_actions_by_umapi(unacknowledged):
+    """
+    :type unacknowledged: list(tuple(str, dict)): the umapi name and the wire form of each action
+    :rtype dict(str, list(dict)): the actions for each umapi, in order
+    """
+    actions_by_name = {}
+    for umapi_name, wire_action in unacknowledged:
+        actions_by_name.setdefault(umapi_name, []).append(wire_action)
+    return actions_by_name
+
+
+def send_actions(umapi_connectors, actions_by_name):
+    """
+    Send actions that were worked out earlier.  The umapis are independent of each other, so each
+    one's actions are sent on a thread of its own, in batches as usual.
+    :type umapi_connectors: user_sync.rules.UmapiConnectors
+    :type actions_by_name: dict(str, list(dict)): the actions for each umapi, in the form they are sent in
+    """
+    connectors_by_name = dict((connector.name, connector) for connector in umapi_connectors.connectors)
+    unknown_names = [name for name in actions_by_name if actions_by_name[name] and name not in connectors_by_name]
+    if unknown_names:
+        raise AssertionException("There are actions for umapi connectors that aren't configured: %s" %
+                                 ', '.join(sorted(unknown_names)))
+    failures = []
+
+    def send(connector, wire_actions):
+        try:
+            connector.replay_actions(wire_actions)
+            action_manager = connector.get_action_manager()
+            while action_manager.has_work():
+                action_manager.flush()
+        except Exception as e:
+            failures.append(e)
+
+    jobs = [(connectors_by_name[name], wire_actions) for name, wire_actions in six.iteritems(actions_by_name)
+            if wire_actions]
+    if len(jobs) == 1:
+        send(*jobs[0])
+    else:
+        threads = [threading.Thread(target=send, args=job, name=job[0].name) for job in jobs]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        for thread in threads:
+            thread.join()
+    for connector, _ in jobs:
+        sent, errors = connector.get_action_manager().get_statistics()
+        logger.info('Actions sent to %s (total, success, failure): (%d, %d, %d)',
+                    connector.name, sent, sent - errors, errors)
+    if failures:
+        raise failures[0]
+
+
+def open_journal(config_loader, umapi_connectors, resume):
+    """
+    Start recording the actions sent by the umapi connectors, if an action journal was asked for
+    :type config_loader: user_sync.config.ConfigLoader
+    :type umapi_connectors: user_sync.rules.UmapiConnectors
+    :type resume: bool
+    :rtype user_sync.journal.ActionJournal
+    """
+    journal_path = config_loader.get_invocation_options()['action_journal']
+    if not journal_path:
+        return None
+    journal = user_sync.journal.ActionJournal(journal_path, resume)
+    for connector in umapi_connectors.connectors:
+        connector.get_action_manager().set_journal(journal, connector.name)
+    return journal
+
+
+def close_journal(umapi_connectors, journal):
+    """
+    :type umapi_connectors: user_sync.rules.UmapiConnectors
+    :type journal: user_sync.journal.ActionJournal
+    """
+    if journal is None:
+        return
+    for connector in umapi_connectors.connectors:
+        connector.get_action_manager().set_journal(None, None)
+    journal.close()
 
 
 if __name__ == '__main__':
@@ -23,6 +23,7 @@ import logging
 import os
 import re
 import subprocess
+import sys
 
 import six
 import yaml
@@ -45,6 +46,7 @@ class ConfigLoader(object):
     # default values for options that can be specified on the command line
     # these are in alphabetical order!  Always add new ones that way!
     invocation_defaults = {
+        'action_journal': None,
         'adobe_only_user_action': ['preserve'],
         'adobe_only_user_list': None,
         'adobe_users': ['all'],
@@ -53,6 +55,7 @@ class ConfigLoader(object):
         'encoding_name': 'utf8',
         'exclude_unmapped_users': False,
         'process_groups': False,
+        'resume': False,
         'strategy': 'sync',
         'test_mode': False,
         'update_user_info': False,
@@ -68,6 +71,9 @@ class ConfigLoader(object):
         """
         self.logger = logging.getLogger('config')
         self.args = args
+        ConfigFileLoader.loaded_file_paths = set()
+        # a daemon reloads its configuration after a failed run, and secrets may have changed with it
+        DictConfig.clear_keyring_values()
         self.main_config = self.load_main_config()
         self.invocation_options = self.load_invocation_options()
         self.directory_groups = self.load_directory_groups()
@@ -201,6 +207,10 @@ class ConfigLoader(object):
                 if len(users_spec) != 2:
                     raise AssertionException('You must specify the groups to read when using the users "group" option')
                 options['directory_group_filter'] = users_spec[1].split(',')
+            elif users_action == 'keys':
+                if len(users_spec) != 2:
+                    raise AssertionException('You must specify the users to read when using the users "keys" option')
+                options['selected_usernames'] = self.load_selected_usernames(users_spec[1])
             else:
                 raise AssertionException('Unknown option "%s" for users' % users_action)
 
@@ -247,6 +257,10 @@ class ConfigLoader(object):
                     options['adobe_group_filter'].append(user_sync.rules.AdobeGroup.create(group))
             else:
                 raise AssertionException('Unknown option "%s" for adobe-users' % adobe_users_action)
+
+        # --resume
+        if options['resume'] and not options['action_journal']:
+            raise AssertionException('You must specify the action journal to resume from with --action-journal')
         return options
 
     def get_logging_config(self):
@@ -380,8 +394,12 @@ class ConfigLoader(object):
                 options = DictConfig('extension', self.get_dict_from_sources(sources))
                 if options:
                     after_mapping_hook_text = options.get_string('after_mapping_hook', True)
-                    if after_mapping_hook_text is None:
+                    after_mapping_hook_module = options.get_string('after_mapping_hook_module', True)
+                    if after_mapping_hook_text is None and after_mapping_hook_module is None:
                         raise AssertionError("No after_mapping_hook found in extension configuration")
+                    if after_mapping_hook_text is not None and after_mapping_hook_module is not None:
+                        raise AssertionException("Extension configuration can't have both after_mapping_hook and "
+                                                 "after_mapping_hook_module")
         return options
 
     @staticmethod
@@ -443,7 +461,7 @@ class ConfigLoader(object):
         """
         Return a dict representing options for RuleProcessor.
         """
-        options = user_sync.rules.RuleProcessor.default_options
+        options = dict(user_sync.rules.RuleProcessor.default_options)
         options.update(self.invocation_options)
 
         # process directory configuration options
@@ -473,6 +491,11 @@ class ConfigLoader(object):
         sync_options = directory_config.get_dict_config('group_sync_options', True)
         if sync_options:
             options['auto_create'] = sync_options.get_bool('auto_create', True)
+            group_diff_engine = sync_options.get_string('diff_engine', True)
+            if group_diff_engine:
+                if group_diff_engine not in ('sets', 'bitset'):
+                    raise AssertionException("group_sync_options: diff_engine must be 'sets' or 'bitset'")
+                options['group_diff_engine'] = group_diff_engine
 
         # process exclusion configuration options
         adobe_config = self.main_config.get_dict_config('adobe_users', True)
@@ -489,12 +512,12 @@ class ConfigLoader(object):
             options['exclude_identity_types'] = exclude_identity_types
         exclude_users_regexps = adobe_config.get_list('exclude_users', True)
         if exclude_users_regexps:
-            exclude_users = []
+            # the matcher anchors the patterns to ensure a complete match
+            # and compiles them, because we will use them over and over
+            exclude_users = user_sync.helper.ExclusionMatcher()
             for regexp in exclude_users_regexps:
                 try:
-                    # add "match begin" and "match end" markers to ensure complete match
-                    # and compile the patterns because we will use them over and over
-                    exclude_users.append(re.compile(r'\A' + regexp + r'\Z', re.UNICODE | re.IGNORECASE))
+                    exclude_users.add(regexp)
                 except re.error as e:
                     validation_message = ('Illegal regular expression (%s) in %s: %s' %
                                           (regexp, 'exclude_identity_types', e))
@@ -531,11 +554,40 @@ class ConfigLoader(object):
             except ValueError:
                 raise AssertionException("Unable to parse max_adobe_only_users value. Value must be a percentage or an integer.")
 
+        # get the performance tuning options, if any
+        performance_config = self.main_config.get_dict_config('performance', True)
+        if performance_config:
+            normalization_cache_size = performance_config.get_int('normalization_cache_size', True)
+            if normalization_cache_size is not None:
+                if normalization_cache_size < 1:
+                    raise AssertionException("performance: normalization_cache_size must be a positive integer")
+                options['normalization_cache_size'] = normalization_cache_size
+            diff_processes = performance_config.get_int('diff_processes', True)
+            if diff_processes is not None:
+                if diff_processes < 1:
+                    raise AssertionException("performance: diff_processes must be a positive integer")
+                options['diff_processes'] = diff_processes
+            diff_batch_size = performance_config.get_int('diff_batch_size', True)
+            if diff_batch_size is not None:
+                if diff_batch_size < 1:
+                    raise AssertionException("performance: diff_batch_size must be a positive integer")
+                options['diff_batch_size'] = diff_batch_size
+
         # now get the directory extension, if any
         extension_config = self.get_directory_extension_options()
         if extension_config:
-            after_mapping_hook_text = extension_config.get_string('after_mapping_hook')
-            options['after_mapping_hook'] = compile(after_mapping_hook_text, '<per-user after-mapping-hook>', 'exec')
+            after_mapping_hook_text = extension_config.get_string('after_mapping_hook', True)
+            if after_mapping_hook_text is not None:
+                options['after_mapping_hook'] = compile(after_mapping_hook_text, '<per-user after-mapping-hook>',
+                                                        'exec')
+            else:
+                options['after_mapping_hook_module'] = extension_config.get_string('after_mapping_hook_module')
+                for key in ('after_mapping_hook_batch_size', 'after_mapping_hook_processes'):
+                    value = extension_config.get_int(key, True)
+                    if value is not None:
+                        if value < 1:
+                            raise AssertionException("extension: %s must be a positive integer" % key)
+                        options[key] = value
             options['extended_attributes'] = extension_config.get_list('extended_attributes', True) or []
             # declaration of extended adobe groups: this is needed for two reasons:
             # 1. it allows validation of group names, and matching them to adobe groups
@@ -557,6 +609,42 @@ class ConfigLoader(object):
 
         return options
 
+    def load_selected_usernames(self, spec):
+        """
+        Parse the usernames (or emails) given with --users keys: either a comma-separated list,
+        or '-' to read them from standard input, one per line.
+        :type spec: str
+        :rtype list(str)
+        """
+        if spec == '-':
+            self.logger.info('Reading the selected users from standard input')
+            names = sys.stdin.read().splitlines()
+        else:
+            names = spec.split(',')
+        selected_usernames = sorted(set(user_sync.helper.normalize_string(name) for name in names if name.strip()))
+        if not selected_usernames:
+            raise AssertionException('No users given for the users "keys" option')
+        return selected_usernames
+
+    def get_token_cache_path(self):
+        """
+        The path of the file where access tokens are kept between runs, if any
+        :rtype str
+        """
+        performance_config = self.main_config.get_dict_config('performance', True)
+        if performance_config:
+            return performance_config.get_string('token_cache_path', True)
+        return None
+
+    @staticmethod
+    def get_config_file_paths():
+        """
+        The paths of the configuration files read so far by this loader, so a long-running
+        process can tell when they change.  Settings that come from a command's output have no path.
+        :rtype list(str)
+        """
+        return sorted(ConfigFileLoader.loaded_file_paths)
+
     def create_umapi_options(self, connector_config_sources):
         options = self.get_dict_from_sources(connector_config_sources)
         options['test_mode'] = self.invocation_options['test_mode']
@@ -773,8 +861,18 @@ class DictConfig(ObjectConfig):
         return messages
 
     keyring_prefix = 'secure_'
+    # values fetched from secure storage, by (service name, user name), shared by all the configs
+    # read since the configuration was last loaded
+    keyring_values = {}
     keyring_suffix = '_key'
 
+    @classmethod
+    def clear_keyring_values(cls):
+        """
+        Forget the values fetched from secure storage, before the configuration is loaded again
+        """
+        cls.keyring_values = {}
+
     def has_credential(self, name):
         """
         Check if there is a credential setting with the given name
@@ -817,11 +915,17 @@ class DictConfig(ObjectConfig):
         if cleartext_value and secure_value_key:
             raise AssertionException('%s: cannot contain setting for both "%s" and "%s"' % (scope, name, keyring_name))
         if secure_value_key:
-            try:
-                import keyring
-                value = keyring.get_password(service_name=secure_value_key, username=user_name)
-            except Exception as e:
-                raise AssertionException('%s: Error accessing secure storage: %s' % (scope, e))
+            # the same credential is often used by several connectors, and secure storage can be slow
+            keyring_key = (secure_value_key, user_name)
+            if keyring_key in self.keyring_values:
+                value = self.keyring_values[keyring_key]
+            else:
+                try:
+                    import keyring
+                    value = keyring.get_password(service_name=secure_value_key, username=user_name)
+                except Exception as e:
+                    raise AssertionException('%s: Error accessing secure storage: %s' % (scope, e))
+                self.keyring_values[keyring_key] = value
         else:
             value = cleartext_value
         if not value and not none_allowed:
@@ -844,11 +948,14 @@ class ConfigFileLoader:
                              '/directory_users/connectors/*': (True, False, None),
                              '/directory_users/extension': (True, False, None),
                              '/logging/file_log_directory': (False, False, "logs"),
+                             '/performance/token_cache_path': (False, False, None),
                              }
 
     # like ROOT_CONFIG_PATH_KEYS, but for non-root configuration files
     SUB_CONFIG_PATH_KEYS = {'/enterprise/priv_key_path': (True, False, None),
-                            '/integration/priv_key_path': (True, False, None)}
+                            '/integration/priv_key_path': (True, False, None),
+                            '/index_path': (False, False, None),
+                            '/after_mapping_hook_module': (True, False, None)}
 
     @classmethod
     def load_root_config(cls, filename):
@@ -885,6 +992,7 @@ class ConfigFileLoader:
     filename = None  # filename of file currently being loaded
     dirpath = None   # directory path of file currently being loaded
     key_path = None  # the full pathname of the setting key being processed
+    loaded_file_paths = set()  # absolute paths of all the files loaded since the ConfigLoader was made
 
     @classmethod
     def load_from_yaml(cls, filename, path_keys):
@@ -927,6 +1035,7 @@ class ConfigFileLoader:
                 raise AssertionException('No such configuration file: %s' % (cls.filepath,))
             cls.filename = os.path.split(cls.filepath)[1]
             cls.dirpath = os.path.dirname(cls.filepath)
+            cls.loaded_file_paths.add(cls.filepath)
             try:
                 with open(filename, 'rb', 1) as input_file:
                     byte_string = input_file.read()
@@ -58,3 +58,53 @@ class DirectoryConnector(object):
                                                                    groups=groups,
                                                                    extended_attributes=extended_attributes,
                                                                    all_users=all_users)
+
+    def prepare_run(self):
+        """
+        Called before each run but the first, when the connector is kept from one run to the next (as the
+        daemon does), so the connector can reopen connections or renew credentials that may have gone stale.
+        """
+        if hasattr(self.implementation, 'connector_prepare_run'):
+            self.implementation.connector_prepare_run(self.state)
+
+    def select_users(self, names):
+        """
+        Ask the connector to load only the users whose email or username is one of the names, or all the
+        users again if names is None.  Connectors that can't do this load users as usual, so the caller must
+        still pick out the users it wants.  A connector kept for several runs keeps the selection until it
+        is changed, so each run must make its own.
+        :type names: list(str)
+        :rtype bool: whether the connector will load only those users
+        """
+        if not hasattr(self.implementation, 'connector_select_users'):
+            return False
+        return self.implementation.connector_select_users(self.state, names)
+
+    def subscribe(self, on_change):
+        """
+        Ask the connector to report changes to users and groups as they happen, if it can and is configured to
+        :type on_change: callable(list(str), list(str)): called with the changed users' emails or usernames,
+            and the changed groups' names, on a thread of the connector's
+        :rtype object: something with a stop method, or None if changes won't be reported
+        """
+        if not hasattr(self.implementation, 'connector_subscribe'):
+            return None
+        return self.implementation.connector_subscribe(self.state, on_change)
+
+    def get_changed_users(self):
+        """
+        The users returned by the last load_users_and_groups that have changed since the last commit,
+        or None if any of them might have changed (as is the case for connectors that don't track changes).
+        :rtype Optional(list(dict))
+        """
+        if not hasattr(self.implementation, 'connector_changed_users'):
+            return None
+        return self.implementation.connector_changed_users(self.state)
+
+    def commit(self):
+        """
+        Called once the users returned by the last load_users_and_groups have been fully synced,
+        so that connectors which track changes can take that load as the base for the next one.
+        """
+        if hasattr(self.implementation, 'connector_commit'):
+            self.implementation.connector_commit(self.state)
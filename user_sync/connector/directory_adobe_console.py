@@ -18,6 +18,8 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
 
+from multiprocessing.pool import ThreadPool
+
 import six
 import umapi_client
 import user_sync.config
@@ -26,7 +28,7 @@ import user_sync.helper
 import user_sync.identity_type
 from user_sync.error import AssertionException
 from user_sync.version import __version__ as app_version
-from user_sync.connector.umapi_util import make_auth_dict
+from user_sync.connector.umapi_util import iter_query_results, make_auth_dict, token_cache
 from user_sync.helper import normalize_string
 from user_sync.identity_type import parse_identity_type
 
@@ -46,6 +48,13 @@ def connector_initialize(options):
     return state
 
 
+def connector_prepare_run(state):
+    """
+    :type state: AdobeConsoleConnector
+    """
+    state.prepare_run()
+
+
 def connector_load_users_and_groups(state, groups=None, extended_attributes=None, all_users=True):
     """
     :type state: OktaDirectoryConnector
@@ -68,6 +77,7 @@ class AdobeConsoleConnector(object):
         # Let just ignore this
         builder.set_string_value('user_identity_type', None)
         builder.set_string_value('identity_type_filter', 'all')
+        builder.set_int_value('group_query_threads', 4)
         options = builder.get_options()
 
         if not options['identity_type_filter'] == 'all':
@@ -100,7 +110,8 @@ class AdobeConsoleConnector(object):
 
         ims_host = server_options['ims_host']
         self.org_id = org_id = integration_options['org_id']
-        auth_dict = make_auth_dict(self.name, enterprise_config, org_id, integration_options['tech_acct'], logger)
+        self.auth_dict = auth_dict = make_auth_dict(self.name, enterprise_config, org_id,
+                                                    integration_options['tech_acct'], logger)
 
         # this check must come after we fetch all the settings
         caller_config.report_unused_values(logger)
@@ -111,9 +122,7 @@ class AdobeConsoleConnector(object):
         try:
             self.connection = umapi_client.Connection(
                 org_id=org_id,
-                auth_dict=auth_dict,
-                ims_host=ims_host,
-                ims_endpoint_jwt=server_options['ims_endpoint_jwt'],
+                auth=token_cache.get_auth(auth_dict, ims_host, server_options['ims_endpoint_jwt'], logger),
                 user_management_endpoint=um_endpoint,
                 test_mode=False,
                 user_agent="user-sync/" + app_version,
@@ -124,9 +133,16 @@ class AdobeConsoleConnector(object):
         except Exception as e:
             raise AssertionException("Connection to org %s at endpoint %s failed: %s" % (org_id, um_endpoint, e))
         logger.debug('%s: connection established', self.name)
-        self.umapi_users = []
         self.user_by_usr_key = {}
 
+    def prepare_run(self):
+        """
+        Get a new access token for the next run if the current one is close to expiry
+        """
+        server_options = self.options['server']
+        self.connection.auth = token_cache.get_auth(self.auth_dict, server_options['ims_host'],
+                                                    server_options['ims_endpoint_jwt'], self.logger)
+
     def load_users_and_groups(self, groups, extended_attributes, all_users):
         """
         :type groups: list(str)
@@ -140,34 +156,26 @@ class AdobeConsoleConnector(object):
 
         # Loading all the groups because UMAPI doesn't support group query. DOH!
         self.logger.info('Loading groups...')
-        umapi_groups = list(self.iter_umapi_groups())
-        self.logger.info('Loading users...')
-
-        # Loading all umapi users based on ID Type first before doing group filtering
-        filter_by_identity_type = self.filter_by_identity_type
-        self.load_umapi_users(identity_type=filter_by_identity_type)
-
-        grouped_user_records = {}
+        umapi_groups = set(self.iter_umapi_groups())
+        found_groups = []
         for group in groups:
-            group_users_count = 0
             if group in umapi_groups:
-                grouped_users = self.iter_group_members(group)
-                for user_key in grouped_users:
-                    if user_key in self.user_by_usr_key:
-                        user = self.user_by_usr_key[user_key]
-                        user['groups'].append(group)
-                        self.user_by_usr_key[user_key] = grouped_user_records[user_key] = user
-                        group_users_count = group_users_count + 1
-                self.logger.debug('Count of users in group "%s": %d', group, group_users_count)
+                found_groups.append(group)
             else:
                 self.logger.warning("No group found for: %s", group)
+
+        self.logger.info('Loading users...')
         if all_users:
-            self.logger.debug('Count of users in any groups: %d', len(grouped_user_records))
+            # stream every user in the org, noting membership in the requested groups as we go
+            self.load_umapi_users(self.filter_by_identity_type, found_groups)
+            grouped_users_count = sum(1 for user in six.itervalues(self.user_by_usr_key) if user['groups'])
+            self.logger.debug('Count of users in any groups: %d', grouped_users_count)
             self.logger.debug('Count of users not in any groups: %d',
-                              len(self.user_by_usr_key) - len(grouped_user_records))
-            return six.itervalues(self.user_by_usr_key)
+                              len(self.user_by_usr_key) - grouped_users_count)
         else:
-            return six.itervalues(grouped_user_records)
+            # only members of the requested groups are needed, so ask the server for just those
+            self.load_group_members(self.filter_by_identity_type, found_groups)
+        return six.itervalues(self.user_by_usr_key)
 
     def convert_user(self, record):
 
@@ -211,28 +219,85 @@ class AdobeConsoleConnector(object):
         except umapi_client.UnavailableError as e:
             raise AssertionException("Error to query groups from Adobe Console: %s" % e)
 
-    def iter_group_members(self, group):
-        umapi_users = self.umapi_users
-        members = filter(lambda u: ('groups' in u and group in u['groups']), umapi_users)
-        for member in members:
-            user_key = self.generate_user_key(member['type'], member['username'], member['domain'])
-            yield (user_key)
-
-    def load_umapi_users(self, identity_type):
+    def iter_umapi_users(self, in_group=None):
+        """
+        Stream user records from the console one page at a time.  Unlike UsersQuery.all_results(),
+        pages are not retained once their records have been consumed.
+        :type in_group: str
+        :rtype iterable(dict)
+        """
         try:
-            u_query = umapi_client.UsersQuery(self.connection)
-            umapi_users = u_query.all_results()
-
-            if not identity_type == 'all':
-                umapi_users = list(filter(lambda usr: usr['type'] == identity_type, umapi_users))
-
-            self.umapi_users = umapi_users
-            for user in umapi_users:
-                # Generate unique user key because Username/Email is a bad unique identifier
-                user_key = self.generate_user_key(user['type'], user['username'], user['domain'])
-                self.user_by_usr_key[user_key] = self.convert_user(user)
+            if in_group:
+                u_query = umapi_client.UsersQuery(self.connection, in_group=in_group)
+            else:
+                u_query = umapi_client.UsersQuery(self.connection)
+            for record in iter_query_results(u_query):
+                yield record
         except umapi_client.UnavailableError as e:
             raise AssertionException("Error contacting UMAPI server: %s" % e)
 
+    def iter_converted_users(self, identity_type, in_group=None):
+        """
+        Convert streamed user records, skipping those that don't match the identity type filter
+        :type identity_type: str
+        :type in_group: str
+        :rtype iterable(tuple(str, dict, dict))
+        """
+        for record in self.iter_umapi_users(in_group):
+            if not identity_type == 'all' and record.get('type') != identity_type:
+                continue
+            user = self.convert_user(record)
+            if user is None:
+                continue
+            # Generate unique user key because Username/Email is a bad unique identifier
+            user_key = self.generate_user_key(record['type'], record['username'], record['domain'])
+            yield user_key, user, record
+
+    def load_umapi_users(self, identity_type, groups=None):
+        """
+        Load every user of the given identity type, keeping only the converted form of each user.
+        Membership in the given groups is recorded on the converted user as the records go by.
+        :type identity_type: str
+        :type groups: list(str)
+        """
+        group_order = dict((group, index) for index, group in enumerate(groups or []))
+        group_users_count = dict((group, 0) for group in group_order)
+        self.user_by_usr_key = user_by_usr_key = {}
+        for user_key, user, record in self.iter_converted_users(identity_type):
+            member_groups = [group for group in record.get('groups') or [] if group in group_order]
+            if member_groups:
+                # keep the requested group order, as though we had gone through the groups one by one
+                member_groups.sort(key=group_order.get)
+                user['groups'].extend(member_groups)
+                for group in member_groups:
+                    group_users_count[group] += 1
+            user_by_usr_key[user_key] = user
+        for group in groups or []:
+            self.logger.debug('Count of users in group "%s": %d', group, group_users_count[group])
+
+    def load_group_members(self, identity_type, groups):
+        """
+        Load only the members of the given groups, querying the groups in parallel
+        :type identity_type: str
+        :type groups: list(str)
+        """
+        def load_group(group):
+            return [(user_key, user) for user_key, user, _ in self.iter_converted_users(identity_type, group)]
+
+        self.user_by_usr_key = user_by_usr_key = {}
+        if not groups:
+            return
+        pool = ThreadPool(max(1, min(self.options['group_query_threads'], len(groups))))
+        try:
+            # imap hands back the results in group order, so the merge is the same however the queries finish
+            for group, members in zip(groups, pool.imap(load_group, groups)):
+                for user_key, user in members:
+                    user = user_by_usr_key.setdefault(user_key, user)
+                    user['groups'].append(group)
+                self.logger.debug('Count of users in group "%s": %d', group, len(members))
+        finally:
+            pool.close()
+            pool.join()
+
     def generate_user_key(self, identity_type, username, domain):
         return '%s,%s,%s' % (normalize_string(identity_type), normalize_string(username), normalize_string(domain))
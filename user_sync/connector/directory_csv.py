@@ -18,6 +18,12 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
 
+import hashlib
+import json
+import logging
+import multiprocessing
+import os
+
 import six
 
 import user_sync.config
@@ -26,6 +32,21 @@ import user_sync.error
 import user_sync.identity_type
 from user_sync.helper import CSVAdapter
 
+# options naming the standard columns, in the order read_user_rows expects their values
+STANDARD_COLUMN_OPTIONS = (
+    'email_column_name',
+    'first_name_column_name',
+    'last_name_column_name',
+    'country_column_name',
+    'groups_column_name',
+    'identity_type_column_name',
+    'username_column_name',
+    'domain_column_name',
+)
+
+INVALID_EMAIL_MESSAGE = 'Missing or invalid email at row: %d; skipping'
+
+
 def connector_metadata():
     metadata = {
         'name': CSVDirectoryConnector.name
@@ -53,9 +74,29 @@ def connector_load_users_and_groups(state, groups=None, extended_attributes=None
     return state.load_users_and_groups(groups or [], extended_attributes or [])
 
 
+def connector_changed_users(state):
+    """
+    :type state: CSVDirectoryConnector
+    :rtype Optional(list(dict))
+    """
+    return state.changed_users
+
+
+def connector_commit(state):
+    """
+    :type state: CSVDirectoryConnector
+    """
+    state.write_index()
+
+
 class CSVDirectoryConnector(object):
     name = 'csv'
 
+    # largest byte range handed to a single worker when reading in parallel
+    max_chunk_size = 64 * 1024 * 1024
+    # format of the index files written by write_index
+    index_version = 1
+
     def __init__(self, caller_options):
         caller_config = user_sync.config.DictConfig('%s configuration' % self.name, caller_options)
         builder = user_sync.config.OptionsBuilder(caller_config)
@@ -71,6 +112,8 @@ class CSVDirectoryConnector(object):
         builder.set_string_value('identity_type_column_name', 'type')
         builder.set_string_value('user_identity_type', None)
         builder.set_string_value('logger_name', self.name)
+        builder.set_int_value('parallel_workers', 1)
+        builder.set_string_value('index_path', None)
         builder.require_string_value('file_path')
         options = builder.get_options()
         self.options = options
@@ -82,6 +125,9 @@ class CSVDirectoryConnector(object):
         self.encoding = options['string_encoding']
         # identity type for new users if not specified in column
         self.user_identity_type = user_sync.identity_type.parse_identity_type(options['user_identity_type'])
+        # users changed since the index was written (None if unknown), and the index to write on commit
+        self.changed_users = None
+        self.pending_index = None
 
     def load_users_and_groups(self, groups, extended_attributes):
         """
@@ -92,7 +138,10 @@ class CSVDirectoryConnector(object):
         options = self.options
         file_path = options['file_path']
         self.logger.debug('Reading from: %s', file_path)
-        self.users = users = self.read_users(file_path, extended_attributes)
+        if options['index_path']:
+            self.users = users = self.read_users_with_index(file_path, extended_attributes)
+        else:
+            self.users = users = self.read_users(file_path, extended_attributes)
         self.logger.debug('Number of users loaded: %d', len(users))
         return six.itervalues(users)
 
@@ -102,98 +151,193 @@ class CSVDirectoryConnector(object):
         :type extended_attributes: list
         :rtype dict
         """
-        users = {}
-
         options = self.options
         logger = self.logger
 
-        recognized_column_names = []
+        # the standard columns come first, in the order read_user_rows expects them;
+        # extended attributes appear after the standard ones (if no header row)
+        recognized_column_names = [options[key] for key in STANDARD_COLUMN_OPTIONS]
+        recognized_column_names += extended_attributes
 
-        def get_column_name(key):
-            column_name = options[key]
-            recognized_column_names.append(column_name)
-            return column_name
+        if options['parallel_workers'] > 1:
+            users = self.read_users_in_parallel(file_path, recognized_column_names)
+            if users is not None:
+                return users
 
-        email_column_name = get_column_name('email_column_name')
-        first_name_column_name = get_column_name('first_name_column_name')
-        last_name_column_name = get_column_name('last_name_column_name')
-        country_column_name = get_column_name('country_column_name')
-        groups_column_name = get_column_name('groups_column_name')
-        identity_type_column_name = get_column_name('identity_type_column_name')
-        username_column_name = get_column_name('username_column_name')
-        domain_column_name = get_column_name('domain_column_name')
+        rows = CSVAdapter.read_csv_columns(file_path,
+                                           column_names=recognized_column_names,
+                                           logger=logger,
+                                           encoding=self.encoding,
+                                           delimiter=options['delimiter'])
+        users, _reset_emails, _line_read = read_user_rows(rows, recognized_column_names,
+                                                          self.user_identity_type, logger)
+        return users
 
-        # extended attributes appear after the standard ones (if no header row)
-        recognized_column_names += extended_attributes
+    def read_users_in_parallel(self, file_path, recognized_column_names):
+        """
+        Parse byte ranges of the file in a pool of worker processes, merging their users in file order.
+        Returns None if the file can't be split, in which case it must be read the usual way.
+        :type file_path: str
+        :type recognized_column_names: list(str)
+        :rtype dict
+        """
+        options = self.options
+        logger = self.logger
+        workers = options['parallel_workers']
+        delimiter = options['delimiter'] or CSVAdapter.guess_delimiter_from_filename(file_path)
+        try:
+            file_size = os.path.getsize(file_path)
+        except OSError as e:
+            raise user_sync.error.AssertionException("Can't open file '%s': %s" % (file_path, e))
+        chunk_count = max(workers * 4, file_size // self.max_chunk_size)
+        split = CSVAdapter.split_csv_file(file_path, chunk_count, self.encoding, delimiter)
+        if split is None or len(split[1]) < 2:
+            logger.debug('Reading file in a single process: it cannot be split')
+            return None
+        header, ranges = split
+        CSVAdapter.check_csv_header(file_path, header, recognized_column_names, logger)
+        logger.debug('Reading file as %d chunks with %d workers', len(ranges), workers)
 
+        debug = logger.isEnabledFor(logging.DEBUG)
+        tasks = [(file_path, start, end, header, recognized_column_names, self.encoding, delimiter,
+                  self.user_identity_type, debug) for start, end in ranges]
+        users = {}
         line_read = 0
-        rows = CSVAdapter.read_csv_rows(file_path,
-                                        recognized_column_names=recognized_column_names,
-                                        logger=logger,
-                                        encoding=self.encoding,
-                                        delimiter=options['delimiter'])
-        for row in rows:
-            line_read += 1
-            email = self.get_column_value(row, email_column_name)
-            if email is None or email.find('@') < 0:
-                logger.warning('Missing or invalid email at row: %d; skipping', line_read)
-                continue
+        pool = multiprocessing.Pool(workers)
+        try:
+            # imap hands back the chunks in file order, which the merge relies on
+            for chunk_users, reset_emails, chunk_line_read, log_records in pool.imap(read_user_chunk, tasks):
+                for level, message, args in log_records:
+                    if message == INVALID_EMAIL_MESSAGE:
+                        # rows are counted from the start of the chunk, so move them to the start of the file
+                        args = (args[0] + line_read,)
+                    logger.log(level, message, *args)
+                merge_user_chunk(users, chunk_users, reset_emails)
+                line_read += chunk_line_read
+        finally:
+            pool.terminate()
+            pool.join()
+        return users
+
+    def read_users_with_index(self, file_path, extended_attributes):
+        """
+        Compare the file with the one described by the index from the last committed run.  If the file
+        is unchanged, its users are taken from the index without reading the file; otherwise the file
+        is read, and the users whose rows changed are noted for connector_changed_users.
+        :type file_path: str
+        :type extended_attributes: list
+        :rtype dict
+        """
+        logger = self.logger
+        index_path = self.options['index_path']
+        self.changed_users = None
+        self.pending_index = None
+        file_hash = self.hash_file(file_path)
+        fingerprint = self.get_index_fingerprint(file_path, extended_attributes)
+        index = self.read_index(index_path)
+        if index is not None and index.get('fingerprint') != fingerprint:
+            logger.info('Ignoring index because the file or its settings have changed: %s', index_path)
+            index = None
 
-            user = users.get(email)
-            if user is None:
-                user = user_sync.connector.helper.create_blank_user()
-                user['email'] = email
-                users[email] = user
-
-            first_name = self.get_column_value(row, first_name_column_name)
-            if first_name is not None:
-                user['firstname'] = first_name
-            else:
-                logger.debug('No value firstname for: %s', email)
-
-            last_name = self.get_column_value(row, last_name_column_name)
-            if last_name is not None:
-                user['lastname'] = last_name
-            else:
-                logger.debug('No value lastname for: %s', email)
-
-            country = self.get_column_value(row, country_column_name)
-            if country is not None:
-                user['country'] = country.upper()
-
-            groups = self.get_column_value(row, groups_column_name)
-            if groups is not None:
-                user['groups'].extend(groups.split(','))
-
-            username = self.get_column_value(row, username_column_name)
-            if username is None:
-                username = email
-            user['username'] = username
-
-            identity_type = self.get_column_value(row, identity_type_column_name)
-            if identity_type:
-                try:
-                    user['identity_type'] = user_sync.identity_type.parse_identity_type(identity_type)
-                except user_sync.error.AssertionException as e:
-                    self.logger.warning('Skipping user %s: %s', username, e)
-                    del users[email]
-                    continue
-            else:
-                user['identity_type'] = self.user_identity_type
-
-            domain = self.get_column_value(row, domain_column_name)
-            if domain:
-                user['domain'] = domain
-            elif username != email:
-                user['domain'] = email[email.find('@') + 1:]
-
-            sa = {}
-            for col in recognized_column_names:
-                sa[col] = self.get_column_value(row, col)
-            user['source_attributes'] = sa
+        if index is not None and index.get('file_hash') == file_hash:
+            logger.info('File unchanged since last sync; using users saved in index: %s', index_path)
+            users = {}
+            for user in index['users']:
+                users[user['email']] = user_sync.connector.helper.DirectoryUserRecord(user)
+            self.changed_users = []
+            return users
 
+        users = self.read_users(file_path, extended_attributes)
+        digests = dict((email, self.get_user_digest(user)) for email, user in six.iteritems(users))
+        if index is not None:
+            previous_digests = index['digests']
+            self.changed_users = [users[email] for email, digest in six.iteritems(digests)
+                                  if previous_digests.get(email) != digest]
+            logger.info('Users changed since last sync: %d of %d', len(self.changed_users), len(users))
+        # serialize the index now, before the users are passed on and possibly modified
+        self.pending_index = json.dumps({
+            'version': self.index_version,
+            'fingerprint': fingerprint,
+            'file_hash': file_hash,
+            'digests': digests,
+            'users': [dict(user) for user in six.itervalues(users)],
+        })
         return users
 
+    def get_index_fingerprint(self, file_path, extended_attributes):
+        """
+        Changing any of the settings that shape the users read from the file invalidates the index.
+        :type file_path: str
+        :type extended_attributes: list
+        :rtype str
+        """
+        settings = dict((key, value) for key, value in six.iteritems(self.options)
+                        if key not in ('index_path', 'logger_name', 'parallel_workers'))
+        settings['file_path'] = os.path.abspath(file_path)
+        settings['extended_attributes'] = list(extended_attributes)
+        settings['version'] = self.index_version
+        return hashlib.sha1(json.dumps(settings, sort_keys=True).encode('utf8')).hexdigest()
+
+    @staticmethod
+    def get_user_digest(user):
+        """
+        :type user: dict
+        :rtype str
+        """
+        return hashlib.sha1(json.dumps(dict(user), sort_keys=True).encode('utf8')).hexdigest()
+
+    @staticmethod
+    def hash_file(file_path):
+        """
+        :type file_path: str
+        :rtype str
+        """
+        file_hash = hashlib.sha256()
+        try:
+            with open(file_path, 'rb') as input_file:
+                for block in iter(lambda: input_file.read(CSVAdapter.read_buffer_size), b''):
+                    file_hash.update(block)
+        except IOError as e:
+            raise user_sync.error.AssertionException("Can't open file '%s': %s" % (file_path, e))
+        return file_hash.hexdigest()
+
+    def read_index(self, index_path):
+        """
+        :type index_path: str
+        :rtype Optional(dict): None if there is no usable index
+        """
+        if not os.path.exists(index_path):
+            return None
+        try:
+            with open(index_path, 'rb') as index_file:
+                index = json.loads(index_file.read().decode('utf8'))
+        except (IOError, ValueError) as e:
+            self.logger.warning("Ignoring unreadable index '%s': %s", index_path, e)
+            return None
+        if not isinstance(index, dict) or index.get('version') != self.index_version:
+            self.logger.warning("Ignoring index '%s': it was written by a different version", index_path)
+            return None
+        return index
+
+    def write_index(self):
+        """
+        Save the index of the last load, so the next load can tell which users have changed since.
+        """
+        if self.pending_index is None:
+            return
+        index_path = self.options['index_path']
+        temp_path = index_path + '.tmp'
+        try:
+            with open(temp_path, 'wb') as index_file:
+                index_file.write(self.pending_index.encode('utf8'))
+            if os.path.exists(index_path):
+                os.remove(index_path)
+            os.rename(temp_path, index_path)
+        except (IOError, OSError) as e:
+            raise user_sync.error.AssertionException("Can't write index '%s': %s" % (index_path, e))
+        self.logger.debug('Index written: %s', index_path)
+        self.pending_index = None
+
     def get_column_value(self, row, column_name):
         """
         :type row: dict
@@ -201,3 +345,125 @@ class CSVDirectoryConnector(object):
         """
         value = row.get(column_name)
         return value if value else None
+
+
+def read_user_rows(rows, recognized_column_names, user_identity_type, logger):
+    """
+    Build users from rows of column values.  Returns the users by email, the emails whose users
+    were dropped (for an invalid identity type) at some point along the way, and the row count.
+    :type rows: iterable(tuple)
+    :type recognized_column_names: list(str)
+    :type user_identity_type: str
+    :type logger: logging.Logger
+    :rtype (dict, set(str), int)
+    """
+    users = {}
+    reset_emails = set()
+    line_read = 0
+    for values in rows:
+        line_read += 1
+        email, first_name, last_name, country, groups, identity_type, username, domain = values[:8]
+        if email is None or email.find('@') < 0:
+            logger.warning(INVALID_EMAIL_MESSAGE, line_read)
+            continue
+
+        user = users.get(email)
+        if user is None:
+            user = user_sync.connector.helper.create_blank_user()
+            user['email'] = email
+            users[email] = user
+
+        if first_name is not None:
+            user['firstname'] = first_name
+        else:
+            logger.debug('No value firstname for: %s', email)
+
+        if last_name is not None:
+            user['lastname'] = last_name
+        else:
+            logger.debug('No value lastname for: %s', email)
+
+        if country is not None:
+            user['country'] = country.upper()
+
+        if groups is not None:
+            user['groups'].extend(groups.split(','))
+
+        if username is None:
+            username = email
+        user['username'] = username
+
+        if identity_type:
+            try:
+                user['identity_type'] = user_sync.identity_type.parse_identity_type(identity_type)
+            except user_sync.error.AssertionException as e:
+                logger.warning('Skipping user %s: %s', username, e)
+                del users[email]
+                reset_emails.add(email)
+                continue
+        else:
+            user['identity_type'] = user_identity_type
+
+        if domain:
+            user['domain'] = domain
+        elif username != email:
+            user['domain'] = email[email.find('@') + 1:]
+
+        user['source_attributes'] = dict(zip(recognized_column_names, values))
+
+    return users, reset_emails, line_read
+
+
+def merge_user_chunk(users, chunk_users, reset_emails):
+    """
+    Fold the users read from one chunk of a file into the users read from the chunks before it,
+    with the same result as reading the rows of both in a single pass.
+    :type users: dict
+    :type chunk_users: dict
+    :type reset_emails: set(str)
+    """
+    # a user dropped in the chunk starts over from its rows after the drop, if there are any
+    for email in reset_emails:
+        users.pop(email, None)
+    for email, chunk_user in six.iteritems(chunk_users):
+        user = users.get(email)
+        if user is None:
+            users[email] = chunk_user
+            continue
+        for key in ('firstname', 'lastname', 'country', 'domain'):
+            if chunk_user[key] is not None:
+                user[key] = chunk_user[key]
+        user['groups'].extend(chunk_user['groups'])
+        # every row sets these
+        for key in ('username', 'identity_type', 'source_attributes'):
+            user[key] = chunk_user[key]
+
+
+def read_user_chunk(task):
+    """
+    Read the users in one byte range of a file; this runs in a worker process.  Log messages are
+    handed back to the parent process along with the users, so they come out in file order.
+    :type task: tuple
+    :rtype (dict, set(str), int, list(tuple))
+    """
+    file_path, start, end, header, recognized_column_names, encoding, delimiter, user_identity_type, debug = task
+    log = DeferredLog(debug)
+    rows = CSVAdapter.read_csv_chunk(file_path, start, end, header, recognized_column_names, encoding, delimiter)
+    users, reset_emails, line_read = read_user_rows(rows, recognized_column_names, user_identity_type, log)
+    return users, reset_emails, line_read, log.records
+
+
+class DeferredLog(object):
+    """
+    Collects the messages of the logger methods used by read_user_rows, to be logged later
+    """
+    def __init__(self, debug):
+        self.debug_enabled = debug
+        self.records = []
+
+    def debug(self, message, *args):
+        if self.debug_enabled:
+            self.records.append((logging.DEBUG, message, args))
+
+    def warning(self, message, *args):
+        self.records.append((logging.WARNING, message, args))
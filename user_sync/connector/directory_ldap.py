@@ -20,6 +20,8 @@
 
 import six
 import string
+import threading
+import time
 
 import ldap3
 
@@ -56,6 +58,31 @@ def connector_load_users_and_groups(state, groups=None, extended_attributes=None
     return state.load_users_and_groups(groups or [], extended_attributes or [], all_users)
 
 
+def connector_prepare_run(state):
+    """
+    :type state: LDAPDirectoryConnector
+    """
+    state.prepare_run()
+
+
+def connector_select_users(state, names):
+    """
+    :type state: LDAPDirectoryConnector
+    :type names: list(str)
+    :rtype bool
+    """
+    return state.select_users(names)
+
+
+def connector_subscribe(state, on_change):
+    """
+    :type state: LDAPDirectoryConnector
+    :type on_change: callable(list(str), list(str))
+    :rtype LDAPChangeSubscriber
+    """
+    return state.subscribe(on_change)
+
+
 class LDAPDirectoryConnector(object):
     name = 'ldap'
 
@@ -114,9 +141,19 @@ class LDAPDirectoryConnector(object):
             connection = ldap3.Connection(server, auto_bind=True, read_only=True, **auth)
         except Exception as e:
             raise AssertionException('LDAP connection failure: %s' % e)
+        # kept so a change subscriber, or a later run, can open connections of its own
+        self.server = server
+        self.auth = auth
         self.connection = connection
         logger.debug('Connected')
         self.user_by_dn = {}
+        # the emails of the members each group had when it was last loaded, by group DN and then member DN,
+        # so that a change subscriber can tell which members a change to a group removed
+        self.member_emails_by_group_dn = {}
+        # group DNs are looked up once, which matters when a daemon keeps the connector for many runs
+        self.group_dn_by_name = {}
+        # a filter for just the selected users, if only some users are wanted
+        self.selected_users_filter = None
         self.additional_group_filters = None
 
     @staticmethod
@@ -129,6 +166,7 @@ class LDAPDirectoryConnector(object):
         builder.set_string_value('group_member_filter_format', None)
         builder.set_bool_value('require_tls_cert', False)
         builder.set_dict_value('two_steps_lookup', None)
+        builder.set_dict_value('change_subscription', None)
         builder.set_string_value('string_encoding', 'utf8')
         builder.set_string_value('user_identity_type_format', None)
         builder.set_string_value('user_email_format', six.text_type('{mail}'))
@@ -146,6 +184,17 @@ class LDAPDirectoryConnector(object):
         builder.require_string_value('base_dn')
         options = builder.get_options()
 
+        if options['change_subscription'] is not None:
+            cs_config = caller_config.get_dict_config('change_subscription', True)
+            cs_builder = user_sync.config.OptionsBuilder(cs_config)
+            cs_builder.require_string_value('mode')
+            cs_builder.set_int_value('reconnect_delay', 30)
+            cs_builder.set_string_value('resume_attribute', 'modifyTimestamp')
+            options['change_subscription'] = cs_options = cs_builder.get_options()
+            if cs_options['mode'] not in LDAPChangeSubscriber.modes:
+                raise AssertionException("change_subscription: mode must be one of %s" %
+                                         ', '.join(LDAPChangeSubscriber.modes))
+
         options['two_steps_enabled'] = False
         if options['two_steps_lookup'] is not None:
             ts_config = caller_config.get_dict_config('two_steps_lookup', True)
@@ -172,9 +221,10 @@ class LDAPDirectoryConnector(object):
         options = self.options
         user = {}
         base_dn = six.text_type(options['base_dn'])
-        all_users_filter = six.text_type(options['all_users_filter'])
+        all_users_filter = self.get_all_users_filter()
         group_member_filter_format = six.text_type(options['group_member_filter_format'])
         grouped_user_records = {}
+        self.user_by_dn = {}
         if options['two_steps_enabled']:
             group_member_attribute_name = six.text_type(options['two_steps_lookup']['group_member_attribute_name'])
 
@@ -200,6 +250,7 @@ class LDAPDirectoryConnector(object):
                 user_subfilter = six.text_type('(') + user_subfilter + six.text_type(')')
             group_user_filter = six.text_type('(&') + group_member_subfilter + user_subfilter + six.text_type(')')
             group_users = 0
+            member_emails = {}
             try:
                 if options['two_steps_enabled']:
                     for user_dn in self.iter_group_member_dns(group_dn, group_member_attribute_name):
@@ -217,13 +268,21 @@ class LDAPDirectoryConnector(object):
                                     user['groups'].append(group)
                                     group_users += 1
                                     grouped_user_records[user_dn] = user
+                                    member_emails[user_dn.lower()] = user['email']
                 else:
                     for user_dn, user in self.iter_users(base_dn, group_user_filter, extended_attributes):
                         user['groups'].append(group)
                         group_users += 1
                         grouped_user_records[user_dn] = user
+                        member_emails[user_dn.lower()] = user['email']
             except Exception as e:
                 raise AssertionException('Unexpected LDAP failure reading group members: %s' % e)
+            if self.selected_users_filter is not None:
+                # only some of the members were searched for, so the others are kept
+                kept_emails = dict(self.member_emails_by_group_dn.get(group_dn.lower(), {}))
+                kept_emails.update(member_emails)
+                member_emails = kept_emails
+            self.member_emails_by_group_dn[group_dn.lower()] = member_emails
             self.logger.debug('Count of users in group "%s": %d', group, group_users)
 
         # if all users are requested, do an additional search for all of them
@@ -245,11 +304,84 @@ class LDAPDirectoryConnector(object):
         self.logger.debug('Total users loaded: %d', len(self.user_by_dn))
         return six.itervalues(self.user_by_dn)
 
+    def get_all_users_filter(self):
+        """
+        The all_users_filter, limited to the selected users if there are any
+        :rtype str
+        """
+        all_users_filter = six.text_type(self.options['all_users_filter'])
+        if self.selected_users_filter is None:
+            return all_users_filter
+        if not all_users_filter.startswith('('):
+            all_users_filter = six.text_type('(') + all_users_filter + six.text_type(')')
+        return six.text_type('(&') + all_users_filter + self.selected_users_filter + six.text_type(')')
+
+    def select_users(self, names):
+        """
+        Limit the user searches to the users whose email or username is one of the names.  This can
+        only be done when the email and username formats are each a single attribute; if not, the
+        searches are left as they are and the caller has to pick out the users it wants.  With names None,
+        the searches are no longer limited.
+        :type names: list(str)
+        :rtype bool: whether the searches are limited
+        """
+        if names is None:
+            self.selected_users_filter = None
+            return False
+        attribute_names = []
+        for formatter in (self.user_email_formatter, self.user_username_formatter):
+            if formatter.string_format is None:
+                continue
+            attribute_name = formatter.get_single_attribute_name()
+            if attribute_name is None:
+                self.selected_users_filter = None
+                return False
+            attribute_names.append(attribute_name)
+        clauses = []
+        for attribute_name in attribute_names:
+            query = six.text_type('(') + attribute_name + six.text_type('={name})')
+            clauses.extend(self.format_ldap_query_string(query, name=six.text_type(name)) for name in names)
+        self.selected_users_filter = six.text_type('(|') + six.text_type('').join(clauses) + six.text_type(')')
+        self.logger.debug('User searches limited by: %s', self.selected_users_filter)
+        return True
+
+    def prepare_run(self):
+        """
+        Open a new connection for the next run.  Directory servers drop connections that have been idle
+        for a while (Active Directory after 15 minutes by default), which a daemon's usually have.  Any
+        selection of users made for the last run is dropped.
+        """
+        self.selected_users_filter = None
+        try:
+            self.connection.unbind()
+        except Exception:
+            pass
+        try:
+            self.connection = ldap3.Connection(self.server, auto_bind=True, read_only=True, **self.auth)
+        except Exception as e:
+            raise AssertionException('LDAP connection failure: %s' % e)
+        self.logger.debug('Reconnected')
+
+    def subscribe(self, on_change):
+        """
+        Start following changes to the directory, if a change_subscription is configured
+        :type on_change: callable(list(str), list(str)): called with the changed users and groups
+        :rtype LDAPChangeSubscriber: the running subscriber, or None
+        """
+        if self.options['change_subscription'] is None:
+            return None
+        subscriber = LDAPChangeSubscriber(self, on_change, self.options['change_subscription'])
+        subscriber.start()
+        return subscriber
+
     def find_ldap_group_dn(self, group):
         """
         :type group: str
         :rtype str
         """
+        group_dn = self.group_dn_by_name.get(group)
+        if group_dn is not None:
+            return group_dn
         connection = self.connection
         options = self.options
         base_dn = six.text_type(options['base_dn'])
@@ -267,6 +399,9 @@ class LDAPDirectoryConnector(object):
             else:
                 if result[0] is not None:
                     group_dn = result[0].entry_dn
+        # groups that aren't found aren't remembered, so they are found once they are created
+        if group_dn is not None:
+            self.group_dn_by_name[group] = group_dn
         return group_dn
 
     def iter_group_member_dns(self, group_dn, member_attribute, searched_dns=None):
@@ -498,7 +633,7 @@ class LDAPDirectoryConnector(object):
                                                                group_dn=group_dn)
         if not group_member_subfilter.startswith('('):
             group_member_subfilter = six.text_type('(') + group_member_subfilter + six.text_type(')')
-        user_subfilter = self.options['all_users_filter']
+        user_subfilter = self.get_all_users_filter()
         if not user_subfilter.startswith('('):
             user_subfilter = six.text_type('(') + user_subfilter + six.text_type(')')
         group_user_filter = six.text_type('(&') + group_member_subfilter + user_subfilter + six.text_type(')')
@@ -519,6 +654,207 @@ class LDAPDirectoryConnector(object):
         return False
 
 
+class LDAPChangeSubscriber(object):
+    """
+    Follows changes to the directory with a persistent search, on a connection of its own and on a
+    thread of its own, and reports the users and groups whose entries change.  Two kinds of search
+    are supported: 'persistent_search' (the draft-ietf-ldapext-psearch control, as in 389 Directory
+    Server and eDirectory) and 'ad_notification' (the Active Directory change notification control).
+
+    When the search fails, it is started again after reconnect_delay seconds, and entries changed
+    while it was down are found by searching on the resume_attribute (modifyTimestamp by default).
+    """
+    modes = ('persistent_search', 'ad_notification')
+    group_object_classes = frozenset(['group', 'groupofnames', 'groupofuniquenames', 'posixgroup'])
+    # how long to wait for each change before checking whether the search should stop
+    poll_seconds = 1
+    # extra time searched when catching up, for clock differences between the directory servers
+    resume_margin_seconds = 300
+
+    def __init__(self, connector, on_change, options):
+        """
+        :type connector: LDAPDirectoryConnector
+        :type on_change: callable(list(str), list(str))
+        :type options: dict: the change_subscription options
+        """
+        self.connector = connector
+        self.on_change = on_change
+        self.options = options
+        self.logger = connector.logger.getChild('subscriber')
+        self.stop_event = threading.Event()
+        self.thread = None
+        attribute_names = ['objectClass']
+        attribute_names.extend(connector.user_email_formatter.get_attribute_names())
+        attribute_names.extend(connector.user_username_formatter.get_attribute_names())
+        # the members of a changed group, to find the members that were removed
+        if connector.options['two_steps_enabled']:
+            self.member_attribute_names = [connector.options['two_steps_lookup']['group_member_attribute_name']]
+        else:
+            self.member_attribute_names = ['member', 'uniqueMember']
+        attribute_names.extend(self.member_attribute_names)
+        self.attribute_names = [six.text_type(name) for name in attribute_names]
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, name='ldap-subscriber')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        self.stop_event.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+    def run(self):
+        resume_time = None
+        while not self.stop_event.is_set():
+            search = None
+            try:
+                search = self.open_search()
+                opened_time = time.time()
+                self.logger.info('Following directory changes (%s)', self.options['mode'])
+                if resume_time is not None:
+                    self.catch_up(resume_time)
+                # changes are followed from here on, even if the search fails before the first event
+                resume_time = opened_time
+                while not self.stop_event.is_set():
+                    event = search.next(block=True, timeout=self.poll_seconds)
+                    if search.connection.closed:
+                        raise AssertionException('connection closed')
+                    resume_time = time.time()
+                    if event is None:
+                        continue
+                    if event.get('type') != 'searchResEntry':
+                        raise AssertionException('search ended: %s' % event.get('description', event.get('type')))
+                    self.handle_change(event['dn'], event.get('attributes') or {}, event.get('previousDN'))
+            except Exception as e:
+                self.logger.warning('Directory change search failed: %s', e)
+            finally:
+                if search is not None:
+                    try:
+                        search.stop()
+                    except Exception:
+                        pass
+            self.stop_event.wait(self.options['reconnect_delay'])
+
+    def open_search(self):
+        """
+        :rtype ldap3.extend.standard.PersistentSearch.PersistentSearch
+        """
+        connector = self.connector
+        connection = ldap3.Connection(connector.server, auto_bind=True, read_only=True,
+                                      client_strategy=ldap3.ASYNC_STREAM, **connector.auth)
+        base_dn = six.text_type(connector.options['base_dn'])
+        try:
+            if self.options['mode'] == 'ad_notification':
+                # Active Directory only allows (objectClass=*), so users and groups are told apart later
+                return connection.extend.microsoft.persistent_search(search_base=base_dn, search_scope=ldap3.SUBTREE,
+                                                                     attributes=self.attribute_names, streaming=False)
+            return connection.extend.standard.persistent_search(search_base=base_dn, search_filter=self.get_filter(),
+                                                                search_scope=ldap3.SUBTREE,
+                                                                attributes=self.attribute_names, streaming=False)
+        except Exception:
+            connection.unbind()
+            raise
+
+    def get_filter(self):
+        """
+        The users in the all users filter, and all the groups
+        :rtype str
+        """
+        all_users_filter = six.text_type(self.connector.options['all_users_filter'])
+        if not all_users_filter.startswith('('):
+            all_users_filter = six.text_type('(') + all_users_filter + six.text_type(')')
+        group_filters = [six.text_type('(objectClass=%s)') % object_class
+                         for object_class in sorted(self.group_object_classes)]
+        return six.text_type('(|') + all_users_filter + six.text_type('').join(group_filters) + six.text_type(')')
+
+    def catch_up(self, since):
+        """
+        Report the entries changed since the given time, which the search may have missed
+        :type since: float
+        """
+        connector = self.connector
+        since_value = time.strftime('%Y%m%d%H%M%SZ', time.gmtime(since - self.resume_margin_seconds))
+        resume_filter = connector.format_ldap_query_string(
+            six.text_type('(') + six.text_type(self.options['resume_attribute']) + six.text_type('>={since})'),
+            since=six.text_type(since_value))
+        search_filter = six.text_type('(&') + self.get_filter() + resume_filter + six.text_type(')')
+        connection = ldap3.Connection(connector.server, auto_bind=True, read_only=True, **connector.auth)
+        try:
+            count = 0
+            entries = connection.extend.standard.paged_search(
+                search_base=six.text_type(connector.options['base_dn']), search_filter=search_filter,
+                search_scope=ldap3.SUBTREE, attributes=self.attribute_names,
+                paged_size=connector.options['search_page_size'] or 200, generator=True)
+            for entry in entries:
+                if entry['type'] == 'searchResEntry':
+                    self.handle_change(entry['dn'], entry['attributes'], None)
+                    count += 1
+            self.logger.info('Caught up with %d directory entries changed while disconnected', count)
+        finally:
+            connection.unbind()
+
+    def handle_change(self, dn, attributes, previous_dn):
+        """
+        :type dn: str
+        :type attributes: dict
+        :type previous_dn: str
+        """
+        users, groups = self.get_changed_names(dn, attributes, previous_dn)
+        if users or groups:
+            self.logger.debug('Directory change to %s: users %s, groups %s', dn, users, groups)
+            self.on_change(users, groups)
+
+    def get_changed_names(self, dn, attributes, previous_dn=None):
+        """
+        The users and groups an entry change is about.  A user is named by email and username; when
+        the entry doesn't have them (as for a deleted entry), the user loaded by the last run with that
+        DN is used.  A change to a group is also about the members it no longer has, which are the
+        ones the last run loaded that aren't among the group's members now.
+        :type dn: str
+        :type attributes: dict
+        :type previous_dn: str
+        :rtype (list(str), list(str))
+        """
+        connector = self.connector
+        object_classes = LDAPValueFormatter.get_attribute_value(attributes, 'objectClass') or []
+        if isinstance(object_classes, six.string_types):
+            object_classes = [object_classes]
+        if self.group_object_classes.intersection(c.lower() for c in object_classes):
+            return self.get_removed_members(dn, attributes), [connector.get_cn_from_dn(dn)]
+        names = set()
+        for formatter in (connector.user_email_formatter, connector.user_username_formatter):
+            value, _ = formatter.generate_value(attributes)
+            if value:
+                names.add(value.strip())
+        if not names:
+            for known_dn in (dn, previous_dn):
+                user = connector.user_by_dn.get(known_dn) if known_dn else None
+                if user is not None:
+                    names.add(user['email'])
+        return sorted(names), []
+
+    def get_removed_members(self, dn, attributes):
+        """
+        The emails of the members of a changed group that the last run loaded, and that the group no
+        longer has.  When the change doesn't list any members (the group was emptied or deleted, or the
+        members are in an attribute that isn't followed), all the members the last run loaded are given.
+        :type dn: str
+        :type attributes: dict
+        :rtype list(str)
+        """
+        member_emails = self.connector.member_emails_by_group_dn.get(dn.lower(), {})
+        member_dns = set()
+        for attribute_name in self.member_attribute_names:
+            values = LDAPValueFormatter.get_attribute_value(attributes, attribute_name) or []
+            if isinstance(values, six.string_types):
+                values = [values]
+            member_dns.update(value.lower() for value in values)
+        return sorted(set(email for member_dn, email in six.iteritems(member_emails)
+                          if member_dn not in member_dns))
+
+
 class LDAPValueFormatter(object):
     encoding = 'utf8'
 
@@ -541,6 +877,15 @@ class LDAPValueFormatter(object):
         """
         return self.attribute_names
 
+    def get_single_attribute_name(self):
+        """
+        The attribute name, if the format is nothing but one attribute, such as '{mail}'
+        :rtype str
+        """
+        if len(self.attribute_names) == 1 and self.string_format == '{' + self.attribute_names[0] + '}':
+            return self.attribute_names[0]
+        return None
+
     def generate_value(self, record):
         """
         :type record: dict
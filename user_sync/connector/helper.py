@@ -20,6 +20,13 @@
 
 import logging
 
+import six
+
+try:
+    from collections.abc import MutableMapping
+except ImportError:
+    from collections import MutableMapping
+
 
 def create_logger(options):
     """
@@ -33,17 +40,158 @@ def create_logger(options):
 
 def create_blank_user():
     """
-    :rtype dict
-    """
-    user = {
-        "identity_type": None,
-        "username": None,
-        "domain": None,
-        "firstname": None,
-        "lastname": None,
-        "email": None,
-        "groups": [],
-        "country": None,
-    }
+    :rtype DirectoryUserRecord
+    """
+    user = DirectoryUserRecord()
+    user["identity_type"] = None
+    user["username"] = None
+    user["domain"] = None
+    user["firstname"] = None
+    user["lastname"] = None
+    user["email"] = None
+    user["groups"] = []
+    user["country"] = None
     return user
 
+
+class UserRecord(MutableMapping):
+    """
+    A user that can be used just like a dict, but which keeps the keys that most users have in
+    slots rather than in a per-user hash table.  Any other keys go in a dict made when first needed.
+    """
+    __slots__ = ('_extra',)
+    fields = ()
+    field_set = frozenset()
+
+    def __init__(self, *args, **kwargs):
+        self._extra = None
+        self.update(*args, **kwargs)
+
+    def __getitem__(self, key):
+        if key in self.field_set:
+            try:
+                return getattr(self, key)
+            except AttributeError:
+                raise KeyError(key)
+        if self._extra is None:
+            raise KeyError(key)
+        return self._extra[key]
+
+    def __setitem__(self, key, value):
+        if key in self.field_set:
+            setattr(self, key, value)
+        else:
+            if self._extra is None:
+                self._extra = {}
+            self._extra[key] = value
+
+    def __delitem__(self, key):
+        if key in self.field_set:
+            try:
+                delattr(self, key)
+            except AttributeError:
+                raise KeyError(key)
+        else:
+            if self._extra is None:
+                raise KeyError(key)
+            del self._extra[key]
+
+    def __iter__(self):
+        for key in self.fields:
+            if hasattr(self, key):
+                yield key
+        if self._extra is not None:
+            for key in self._extra:
+                yield key
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+    def __repr__(self):
+        return repr(dict(self))
+
+    def __reduce__(self):
+        return type(self), (dict(self),)
+
+    def copy(self):
+        return type(self)(self)
+
+
+class DirectoryUserRecord(UserRecord):
+    fields = ('identity_type', 'username', 'domain', 'firstname', 'lastname', 'email', 'groups', 'country',
+              'source_attributes', 'member_groups')
+    field_set = frozenset(fields)
+    __slots__ = fields
+
+
+class UmapiUserRecord(UserRecord):
+    fields = ('email', 'username', 'domain', 'firstname', 'lastname', 'country', 'type', 'status', 'groups')
+    field_set = frozenset(fields)
+    __slots__ = fields
+
+
+class UserRecordCompactor(object):
+    """
+    Shrinks users once they are fully loaded: users become records, values that many users share
+    (identity types, domains, countries and group names) are stored once, each distinct list of
+    groups becomes one tuple shared by every user with those groups, and source attributes are
+    dropped unless something will use them.
+    """
+
+    def __init__(self, keep_source_attributes=True):
+        """
+        :type keep_source_attributes: bool
+        """
+        self.keep_source_attributes = keep_source_attributes
+        self.strings = {}
+        self.group_tuples = {}
+
+    def share_string(self, value):
+        if value is None:
+            return None
+        return self.strings.setdefault(value, value)
+
+    def share_groups(self, groups):
+        """
+        :type groups: iterable(str)
+        :rtype tuple(str)
+        """
+        key = tuple(groups)
+        shared = self.group_tuples.get(key)
+        if shared is None:
+            shared = self.group_tuples[key] = tuple(self.share_string(group) for group in key)
+        return shared
+
+    def compact_directory_user(self, user):
+        """
+        :type user: dict
+        :rtype DirectoryUserRecord
+        """
+        record = user if isinstance(user, DirectoryUserRecord) else DirectoryUserRecord(user)
+        self.share_values(record, ('identity_type', 'domain', 'country'), ('groups', 'member_groups'))
+        source_attributes = record.get('source_attributes')
+        if not self.keep_source_attributes:
+            record.pop('source_attributes', None)
+        elif source_attributes is not None:
+            record['source_attributes'] = dict((self.share_string(key), value)
+                                               for key, value in six.iteritems(source_attributes))
+        return record
+
+    def compact_umapi_user(self, user):
+        """
+        :type user: dict
+        :rtype UmapiUserRecord
+        """
+        record = user if isinstance(user, UmapiUserRecord) else UmapiUserRecord(user)
+        self.share_values(record, ('type', 'domain', 'country', 'status'), ('groups',))
+        return record
+
+    def share_values(self, record, string_keys, group_keys):
+        for key in string_keys:
+            value = record.get(key)
+            if value is not None:
+                record[key] = self.share_string(value)
+        for key in group_keys:
+            value = record.get(key)
+            if value is not None:
+                record[key] = self.share_groups(value)
@@ -20,25 +20,25 @@
 
 import json
 import logging
+import os
+import tempfile
+import time
 # import helper
 
-import jwt
 import six
-import umapi_client
 
 import user_sync.connector.helper
 import user_sync.config
 import user_sync.helper
 import user_sync.identity_type
+import user_sync.snapshot
 from user_sync.error import AssertionException
 from user_sync.version import __version__ as app_version
-from user_sync.connector.umapi_util import make_auth_dict
+from user_sync.connector.umapi_util import iter_query_results, make_auth_dict, token_cache
 
-try:
-    from jwt.contrib.algorithms.pycrypto import RSAAlgorithm
-    jwt.register_algorithm('RS256', RSAAlgorithm(RSAAlgorithm.SHA256))
-except:
-    pass
+# umapi_client, jwt and the crypto libraries take a while to import, so umapi_client is only
+# imported the first time it is used, once a connector is actually made
+umapi_client = user_sync.helper.LazyModule('umapi_client')
 
 
 class UmapiConnector(object):
@@ -65,6 +65,7 @@ class UmapiConnector(object):
         server_builder.set_string_value('ims_endpoint_jwt', '/ims/exchange/jwt')
         server_builder.set_int_value('timeout', 120)
         server_builder.set_int_value('retries', 3)
+        server_builder.set_int_value('batch_retries', 50)
         options['server'] = server_options = server_builder.get_options()
 
         enterprise_config = caller_config.get_dict_config('enterprise')
@@ -80,7 +81,8 @@ class UmapiConnector(object):
 
         ims_host = server_options['ims_host']
         self.org_id = org_id = enterprise_options['org_id']
-        auth_dict = make_auth_dict(self.name, enterprise_config, org_id, enterprise_options['tech_acct'], logger)
+        self.auth_dict = auth_dict = make_auth_dict(self.name, enterprise_config, org_id,
+                                                    enterprise_options['tech_acct'], logger)
         # this check must come after we fetch all the settings
         enterprise_config.report_unused_values(logger)
         # open the connection
@@ -89,9 +91,7 @@ class UmapiConnector(object):
         try:
             self.connection = connection = umapi_client.Connection(
                 org_id=org_id,
-                auth_dict=auth_dict,
-                ims_host=ims_host,
-                ims_endpoint_jwt=server_options['ims_endpoint_jwt'],
+                auth=token_cache.get_auth(auth_dict, ims_host, server_options['ims_endpoint_jwt'], logger),
                 user_management_endpoint=um_endpoint,
                 test_mode=options['test_mode'],
                 user_agent="user-sync/" + app_version,
@@ -103,26 +103,141 @@ class UmapiConnector(object):
             raise AssertionException("Connection to org %s at endpoint %s failed: %s" % (org_id, um_endpoint, e))
         logger.debug('%s: connection established', self.name)
         # wrap the connection in an action manager
-        self.action_manager = ActionManager(connection, org_id, logger)
+        self.action_manager = ActionManager(connection, org_id, logger, server_options['batch_retries'])
+        # the org's users can be kept between runs, see keep_user_snapshot
+        self.snapshot_dir = None
+
+    def prepare_run(self):
+        """
+        Get ready for another run on the same connection, as the daemon does: get a new access token
+        if the current one is close to expiry, and start the action statistics over.
+        """
+        server_options = self.options['server']
+        self.connection.auth = token_cache.get_auth(self.auth_dict, server_options['ims_host'],
+                                                    server_options['ims_endpoint_jwt'], self.logger)
+        self.action_manager.reset_statistics()
 
     def get_users(self):
         return list(self.iter_users())
 
+    def keep_user_snapshot(self, snapshot_dir, max_age):
+        """
+        Keep the org's users between runs, as the daemon does, in a snapshot file in snapshot_dir.
+        All the users are only read again once the snapshot is max_age seconds old.  Until then,
+        a run reads again just the users that earlier runs sent actions for, one at a time, so changes
+        made to the org in other ways, as in the Admin Console, are only seen when all are read again.
+        :type snapshot_dir: str
+        :type max_age: float
+        """
+        self.snapshot_dir = snapshot_dir
+        self.snapshot_max_age = max_age
+        self.user_snapshot = None
+        self.snapshot_time = None
+        self.snapshot_expired = False
+        # the users sent actions since the snapshot was read, and those read again since, by email
+        self.changed_emails = set()
+        self.updated_user_by_email = {}
+
     def iter_users(self, in_group=None):
-        users = {}
+        """
+        :type in_group: str: only read the members of this group, which are never kept in the snapshot
+        :rtype iterable(dict)
+        """
+        if self.snapshot_dir is None or in_group:
+            return self.query_users(in_group)
+        if (self.user_snapshot is None or self.snapshot_expired or
+                time.time() - self.snapshot_time >= self.snapshot_max_age):
+            return self.read_user_snapshot()
+        return self.iter_snapshot_users()
+
+    def read_user_snapshot(self):
+        """
+        Read all the users, keeping them in a new snapshot once they have all been read
+        :rtype iterable(dict)
+        """
+        snapshot_time = time.time()
+        # actions sent from here on may change users that have already been read
+        self.snapshot_expired = False
+        self.changed_emails = set()
+        users = []
+        for user in self.query_users():
+            users.append(user)
+            yield user
+        self.close_user_snapshot()
+        file_descriptor, file_path = tempfile.mkstemp(suffix='.snapshot', dir=self.snapshot_dir)
+        os.close(file_descriptor)
+        user_sync.snapshot.save_snapshot(file_path, users)
+        self.user_snapshot = user_sync.snapshot.load_snapshot(file_path)
+        self.snapshot_time = snapshot_time
+        self.updated_user_by_email = {}
+        self.logger.debug('Kept %d users in the snapshot %s', len(users), file_path)
+
+    def iter_snapshot_users(self):
+        """
+        The users in the snapshot, with those that were sent actions read again
+        :rtype iterable(dict)
+        """
+        if self.changed_emails:
+            self.logger.info('Reading again %d users that were changed since all the users were read',
+                             len(self.changed_emails))
+            for email in self.changed_emails:
+                self.updated_user_by_email[email] = self.get_user(email)
+            self.changed_emails = set()
+        updated_user_by_email = self.updated_user_by_email
+        for user in self.user_snapshot:
+            if user_sync.helper.normalize_string(user['email']) not in updated_user_by_email:
+                yield user
+        for user in six.itervalues(updated_user_by_email):
+            if user is not None:
+                yield user
+
+    def close_user_snapshot(self):
+        if self.user_snapshot is not None:
+            self.user_snapshot.close()
+            os.remove(self.user_snapshot.file_path)
+            self.user_snapshot = None
+
+    def note_changed_user(self, commands):
+        """
+        Note the user an action is sent for, so that a snapshot of the users reads it again
+        :type commands: Commands
+        """
+        emails = [commands.email or (commands.username if commands.username and '@' in commands.username else None)]
+        for command_name, command_params in commands.do_list:
+            if command_name == 'update':
+                emails.append(command_params.get('email'))
+        if emails[0] is None:
+            # the user can't be looked up, so all of them are read again
+            self.snapshot_expired = True
+        self.changed_emails.update(user_sync.helper.normalize_string(email) for email in emails if email)
+
+    def query_users(self, in_group=None):
+        # only the emails are remembered, to skip repeats; the users themselves are not kept
+        emails = set()
         try:
             if in_group:
                 u_query = umapi_client.UsersQuery(self.connection, in_group=in_group)
             else:
                 u_query = umapi_client.UsersQuery(self.connection)
-            for u in u_query:
+            for u in iter_query_results(u_query):
                 email = u['email']
-                if not (email in users):
-                    users[email] = u
+                if not (email in emails):
+                    emails.add(email)
                     yield u
         except umapi_client.UnavailableError as e:
             raise AssertionException("Error contacting UMAPI server: %s" % e)
 
+    def get_user(self, email):
+        """
+        Fetch one user with a single request, rather than reading through the whole org
+        :type email: str
+        :rtype dict: the user, or None if there's no such user in the org
+        """
+        try:
+            return umapi_client.UserQuery(self.connection, email).result() or None
+        except umapi_client.UnavailableError as e:
+            raise AssertionException("Error contacting UMAPI server: %s" % e)
+
     def get_groups(self):
         return list(self.iter_groups())
 
@@ -147,17 +262,38 @@ class UmapiConnector(object):
         if name:
             group = umapi_client.UserGroupAction(group_name=name)
             group.create(description="Automatically created by User Sync Tool")
+            if self.action_manager.is_planning():
+                return self.action_manager.add_action(group)
             return self.connection.execute_single(group)
 
     def get_action_manager(self):
         return self.action_manager
 
+    def replay_actions(self, wire_actions):
+        """
+        Send actions again, as they were recorded in an action journal
+        :type wire_actions: list(dict): the actions in the form they are sent in
+        """
+        action_manager = self.get_action_manager()
+        if self.snapshot_dir is not None:
+            # the actions don't say which users they change in a form that can be looked up
+            self.snapshot_expired = True
+        for wire_action in wire_actions:
+            frame = dict(wire_action)
+            commands = frame.pop('do', [])
+            action = umapi_client.Action(**frame)
+            for command in commands:
+                action.append(**command)
+            action_manager.add_action(action)
+
     def send_commands(self, commands, callback=None):
         """
         :type commands: Commands
         :type callback: callable(dict)
         """
         if len(commands) > 0:
+            if self.snapshot_dir is not None:
+                self.note_changed_user(commands)
             action_manager = self.get_action_manager()
             action = action_manager.create_action(commands)
             if action is not None:
@@ -254,23 +390,61 @@ class Commands(object):
 class ActionManager(object):
     next_request_id = 1
 
-    def __init__(self, connection, org_id, logger):
+    def __init__(self, connection, org_id, logger, batch_retries=0):
         """
         :type connection: umapi_client.Connection
         :type org_id: str
         :type logger: logging.Logger
+        :type batch_retries: int: how many batches may be sent again in each run, after batches fail as a whole
         """
         self.action_count = 0
         self.error_count = 0
+        self.retried_count = 0
+        self.batch_retries = batch_retries
+        self.retries_left = batch_retries
         self.items = []
         self.connection = connection
         self.org_id = org_id
         self.logger = logger.getChild('action')
+        self.journal = None
+        self.journal_name = None
+        self.planned_actions = None
+        # the actions in batches that failed as a whole, so only they are sent again
+        self.failed_actions = set()
 
     def get_statistics(self):
         """Return the count of actions sent so far, and how many had errors."""
         return self.action_count, self.error_count
 
+    def get_retried_count(self):
+        """Return the count of actions that succeeded when sent again after their batch failed."""
+        return self.retried_count
+
+    def reset_statistics(self):
+        self.action_count = 0
+        self.error_count = 0
+        self.retried_count = 0
+        self.retries_left = self.batch_retries
+
+    def set_journal(self, journal, journal_name):
+        """
+        Record the actions from now on in a journal, or stop recording them if it's None
+        :type journal: user_sync.journal.ActionJournal
+        :type journal_name: str: the name of the umapi the actions are for
+        """
+        self.journal = journal
+        self.journal_name = journal_name
+
+    def set_plan(self, planned_actions):
+        """
+        Put the actions in a plan from now on, instead of sending them, or send them again if it's None
+        :type planned_actions: list(dict): where to put the actions, in the form they are sent in
+        """
+        self.planned_actions = planned_actions
+
+    def is_planning(self):
+        return self.planned_actions is not None
+
     def get_next_request_id(self):
         request_id = 'action_%d' % ActionManager.next_request_id
         ActionManager.next_request_id += 1
@@ -309,6 +483,11 @@ class ActionManager(object):
         :type action: umapi_client.UserAction
         :type callback: callable(umapi_client.UserAction, bool, dict)
         """
+        if self.planned_actions is not None:
+            self.planned_actions.append(action.wire_dict())
+            self.action_count += 1
+            self.logger.debug('Planned action: %s', json.dumps(action.wire_dict()))
+            return
         item = {
             'action': action,
             'callback': callback
@@ -316,6 +495,8 @@ class ActionManager(object):
         self.items.append(item)
         self.action_count += 1
         self.logger.debug('Added action: %s', json.dumps(action.wire_dict()))
+        if self.journal is not None:
+            self.journal.record_queued(self.journal_name, action)
         self._execute_action(action)
 
     def has_work(self):
@@ -352,30 +533,152 @@ class ActionManager(object):
         :return: 
         """
         # update queue
-        sent_items, self.items = self.items[:total_sent], self.items[total_sent:]
+        sent_items = self.take_sent_items(total_sent, batch_error)
+
+        # a batch that failed as a whole is sent again in smaller batches, so only the actions at fault fail
+        failed_items = []
+        if batch_error:
+            sent_items, failed_items = self.retry_items(sent_items, batch_error)
 
-        # collect sent actions, their errors, their callbacks
-        details = [(item['action'], item['action'].execution_errors(), item['callback']) for item in sent_items]
+        # collect sent actions, their errors, their callbacks, and whether they were sent again
+        details = [(item['action'], item['action'].execution_errors(), item['callback'], item.get('retried'))
+                   for item in sent_items]
 
         # log errors
-        if batch_error:
-            request_ids = str([action.frame.get("requestID") for action, _, _ in details])
+        if failed_items:
+            request_ids = str([item['action'].frame.get("requestID") for item in failed_items])
             self.logger.critical("Unexpected response! Sent actions %s may have failed: %s", request_ids, batch_error)
-            self.error_count += total_sent
-        else:
-            for action, errors, _ in details:
-                if errors:
-                    self.error_count += 1
-                    for error in errors:
-                        self.logger.error('Error in requestID: %s (User: %s, Command: %s): code: "%s" message: "%s"',
-                                          action.frame.get("requestID"),
-                                          error.get("target", "<Unknown>"), error.get("command", "<Unknown>"),
-                                          error.get('errorCode', "<None>"), error.get('message', "<None>"))
+            self.error_count += len(failed_items)
+        for action, errors, _, retried in details:
+            if errors:
+                self.error_count += 1
+                for error in errors:
+                    self.logger.error('Error in requestID: %s (User: %s, Command: %s): code: "%s" message: "%s"',
+                                      action.frame.get("requestID"),
+                                      error.get("target", "<Unknown>"), error.get("command", "<Unknown>"),
+                                      error.get('errorCode', "<None>"), error.get('message', "<None>"))
+            elif retried:
+                self.retried_count += 1
+        # the actions in a batch that got an unexpected response are left unanswered in the journal,
+        # as they may or may not have been done
+        if self.journal is not None and (details or failed_items):
+            for action, errors, _, _ in details:
+                self.journal.record_done(self.journal_name, action, not errors)
+            self.journal.sync()
         # invoke callbacks
-        for action, errors, callback in details:
+        for action, errors, callback, _ in details:
             if callable(callback):
                 callback({
                     "action": action,
-                    "is_success": not batch_error and not errors,
-                    "errors": [batch_error] if batch_error else errors
+                    "is_success": not errors,
+                    "errors": errors
                 })
+        for item in failed_items:
+            if callable(item['callback']):
+                item['callback']({
+                    "action": item['action'],
+                    "is_success": False,
+                    "errors": [batch_error]
+                })
+
+    def take_sent_items(self, total_sent, batch_error=None):
+        """
+        Take the items whose actions have all been sent off the front of the queue.  The connection splits
+        actions that are too big, so the count sent is of the pieces it split them into, which it sends
+        in batches of throttle_actions.  When some of those batches fail as a whole, the actions with
+        pieces in them are noted as failed.
+        :type total_sent: int: the number of pieces sent by a call to the connection
+        :type batch_error: umapi_client.BatchError
+        :rtype list(dict)
+        """
+        pieces = []
+        unsent_counts = []
+        for item in self.items:
+            action = item['action']
+            item_pieces = (getattr(action, 'split_actions', None) or [action])[item.get('sent_pieces', 0):]
+            pieces.extend((action, piece) for piece in item_pieces)
+            unsent_counts.append(len(item_pieces))
+        if batch_error is not None:
+            self.failed_actions.update(self.find_failed_actions(pieces[:total_sent]))
+        sent_count = 0
+        for item, unsent_count in zip(self.items, unsent_counts):
+            if unsent_count > total_sent:
+                # the rest of this action's pieces are still queued
+                item['sent_pieces'] = item.get('sent_pieces', 0) + total_sent
+                break
+            total_sent -= unsent_count
+            sent_count += 1
+        sent_items, self.items = self.items[:sent_count], self.items[sent_count:]
+        return sent_items
+
+    def find_failed_actions(self, sent_pieces):
+        """
+        The server reports an action's errors on the action it was sent in, so a batch with errors was
+        answered.  One with none either succeeded or failed as a whole, and only their number tells
+        them apart, so they are all taken to have failed.  The queue never holds a whole batch, so this
+        only sends good actions again when a single action is split into more than a batch.
+        :type sent_pieces: list(tuple(umapi_client.Action, umapi_client.Action)): each action sent, and the
+            piece of it that was sent, in the order they were sent
+        :rtype set(umapi_client.Action): the actions that were in batches with no errors
+        """
+        batch_size = self.connection.throttle_actions
+        failed_actions = set()
+        for i in range(0, len(sent_pieces), batch_size):
+            batch = sent_pieces[i:i + batch_size]
+            if not any(piece.errors for _, piece in batch):
+                failed_actions.update(action for action, _ in batch)
+        return failed_actions
+
+    def retry_items(self, items, batch_error):
+        """
+        Send again the actions of batches that failed as a whole.  Each failed batch is split in two
+        and the halves sent separately, and so on for any half that fails, until the actions at fault
+        are sent on their own.  Each batch sent again uses up one of the run's retries.  The actions of
+        batches that were answered, when others sent with them failed, are not sent again.
+        :type items: list(dict)
+        :type batch_error: umapi_client.BatchError
+        :rtype (list(dict), list(dict)): the items the server answered for, and the ones that failed
+        """
+        answered_items = [item for item in items if item['action'] not in self.failed_actions]
+        items = [item for item in items if item['action'] in self.failed_actions]
+        self.failed_actions.difference_update(item['action'] for item in items)
+        if self.retries_left <= 0:
+            return answered_items, items
+        if all(isinstance(cause, umapi_client.UnavailableError) for cause in batch_error.causes):
+            # the server is down, so smaller batches won't do any better
+            return answered_items, items
+        if self.has_work():
+            # send what is queued first, so each batch sent again holds only the actions given to it
+            self.flush()
+        retried_count = len(items)
+        failed_items = []
+        batch_size = self.connection.throttle_actions
+        batches = []
+        for i in range(0, len(items), batch_size):
+            batch = items[i:i + batch_size]
+            batches.extend([batch[:len(batch) // 2], batch[len(batch) // 2:]] if len(batch) > 1 else [batch])
+        while batches:
+            batch = batches.pop(0)
+            if self.retries_left <= 0:
+                failed_items.extend(batch)
+                continue
+            self.retries_left -= 1
+            actions = [item['action'] for item in batch]
+            for action in actions:
+                action.errors = []
+            try:
+                self.connection.execute_multiple(actions, immediate=True)
+            except umapi_client.BatchError:
+                if len(batch) == 1:
+                    failed_items.extend(batch)
+                else:
+                    half = len(batch) // 2
+                    batches[0:0] = [batch[:half], batch[half:]]
+            else:
+                for item in batch:
+                    item['retried'] = True
+                answered_items.extend(batch)
+        self.logger.info('Sent %d actions again after a batch failed: %d answered, %d failed (%d retries left)',
+                         retried_count, sum(1 for item in answered_items if item.get('retried')), len(failed_items),
+                         self.retries_left)
+        return answered_items, failed_items
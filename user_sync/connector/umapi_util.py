@@ -1,15 +1,24 @@
+import base64
+import hashlib
+import hmac
+import json
+import os
+import time
+
 from user_sync.error import AssertionException
-from Crypto.PublicKey import RSA
 
 
 def make_auth_dict(name, config, org_id, tech_acct, logger):
+    start = time.time()
     auth_dict = {
         'org_id': org_id,
         'tech_acct_id': tech_acct,
         'api_key': config.get_credential('api_key', org_id),
         'client_secret': config.get_credential('client_secret', org_id),
     }
+    logger.debug('%s: api_key and client_secret read in %.3f seconds', name, time.time() - start)
     # get the private key
+    start = time.time()
     key_path = config.get_string('priv_key_path', True)
     if key_path:
         data_setting = config.has_credential('priv_key_data')
@@ -25,13 +34,269 @@ def make_auth_dict(name, config, org_id, tech_acct, logger):
                                      (config.get_full_scope(), key_path, e))
     else:
         key_data = config.get_credential('priv_key_data', org_id)
-    # decrypt the private key, if needed
-    passphrase = config.get_credential('priv_key_pass', org_id, True)
-    if passphrase:
-        try:
-            key_data = str(RSA.importKey(key_data, passphrase=passphrase).exportKey().decode('ascii'))
-        except (ValueError, IndexError, TypeError) as e:
-            raise AssertionException('%s: Error decrypting private key, either the password is wrong or: %s' %
-                                     (config.get_full_scope(), e))
     auth_dict['private_key_data'] = key_data
+    # the private key is only decrypted, if needed, when a token has to be fetched
+    auth_dict['private_key_pass'] = config.get_credential('priv_key_pass', org_id, True)
+    auth_dict['scope'] = config.get_full_scope()
+    logger.debug('%s: private key and passphrase read in %.3f seconds', name, time.time() - start)
     return auth_dict
+
+
+jwt_algorithms_registered = False
+
+
+def register_jwt_algorithms():
+    """
+    Register the RS256 algorithm that umapi_client signs its JWTs with, the first time a JWT is made,
+    whichever connector makes it
+    """
+    global jwt_algorithms_registered
+    if jwt_algorithms_registered:
+        return
+    jwt_algorithms_registered = True
+    try:
+        import jwt
+        from jwt.contrib.algorithms.pycrypto import RSAAlgorithm
+        jwt.register_algorithm('RS256', RSAAlgorithm(RSAAlgorithm.SHA256))
+    except:
+        pass
+
+
+# decrypted private keys, by a hash of the encrypted key and its passphrase, shared by all connectors
+decrypted_key_by_hash = {}
+
+
+def get_private_key_data(auth_dict, logger):
+    """
+    :type auth_dict: dict: from make_auth_dict
+    :type logger: logging.Logger
+    :rtype str: the private key, decrypted
+    """
+    key_data = auth_dict['private_key_data']
+    passphrase = auth_dict['private_key_pass']
+    if passphrase:
+        key_hash = hashlib.sha256(('%s\n%s' % (key_data, passphrase)).encode('utf8')).hexdigest()
+        decrypted_key_data = decrypted_key_by_hash.get(key_hash)
+        if decrypted_key_data is None:
+            from Crypto.PublicKey import RSA
+            start = time.time()
+            try:
+                decrypted_key_data = str(RSA.importKey(key_data, passphrase=passphrase).exportKey().decode('ascii'))
+            except (ValueError, IndexError, TypeError) as e:
+                raise AssertionException('%s: Error decrypting private key, either the password is wrong or: %s' %
+                                         (auth_dict['scope'], e))
+            decrypted_key_by_hash[key_hash] = decrypted_key_data
+            logger.debug('%s: private key decrypted in %.3f seconds', auth_dict['scope'], time.time() - start)
+        key_data = decrypted_key_data
+    return key_data
+
+
+class TokenCache(object):
+    """
+    IMS access tokens, keyed by org id, technical account and API key, so that all the connections
+    with the same credentials share one JWT exchange.  If a file path is set, the tokens are also kept
+    in that file, so that later runs can use them until they expire.  Each token is encrypted in the
+    file with a key derived from its client secret, so the file is no use without the credentials.
+    """
+    file_version = 2
+    # tokens that expire within this many seconds are not used
+    expiry_margin = 300
+    # nor are tokens with less than this share of their lifetime left, since a static auth is made
+    # from the token, and it has to last for the whole run
+    lifetime_margin = 0.5
+
+    def __init__(self, file_path=None):
+        """
+        :type file_path: str
+        """
+        self.file_path = file_path
+        # token id -> (access token, expiry time, issue time)
+        self.token_by_id = {}
+        self.file_entries = None
+
+    def set_file_path(self, file_path):
+        """
+        :type file_path: str
+        """
+        self.file_path = file_path
+        self.file_entries = None
+
+    def get_auth(self, auth_dict, ims_host, ims_endpoint_jwt, logger):
+        """
+        :type auth_dict: dict: from make_auth_dict
+        :type ims_host: str
+        :type ims_endpoint_jwt: str
+        :type logger: logging.Logger
+        :rtype umapi_client.auth.Auth
+        """
+        from umapi_client.auth import Auth
+        return Auth(auth_dict['api_key'], self.get_access_token(auth_dict, ims_host, ims_endpoint_jwt, logger))
+
+    def get_access_token(self, auth_dict, ims_host, ims_endpoint_jwt, logger):
+        """
+        Get a token from this cache or from the cache file if there is a good one, otherwise from IMS.
+        :type auth_dict: dict: from make_auth_dict
+        :type ims_host: str
+        :type ims_endpoint_jwt: str
+        :type logger: logging.Logger
+        :rtype str
+        """
+        token_id = self.get_token_id(auth_dict)
+        token = self.token_by_id.get(token_id)
+        if token is None or not self.is_fresh(token):
+            token = self.read_token(token_id, auth_dict['client_secret'], logger)
+            if token is not None and self.is_fresh(token):
+                logger.debug('Using cached access token for org %s', auth_dict['org_id'])
+            else:
+                token = self.fetch_token(auth_dict, ims_host, ims_endpoint_jwt, logger)
+                self.write_token(token_id, auth_dict['client_secret'], token, logger)
+            self.token_by_id[token_id] = token
+        return token[0]
+
+    @staticmethod
+    def fetch_token(auth_dict, ims_host, ims_endpoint_jwt, logger):
+        """
+        Exchange a JWT for an access token, as umapi_client.Connection does
+        :type auth_dict: dict
+        :type ims_host: str
+        :type ims_endpoint_jwt: str
+        :type logger: logging.Logger
+        :rtype tuple(str, float, float): the access token, its expiry time and the time it was fetched
+        """
+        from six import StringIO
+        from umapi_client.auth import JWT, AccessRequest
+        register_jwt_algorithms()
+        jwt = JWT(auth_dict['org_id'], auth_dict['tech_acct_id'], ims_host, auth_dict['api_key'],
+                  StringIO(get_private_key_data(auth_dict, logger)))
+        start = time.time()
+        access_request = AccessRequest("https://" + ims_host + ims_endpoint_jwt, auth_dict['api_key'],
+                                       auth_dict['client_secret'], jwt())
+        access_token = access_request()
+        logger.debug('Access token for org %s fetched in %.3f seconds', auth_dict['org_id'], time.time() - start)
+        expiry = getattr(access_request, 'expiry', None)
+        # without an expiry, the token is only used for this run
+        return access_token, time.mktime(expiry.timetuple()) if expiry is not None else None, start
+
+    def is_fresh(self, token):
+        """
+        :type token: tuple(str, float, float)
+        :rtype bool
+        """
+        expiry, issued = token[1], token[2]
+        if expiry is None:
+            return True
+        margin = max(self.expiry_margin, (expiry - issued) * self.lifetime_margin)
+        return expiry - margin > time.time()
+
+    @staticmethod
+    def get_token_id(auth_dict):
+        """
+        :type auth_dict: dict
+        :rtype str
+        """
+        key = '\n'.join((auth_dict['org_id'], auth_dict['tech_acct_id'], auth_dict['api_key']))
+        return hashlib.sha256(key.encode('utf8')).hexdigest()
+
+    @staticmethod
+    def get_cipher_key(token_id, client_secret):
+        """
+        :type token_id: str
+        :type client_secret: str
+        :rtype bytes
+        """
+        return hmac.new(client_secret.encode('utf8'), token_id.encode('ascii'), hashlib.sha256).digest()
+
+    def read_token(self, token_id, client_secret, logger):
+        """
+        :rtype tuple(str, float, float): None if the file has no token for these credentials
+        """
+        if not self.file_path:
+            return None
+        if self.file_entries is None:
+            self.file_entries = self.read_file(logger)
+        entry = self.file_entries.get(token_id)
+        if entry is None:
+            return None
+        from Crypto.Cipher import AES
+        try:
+            cipher = AES.new(self.get_cipher_key(token_id, client_secret), AES.MODE_GCM,
+                             nonce=base64.b64decode(entry['nonce']))
+            access_token = cipher.decrypt_and_verify(base64.b64decode(entry['data']), base64.b64decode(entry['tag']))
+            return access_token.decode('utf8'), entry['expiry'], entry['issued']
+        except (KeyError, TypeError, ValueError) as e:
+            # e.g. the client secret has changed since the token was saved
+            logger.debug("Ignoring cached access token that can't be decrypted: %s", e)
+            return None
+
+    def read_file(self, logger):
+        """
+        :rtype dict: the file's entries by token id
+        """
+        if not os.path.exists(self.file_path):
+            return {}
+        try:
+            with open(self.file_path, 'r') as token_file:
+                content = json.load(token_file)
+            if content.get('version') == self.file_version:
+                return content['tokens']
+            logger.debug('Ignoring access token cache with a different version: %s', self.file_path)
+        except (IOError, OSError, ValueError, KeyError, AttributeError) as e:
+            logger.warning("Ignoring access token cache that can't be read: %s: %s", self.file_path, e)
+        return {}
+
+    def write_token(self, token_id, client_secret, token, logger):
+        """
+        Save the token, and drop any expired ones, if the token can be saved
+        :type token: tuple(str, float, float)
+        """
+        access_token, expiry, issued = token
+        if not self.file_path or expiry is None:
+            return
+        if self.file_entries is None:
+            self.file_entries = self.read_file(logger)
+        from Crypto.Cipher import AES
+        cipher = AES.new(self.get_cipher_key(token_id, client_secret), AES.MODE_GCM)
+        data, tag = cipher.encrypt_and_digest(access_token.encode('utf8'))
+        now = time.time()
+        entries = dict((key, entry) for key, entry in self.file_entries.items() if entry.get('expiry', 0) > now)
+        entries[token_id] = {
+            'expiry': expiry,
+            'issued': issued,
+            'nonce': base64.b64encode(cipher.nonce).decode('ascii'),
+            'tag': base64.b64encode(tag).decode('ascii'),
+            'data': base64.b64encode(data).decode('ascii'),
+        }
+        self.file_entries = entries
+        temp_path = self.file_path + '.tmp'
+        try:
+            # only the owner can read the tokens, even though they are encrypted
+            descriptor = os.open(temp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+            with os.fdopen(descriptor, 'w') as token_file:
+                json.dump({'version': self.file_version, 'tokens': entries}, token_file)
+            if os.path.exists(self.file_path):
+                os.remove(self.file_path)
+            os.rename(temp_path, self.file_path)
+        except (IOError, OSError) as e:
+            logger.warning("Can't write access token cache %s: %s", self.file_path, e)
+
+
+# shared by all the connections of a run
+token_cache = TokenCache()
+
+
+def iter_query_results(query):
+    """
+    Iterate over the results of a umapi_client query, fetching a page at a time.  Unlike iterating
+    over the query itself, results are not kept by the query once they have been handed out.
+    :type query: umapi_client.QueryMultiple
+    :rtype iterable(dict)
+    """
+    page = 0
+    while True:
+        result = query.conn.query_multiple(query.object_type, page, query.url_params, query.query_params)
+        records, last_page = result[0], result[1]
+        for record in records:
+            yield record
+        if last_page or not records:
+            return
+        page += 1
@@ -18,9 +18,15 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
 
+import codecs
 import csv
 import datetime
+import importlib
+import io
+import mmap
+import operator
 import os
+import re
 import sys
 
 import six
@@ -41,24 +47,248 @@ def normalize_string(string_value):
     return string_value.strip().lower() if string_value is not None else None
 
 
+class NormalizationCache(object):
+    """
+    Remembers the results of normalize_string for values that come from a small vocabulary,
+    such as group names, domains and identity types, which are normalized over and over.
+    The cache is bounded: when it is full, it is emptied and starts over.
+    """
+    default_max_size = 10000
+
+    def __init__(self, max_size=default_max_size):
+        """
+        :type max_size: int
+        """
+        self.max_size = max_size
+        self.normalized_by_value = {}
+        self.hits = 0
+        self.misses = 0
+
+    def normalize(self, string_value):
+        """
+        Same as normalize_string
+        """
+        try:
+            normalized_value = self.normalized_by_value[string_value]
+            self.hits += 1
+            return normalized_value
+        except KeyError:
+            self.misses += 1
+            if len(self.normalized_by_value) >= self.max_size:
+                self.normalized_by_value.clear()
+            normalized_value = self.normalized_by_value[string_value] = normalize_string(string_value)
+            return normalized_value
+
+    def resize(self, max_size):
+        """
+        :type max_size: int
+        """
+        self.max_size = max_size
+        if len(self.normalized_by_value) > max_size:
+            self.normalized_by_value.clear()
+
+    def get_statistics(self):
+        """
+        :rtype (int, int, int): the hit count, the miss count and the current size
+        """
+        return self.hits, self.misses, len(self.normalized_by_value)
+
+    def reset_statistics(self):
+        """
+        Start the hit and miss counts over, keeping the cached values
+        """
+        self.hits = 0
+        self.misses = 0
+
+
+# shared cache for group names, domains and identity types
+normalization_cache = NormalizationCache()
+
+
+class ExclusionMatcher(object):
+    """
+    Matches usernames against the exclude_users patterns.  Each pattern must match the whole
+    username, ignoring case.  Rather than trying every pattern in turn, literal patterns are
+    looked up in a set, patterns that are a literal prefix or suffix with .* on the other side
+    are looked up by length, and the rest are combined into one alternation.  Usernames those
+    lookups can't decide exactly (non-ASCII or multi-line ones) are tried against every pattern.
+    """
+    flags = re.UNICODE | re.IGNORECASE
+    # backreferences, group conditions and global flags change meaning when patterns are combined
+    uncombinable_pattern = re.compile(r'\\[1-9]|\(\?P=|\(\?\(|\(\?[aiLmsux]+\)')
+    special_characters = frozenset('.^$*+?{}[]|()')
+
+    def __init__(self, patterns=()):
+        """
+        :type patterns: iterable(str or re): a compiled pattern is used as is, and never combined
+        """
+        self.literals = set()
+        self.prefixes_by_length = {}
+        self.suffixes_by_length = {}
+        self.combinable_patterns = []
+        self.combined_regex = None
+        self.separate_regexes = []
+        self.regexes = []
+        for pattern in patterns:
+            self.add(pattern)
+
+    def add(self, pattern):
+        """
+        :type pattern: str or re
+        :raises re.error: if the pattern isn't a legal regular expression
+        """
+        if not isinstance(pattern, six.string_types):
+            self.regexes.append(pattern)
+            self.separate_regexes.append(pattern)
+            return
+        regex = re.compile(r'\A' + pattern + r'\Z', self.flags)
+        self.regexes.append(regex)
+        literal = self.parse_literal(pattern)
+        if literal is not None:
+            self.literals.add(literal)
+            return
+        if pattern.endswith('.*'):
+            prefix = self.parse_literal(pattern[:-2])
+            if prefix is not None:
+                self.prefixes_by_length.setdefault(len(prefix), set()).add(prefix)
+                return
+        if pattern.startswith('.*'):
+            suffix = self.parse_literal(pattern[2:])
+            if suffix is not None:
+                self.suffixes_by_length.setdefault(len(suffix), set()).add(suffix)
+                return
+        if self.uncombinable_pattern.search(pattern):
+            self.separate_regexes.append(regex)
+        else:
+            self.combinable_patterns.append(pattern)
+            self.combined_regex = None
+
+    @classmethod
+    def parse_literal(cls, pattern):
+        """
+        :type pattern: str
+        :rtype str: the lowercase ASCII string the pattern matches, or None if it isn't such a literal
+        """
+        characters = []
+        escaped = False
+        for character in pattern:
+            if escaped:
+                if character.isalnum():
+                    return None
+                characters.append(character)
+                escaped = False
+            elif character == '\\':
+                escaped = True
+            elif character in cls.special_characters:
+                return None
+            else:
+                characters.append(character)
+        literal = ''.join(characters)
+        if escaped or not is_ascii(literal):
+            return None
+        return literal.lower()
+
+    def combine(self):
+        """
+        Build the alternation of the combinable patterns, or keep them apart if that fails
+        """
+        patterns = self.combinable_patterns
+        alternation = '|'.join('(?:%s)' % pattern for pattern in patterns)
+        try:
+            self.combined_regex = re.compile(r'\A(?:' + alternation + r')\Z', self.flags)
+        except (re.error, AssertionError, OverflowError):
+            # e.g. too many groups for one regular expression
+            self.separate_regexes.extend(re.compile(r'\A' + pattern + r'\Z', self.flags) for pattern in patterns)
+            self.combinable_patterns = []
+            self.combined_regex = None
+
+    def match(self, username):
+        """
+        :type username: str
+        :rtype bool
+        """
+        if self.combinable_patterns and self.combined_regex is None:
+            self.combine()
+        if not is_ascii(username) or '\n' in username:
+            return any(regex.match(username) for regex in self.regexes)
+        lowered = username.lower()
+        if lowered in self.literals:
+            return True
+        for length, prefixes in six.iteritems(self.prefixes_by_length):
+            if lowered[:length] in prefixes:
+                return True
+        size = len(lowered)
+        for length, suffixes in six.iteritems(self.suffixes_by_length):
+            if length <= size and lowered[size - length:] in suffixes:
+                return True
+        if self.combined_regex is not None and self.combined_regex.match(username):
+            return True
+        return any(regex.match(username) for regex in self.separate_regexes)
+
+    def __len__(self):
+        return len(self.regexes)
+
+
+class LazyModule(object):
+    """
+    Stands in for a module that is slow to load and only needed by some runs.  The module is imported
+    the first time one of its attributes is used, and the attributes are then looked up on it.
+    """
+
+    def __init__(self, name):
+        """
+        :type name: str: the full name of the module
+        """
+        self.name = name
+        self.module = None
+
+    def __getattr__(self, attribute):
+        if self.module is None:
+            self.module = importlib.import_module(self.name)
+        return getattr(self.module, attribute)
+
+
+def is_ascii(string_value):
+    """
+    :type string_value: str
+    :rtype bool
+    """
+    try:
+        string_value.encode('ascii')
+    except UnicodeError:
+        return False
+    return True
+
+
 class CSVAdapter:
     """
     Read and write CSV files to and from lists of dictionaries
     """
-    @staticmethod
-    def open_csv_file(name, mode, encoding=None):
+    # buffer size used when reading large files column by column
+    read_buffer_size = 1024 * 1024
+
+    # compression applied to files with these extensions, by the name of the module that handles it
+    compression_by_extension = {'.gz': 'gzip', '.bz2': 'bz2', '.xz': 'lzma'}
+
+    @classmethod
+    def open_csv_file(cls, name, mode, encoding=None, buffering=1):
         """
+        Files whose names end in .gz, .bz2 or .xz are decompressed when read and compressed when written.
         :type name: str
         :type mode: str
         :type encoding: str, but ignored in py2
+        :type buffering: int, only used when reading uncompressed files
         :rtype file
         """
         try:
+            compression = cls.get_compression(name)
+            if compression is not None:
+                return cls.open_compressed_file(name, mode, encoding, compression)
             if mode == 'r':
                 if is_py2():
-                    return open(str(name), 'rb', buffering=1)
+                    return open(str(name), 'rb', buffering=buffering)
                 else:
-                    kwargs = dict(buffering=1, newline='', encoding=encoding)
+                    kwargs = dict(buffering=buffering, newline='', encoding=encoding)
                     return open(str(name), 'r', **kwargs)
             elif mode == 'w':
                 if is_py2():
@@ -72,12 +302,47 @@ class CSVAdapter:
             raise AssertionException("Can't open file '%s': %s" % (name, e))
 
     @staticmethod
-    def guess_delimiter_from_filename(filename):
+    def open_compressed_file(name, mode, encoding, compression):
+        """
+        :type name: str
+        :type mode: str
+        :type encoding: str, but ignored in py2
+        :type compression: str
+        :rtype file
+        """
+        if mode not in ('r', 'w'):
+            raise ValueError("File mode (%s) must be 'r' or 'w'" % mode)
+        try:
+            module = importlib.import_module(compression)
+        except ImportError:
+            raise AssertionException("Can't open file '%s': %s compression is not available" % (name, compression))
+        if is_py2():
+            if compression == 'bz2':
+                return module.BZ2File(str(name), mode + 'b')
+            return module.open(str(name), mode + 'b')
+        else:
+            kwargs = dict(newline='', encoding=encoding if mode == 'r' else None)
+            return module.open(str(name), mode + 't', **kwargs)
+
+    @classmethod
+    def get_compression(cls, filename):
+        """
+        :type filename: str
+        :rtype str: the name of the compression module, or None if the file isn't compressed
+        """
+        _base_name, extension = os.path.splitext(str(filename))
+        return cls.compression_by_extension.get(normalize_string(extension))
+
+    @classmethod
+    def guess_delimiter_from_filename(cls, filename):
         """
         :type filename
         :rtype str
         """
-        _base_name, extension = os.path.splitext(filename)
+        base_name, extension = os.path.splitext(filename)
+        if cls.get_compression(filename) is not None:
+            # look at the extension of the file inside, such as the .tsv of users.tsv.gz
+            _base_name, extension = os.path.splitext(base_name)
         normalized_extension = normalize_string(extension)
         if normalized_extension == '.csv':
             return ','
@@ -122,6 +387,186 @@ class CSVAdapter:
             except UnicodeError as e:
                 raise AssertionException("Encoding error in file '%s': %s" % (file_path, e))
 
+    @classmethod
+    def read_csv_columns(cls, file_path, column_names, logger=None, encoding='utf8', delimiter=None):
+        """
+        Read the named columns of each row as a tuple, in the order given by column_names.
+        The header is looked up just once, so this is much cheaper than read_csv_rows on large files.
+        A value is None if its column is not in the file or is empty in the row; otherwise the
+        values are what read_csv_rows gives for the same columns.
+        :type file_path: str
+        :type column_names: list(str)
+        :type logger: logging.Logger
+        :type encoding: str
+        :type delimiter: str
+        :rtype iterable(tuple)
+        """
+        with cls.open_csv_file(file_path, 'r', encoding, buffering=cls.read_buffer_size) as input_file:
+            if delimiter is None:
+                delimiter = cls.guess_delimiter_from_filename(file_path)
+            try:
+                reader = csv.reader(input_file, delimiter=delimiter)
+                header = next(reader, None)
+                if header is None:
+                    return
+                if is_py2():
+                    header = [name.decode(encoding, 'strict') for name in header]
+                cls.check_csv_header(file_path, header, column_names, logger)
+                for values in cls.select_csv_columns(reader, header, column_names, encoding):
+                    yield values
+            except UnicodeError as e:
+                raise AssertionException("Encoding error in file '%s': %s" % (file_path, e))
+
+    @staticmethod
+    def check_csv_header(file_path, header, column_names, logger=None):
+        """
+        :type file_path: str
+        :type header: list(str)
+        :type column_names: list(str)
+        :type logger: logging.Logger
+        """
+        unrecognized_column_names = [column_name for column_name in header if column_name not in column_names]
+        if len(unrecognized_column_names) > 0 and logger is not None:
+            logger.warn("In file '%s': unrecognized column names: %s", file_path, unrecognized_column_names)
+
+    @staticmethod
+    def select_csv_columns(reader, header, column_names, encoding='utf8'):
+        """
+        Pick the named columns out of each row that comes from a csv.reader positioned after the header.
+        :type reader: iterable(list)
+        :type header: list(str)
+        :type column_names: list(str)
+        :type encoding: str, only used in py2
+        :rtype iterable(tuple)
+        """
+        # as with csv.DictReader, a repeated column name takes its value from the last such column.
+        # Short rows are padded with empty values and every row gets an extra empty value at the
+        # end, which is where the columns that aren't in the file point.
+        index_by_name = dict((name, index) for index, name in enumerate(header))
+        width = len(header)
+        indexes = [index_by_name.get(name, -1) for name in column_names]
+        if len(indexes) == 1:
+            index = indexes[0]
+            get_values = lambda row: (row[index],)
+        else:
+            get_values = operator.itemgetter(*indexes)
+        for row in reader:
+            if not row:
+                # csv.DictReader skips blank lines, so we do too
+                continue
+            if len(row) < width:
+                row += [''] * (width - len(row))
+            row.append('')
+            if is_py2():
+                yield tuple(value.decode(encoding, 'strict') if value else None for value in get_values(row))
+            else:
+                yield tuple(value if value else None for value in get_values(row))
+
+    @staticmethod
+    def can_split_csv_encoding(encoding):
+        """
+        Byte ranges of a file can only be cut at quote and line break bytes if those characters
+        are single bytes that never occur inside the encoding of any other character.
+        :type encoding: str
+        :rtype bool
+        """
+        name = codecs.lookup(encoding).name
+        return name in ('utf-8', 'utf-8-sig', 'ascii', 'latin-1') or name.startswith(('iso8859', 'cp125'))
+
+    @classmethod
+    def split_csv_file(cls, file_path, chunk_count, encoding='utf8', delimiter=None):
+        """
+        Split the records that follow the header row of a CSV file into about chunk_count byte ranges,
+        for reading in parallel with read_csv_chunk.  A range only ends at a line break that is outside
+        of any quoted value, so values which span lines are never cut in two.  As in the csv module, a
+        quote only opens a quoted value at the start of a field.  Returns None if the file can't be
+        split, as when a quoted value is closed before the end of its field, in which case it should be
+        read with read_csv_columns.
+        :type file_path: str
+        :type chunk_count: int
+        :type encoding: str
+        :type delimiter: str
+        :rtype (list(str), list(tuple(int, int)))
+        """
+        if not cls.can_split_csv_encoding(encoding) or cls.get_compression(file_path) is not None:
+            return None
+        if delimiter is None:
+            delimiter = cls.guess_delimiter_from_filename(file_path)
+        # the bytes after which a field starts, or a quoted value may end
+        separators = (delimiter.encode(encoding), b'\n', b'\r')
+        try:
+            with open(str(file_path), 'rb') as input_file:
+                size = os.fstat(input_file.fileno()).st_size
+                if size == 0:
+                    return None
+                data = mmap.mmap(input_file.fileno(), 0, access=mmap.ACCESS_READ)
+                try:
+                    header_end = _next_csv_record_start(data, 0, size, separators)
+                    if header_end is None or header_end >= size:
+                        return None
+                    header_data = data[:header_end]
+                    boundaries = [header_end]
+                    for chunk in range(1, chunk_count):
+                        target = header_end + (size - header_end) * chunk // chunk_count
+                        if target > boundaries[-1]:
+                            # the quoted values are followed from the last boundary, which is known to be
+                            # outside a quoted value
+                            target = _skip_csv_quotes(data, boundaries[-1], target, size, separators)
+                            boundary = None if target is None else _next_csv_record_start(data, target, size,
+                                                                                          separators)
+                            if boundary is None:
+                                return None
+                            if boundary >= size:
+                                break
+                            boundaries.append(boundary)
+                    boundaries.append(size)
+                finally:
+                    data.close()
+        except (IOError, OSError, ValueError) as e:
+            raise AssertionException("Can't open file '%s': %s" % (file_path, e))
+        try:
+            if is_py2():
+                header = next(csv.reader([header_data], delimiter=delimiter), [])
+                header = [name.decode(encoding, 'strict') for name in header]
+            else:
+                header_text = header_data.decode(encoding, 'strict')
+                header = next(csv.reader(io.StringIO(header_text, newline=''), delimiter=delimiter), [])
+        except UnicodeError as e:
+            raise AssertionException("Encoding error in file '%s': %s" % (file_path, e))
+        return header, list(zip(boundaries[:-1], boundaries[1:]))
+
+    @classmethod
+    def read_csv_chunk(cls, file_path, start, end, header, column_names, encoding='utf8', delimiter=None):
+        """
+        Read the named columns of the rows in one byte range found by split_csv_file.
+        :type file_path: str
+        :type start: int
+        :type end: int
+        :type header: list(str)
+        :type column_names: list(str)
+        :type encoding: str
+        :type delimiter: str
+        :rtype iterable(tuple)
+        """
+        if delimiter is None:
+            delimiter = cls.guess_delimiter_from_filename(file_path)
+        try:
+            with open(str(file_path), 'rb') as input_file:
+                input_file.seek(start)
+                data = input_file.read(end - start)
+        except IOError as e:
+            raise AssertionException("Can't open file '%s': %s" % (file_path, e))
+        try:
+            if is_py2():
+                lines = io.BytesIO(data)
+            else:
+                lines = io.StringIO(data.decode(encoding, 'strict'), newline='')
+            reader = csv.reader(lines, delimiter=delimiter)
+            for values in cls.select_csv_columns(reader, header, column_names, encoding):
+                yield values
+        except UnicodeError as e:
+            raise AssertionException("Encoding error in file '%s': %s" % (file_path, e))
+
     @classmethod
     def write_csv_rows(cls, file_path, field_names, rows, encoding='utf8', delimiter=None):
         """
@@ -151,6 +596,62 @@ class CSVAdapter:
                 writer.writerow(row)
 
 
+def _skip_csv_quotes(data, position, end, size, separators):
+    """
+    Follow the quoted values from position, which is outside of any quoted value, to end.  Returns a
+    position at or after end that is outside of any quoted value, or None if a quoted value is closed
+    before the end of its field, since the csv module's reading of that can't be followed here.
+    A quote that isn't at the start of a field, as in O"Brien, is just part of the value.
+    """
+    while True:
+        quote = data.find(b'"', position, end)
+        if quote < 0:
+            return end
+        if quote > 0 and data[quote - 1:quote] not in separators:
+            position = quote + 1
+            continue
+        position = _find_closing_quote(data, quote + 1, size, separators)
+        if position is None or position >= end:
+            return position
+
+
+def _find_closing_quote(data, position, size, separators):
+    """
+    Find the position just past the quote that closes the quoted value in which position lies,
+    skipping doubled quotes, which are escaped quotes.  Returns None if the closing quote isn't
+    at the end of its field.
+    """
+    while True:
+        closing = data.find(b'"', position)
+        if closing < 0:
+            return size
+        following = data[closing + 1:closing + 2]
+        if following == b'"':
+            position = closing + 2
+        elif following and following not in separators:
+            return None
+        else:
+            return closing + 1
+
+
+def _next_csv_record_start(data, position, size, separators):
+    """
+    Find the start of the first record after position, given that position is not inside a
+    quoted value: that is just past the first line break that isn't inside a quoted value.
+    Returns None if the quoted values can't be followed.
+    """
+    while position < size:
+        line_end = data.find(b'\n', position)
+        if line_end < 0:
+            return size
+        position = _skip_csv_quotes(data, position, line_end, size, separators)
+        if position is None:
+            return None
+        if position == line_end:
+            return line_end + 1
+    return size
+
+
 class JobStats:
     line_left_count = 10
     line_width = 60
@@ -40,7 +40,7 @@ def parse_identity_type(value, message_format=None):
     """
     result = None
     if value is not None:
-        normalized_value = user_sync.helper.normalize_string(value)
+        normalized_value = user_sync.helper.normalization_cache.normalize(value)
         result = NORMALIZED_IDENTITY_TYPE_MAP.get(normalized_value)
         if result is None:
             validation_message = 'Unrecognized identity type: "%s"' % value
@@ -0,0 +1,115 @@
+# Copyright (c) 2016-2017 Adobe Inc.  All rights reserved.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+"""
+An append-only record of the actions sent to the UMAPI, so that a run which dies partway through can be
+finished later (sync --resume) without reading the directory and the Adobe users again.
+
+The journal has one JSON object per line: a "queued" record when an action is handed to the action
+manager, and a "done" record once the UMAPI has answered for it.  Records are passed to the operating
+system as they are written, and forced to disk after every batch the UMAPI answers.
+"""
+
+import io
+import json
+import logging
+import os
+import threading
+
+import six
+
+from user_sync.error import AssertionException
+
+logger = logging.getLogger('journal')
+
+
+class ActionJournal(object):
+    def __init__(self, path, resume=False):
+        """
+        :type path: str
+        :type resume: bool: add to the existing journal rather than start a new one
+        """
+        self.path = path
+        try:
+            self.file = io.open(path, 'a' if resume else 'w', encoding='utf8')
+        except (IOError, OSError) as e:
+            raise AssertionException("Can't open the action journal %s: %s" % (path, e))
+        # the umapi connectors may send their actions on threads of their own
+        self.lock = threading.Lock()
+
+    def record_queued(self, umapi_name, action):
+        """
+        :type umapi_name: str
+        :type action: umapi_client.Action
+        """
+        self.write({'event': 'queued', 'umapi': umapi_name, 'id': action.frame.get('requestID'),
+                    'action': action.wire_dict()})
+
+    def record_done(self, umapi_name, action, is_success):
+        """
+        :type umapi_name: str
+        :type action: umapi_client.Action
+        :type is_success: bool
+        """
+        self.write({'event': 'done', 'umapi': umapi_name, 'id': action.frame.get('requestID'),
+                    'success': is_success})
+
+    def write(self, record):
+        line = six.text_type(json.dumps(record, default=list)) + u'\n'
+        with self.lock:
+            self.file.write(line)
+            self.file.flush()
+
+    def sync(self):
+        with self.lock:
+            os.fsync(self.file.fileno())
+
+    def close(self):
+        if not self.file.closed:
+            self.sync()
+            self.file.close()
+
+    @staticmethod
+    def read_unacknowledged(path):
+        """
+        The actions in a journal that the UMAPI never answered for, in the order they were queued
+        :type path: str
+        :rtype list(tuple(str, dict)): the umapi name and the wire form of each action
+        """
+        queued = []
+        done = set()
+        try:
+            with io.open(path, 'r', encoding='utf8') as journal_file:
+                for line_number, line in enumerate(journal_file, 1):
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        # the last line is cut short if the process died while writing it
+                        logger.warning('Skipping unreadable line %d of the action journal', line_number)
+                        continue
+                    key = (record['umapi'], record['id'])
+                    if record['event'] == 'queued':
+                        queued.append((key, record['action']))
+                    elif record['event'] == 'done':
+                        done.add(key)
+        except (IOError, OSError) as e:
+            raise AssertionException("Can't read the action journal %s: %s" % (path, e))
+        return [(key[0], action) for key, action in queued if key not in done]
@@ -0,0 +1,109 @@
+# Copyright (c) 2016-2017 Adobe Inc.  All rights reserved.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+"""
+A sync plan: the actions a run would send to each umapi, worked out by 'user-sync plan' and sent
+later by 'user-sync apply'.
+
+The plan file has a header line, then one line per action in the order the run made them:
+
+    {"user_sync_plan": 1, "created": "2020-01-31 02:00:00", "version": "2.6.0"}
+    {"umapi": "umapi", "action": {"user": "jdoe@example.com", "do": [{"addAdobeID": {...}}], ...}}
+"""
+
+import io
+import json
+import os
+from collections import OrderedDict
+from datetime import datetime
+
+import six
+
+from user_sync.error import AssertionException
+from user_sync.version import __version__ as app_version
+
+PLAN_FORMAT = 1
+
+
+class SyncPlan(object):
+    def __init__(self, created=None):
+        """
+        :type created: str: when the plan was worked out, if it was read from a file
+        """
+        self.created = created or datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+        self.actions_by_umapi = OrderedDict()
+
+    def get_actions(self, umapi_name):
+        """
+        The list of actions planned for a umapi, which can be added to
+        :type umapi_name: str
+        :rtype list(dict)
+        """
+        return self.actions_by_umapi.setdefault(umapi_name, [])
+
+    def __len__(self):
+        return sum(len(actions) for actions in six.itervalues(self.actions_by_umapi))
+
+    def write(self, path):
+        """
+        Write the plan to a temporary file first, so there's never a partly written plan to apply
+        :type path: str
+        """
+        temp_path = path + '.tmp'
+        try:
+            with io.open(temp_path, 'w', encoding='utf8') as plan_file:
+                header = {'user_sync_plan': PLAN_FORMAT, 'created': self.created, 'version': app_version}
+                plan_file.write(six.text_type(json.dumps(header, sort_keys=True)) + u'\n')
+                for umapi_name, actions in six.iteritems(self.actions_by_umapi):
+                    for action in actions:
+                        line = json.dumps({'umapi': umapi_name, 'action': action}, sort_keys=True, default=list)
+                        plan_file.write(six.text_type(line) + u'\n')
+            if hasattr(os, 'replace'):
+                os.replace(temp_path, path)
+            else:
+                if os.path.exists(path):
+                    os.remove(path)
+                os.rename(temp_path, path)
+        except (IOError, OSError) as e:
+            raise AssertionException("Can't write the plan file %s: %s" % (path, e))
+
+    @classmethod
+    def read(cls, path):
+        """
+        :type path: str
+        :rtype SyncPlan
+        """
+        try:
+            with io.open(path, 'r', encoding='utf8') as plan_file:
+                lines = [line for line in plan_file if line.strip()]
+        except (IOError, OSError) as e:
+            raise AssertionException("Can't read the plan file %s: %s" % (path, e))
+        try:
+            header = json.loads(lines[0]) if lines else {}
+            if header.get('user_sync_plan') != PLAN_FORMAT:
+                raise AssertionException("%s isn't a plan file written by this version of User Sync" % path)
+            plan = cls(header.get('created'))
+            for line in lines[1:]:
+                record = json.loads(line)
+                plan.get_actions(record['umapi']).append(record['action'])
+        except (ValueError, KeyError, AttributeError) as e:
+            raise AssertionException("The plan file %s is damaged: %s" % (path, e))
+        return plan
@@ -20,15 +20,18 @@
 # SOFTWARE.
 
 import logging
+import multiprocessing
 import six
 import re
+import zlib
 from itertools import chain
 
 import user_sync.connector.umapi
 import user_sync.error
 import user_sync.identity_type
 from collections import defaultdict
-from user_sync.helper import normalize_string, CSVAdapter, JobStats
+from user_sync.connector.helper import UserRecordCompactor
+from user_sync.helper import normalize_string, normalization_cache, CSVAdapter, ExclusionMatcher, JobStats
 
 GROUP_NAME_DELIMITER = '::'
 PRIMARY_UMAPI_NAME = None
@@ -40,8 +43,13 @@ class RuleProcessor(object):
     default_options = {
         'adobe_group_filter': None,
         'after_mapping_hook': None,
+        'after_mapping_hook_batch_size': 1000,
+        'after_mapping_hook_module': None,
+        'after_mapping_hook_processes': 1,
         'default_country_code': None,
         'delete_strays': False,
+        'diff_batch_size': 20000,
+        'diff_processes': 1,
         'directory_group_filter': None,
         'disentitle_strays': False,
         'exclude_groups': [],
@@ -49,10 +57,14 @@ class RuleProcessor(object):
         'exclude_strays': False,
         'exclude_users': [],
         'extended_attributes': None,
+        'group_diff_engine': 'sets',
         'process_groups': False,
         'max_adobe_only_users': 200,
         'new_account_type': user_sync.identity_type.ENTERPRISE_IDENTITY_TYPE,
+        'normalization_cache_size': normalization_cache.default_max_size,
+        'plan_only': False,
         'remove_strays': False,
+        'selected_usernames': None,
         'strategy': 'sync',
         'stray_list_input_path': None,
         'stray_list_output_path': None,
@@ -61,6 +73,9 @@ class RuleProcessor(object):
         'username_filter_regex': None,
     }
 
+    # the fields of an adobe user that are sent to the processes comparing users
+    user_diff_fields = ('type', 'email', 'username', 'domain', 'groups', 'firstname', 'lastname')
+
     def __init__(self, caller_options):
         """
         :type caller_options:dict
@@ -68,9 +83,21 @@ class RuleProcessor(object):
         options = dict(self.default_options)
         options.update(caller_options)
         self.options = options
+        normalization_cache.resize(options['normalization_cache_size'])
+        # every user key is interned here, so the collections below share one string per user
+        self.user_key_table = UserKeyTable()
         self.directory_user_by_user_key = {}
         self.filtered_directory_user_by_user_key = {}
+        # keys of the directory users that changed since the directory connector's last commit;
+        # None means that any of them might have changed
+        self.changed_user_keys = None
         self.umapi_info_by_name = {}
+        # the additional groups given by each member group that has been seen
+        self.additional_groups_by_member_group = {}
+        # with --users keys, only these users (by username or email) are synced
+        self.selected_usernames = None
+        if options['selected_usernames'] is not None:
+            self.selected_usernames = set(options['selected_usernames'])
         # counters for action summary log
         self.action_summary = {
             # these are in alphabetical order!  Always add new ones that way!
@@ -91,6 +118,8 @@ class RuleProcessor(object):
         self.exclude_groups = self.normalize_groups(options['exclude_groups'])
         self.exclude_identity_types = options['exclude_identity_types']
         self.exclude_users = options['exclude_users']
+        if not isinstance(self.exclude_users, ExclusionMatcher):
+            self.exclude_users = ExclusionMatcher(self.exclude_users)
 
         # There's a big difference between how we handle the primary umapi,
         # and how we handle secondary umapis.  We care about all the (non-excluded)
@@ -152,10 +181,19 @@ class RuleProcessor(object):
             'hook_storage': None,
         }
 
+        # the hook module, for hook code written as functions rather than a code block
+        self.after_mapping_hook_module = None
+        if options['after_mapping_hook_module'] is not None:
+            self.after_mapping_hook_module = load_after_mapping_hook_module(options['after_mapping_hook_module'])
+
         # map of username to email address for users that have an email-type username that
         # differs from the user's email address
         self.email_override = {}  # type: dict[str, str]
 
+        # users are kept as compact records; source attributes are only needed by hook code
+        has_hook = options['after_mapping_hook'] is not None or options['after_mapping_hook_module'] is not None
+        self.record_compactor = UserRecordCompactor(keep_source_attributes=has_hook)
+
         if logger.isEnabledFor(logging.DEBUG):
             options_to_report = options.copy()
             username_filter_regex = options_to_report['username_filter_regex']
@@ -181,6 +219,7 @@ class RuleProcessor(object):
             load_directory_stats.log_end(logger)
 
         for umapi_info in self.umapi_info_by_name.values():
+            umapi_info.finalize_desired_groups()
             self.validate_and_log_additional_groups(umapi_info)
 
         umapi_stats = JobStats('Push to UMAPI' if self.push_umapi else 'Sync with UMAPI', divider="-")
@@ -196,6 +235,44 @@ class RuleProcessor(object):
         umapi_connectors.execute_actions()
         umapi_stats.log_end(logger)
         self.log_action_summary(umapi_connectors)
+        if directory_connector is not None:
+            self.commit_directory_changes(directory_connector, umapi_connectors)
+
+    def commit_directory_changes(self, directory_connector, umapi_connectors):
+        """
+        Let the directory connector know that its users are in sync, but only if this was a live run
+        of all the users that updated user info (so unchanged users have nothing left to update) and had no errors.
+        :type directory_connector: user_sync.connector.directory.DirectoryConnector
+        :type umapi_connectors: UmapiConnectors
+        """
+        if self.options['test_mode'] or not self.options['update_user_info'] or self.push_umapi:
+            return
+        if self.options['plan_only']:
+            return
+        if self.is_comparison_limited():
+            self.logger.debug('Not committing directory changes: only some of the users were compared')
+            return
+        connectors = [umapi_connectors.get_primary_connector()]
+        connectors.extend(six.itervalues(umapi_connectors.get_secondary_connectors()))
+        for umapi_connector in connectors:
+            _sent, errors = umapi_connector.get_action_manager().get_statistics()
+            if errors:
+                self.logger.debug('Not committing directory changes: there were UMAPI errors')
+                return
+        directory_connector.commit()
+
+    def is_comparison_limited(self):
+        """
+        Whether a user or group filter kept some of the directory or Adobe users out of this run,
+        so the users the directory connector read weren't all compared.
+        :rtype bool
+        """
+        options = self.options
+        return (self.selected_usernames is not None or
+                options['username_filter_regex'] is not None or
+                options['directory_group_filter'] is not None or
+                options['adobe_group_filter'] is not None or
+                options['stray_list_input_path'] is not None)
 
     def validate_and_log_additional_groups(self, umapi_info):
         """
@@ -281,6 +358,7 @@ class RuleProcessor(object):
 
         # prepare the network summary
         umapi_summary_format = 'Number of%s%s UMAPI actions sent (total, success, error)'
+        umapi_retry_format = 'Number of%s%s UMAPI successes after a batch was retried'
         if umapi_connectors.get_secondary_connectors():
             spacer = ' '
             connectors = [('primary', umapi_connectors.get_primary_connector())]
@@ -295,13 +373,17 @@ class RuleProcessor(object):
         for action_description in action_summary_description:
             if len(action_description[1]) > pad:
                 pad = len(action_description[1])
-        for name, _ in connectors:
+        for name, umapi_connector in connectors:
             umapi_summary_description = umapi_summary_format % (spacer, name)
             if len(umapi_summary_description) > pad:
                 pad = len(umapi_summary_description)
+            if umapi_connector.get_action_manager().get_retried_count():
+                pad = max(pad, len(umapi_retry_format % (spacer, name)))
 
         # do the report
-        if self.options['test_mode']:
+        if self.options['plan_only']:
+            header = '---- Action Summary (PLAN) ---'
+        elif self.options['test_mode']:
             header = '- Action Summary (TEST MODE) -'
         else:
             header = '------- Action Summary -------'
@@ -314,6 +396,14 @@ class RuleProcessor(object):
             sent, errors = umapi_connector.get_action_manager().get_statistics()
             description = (umapi_summary_format % (spacer, name)).rjust(pad, ' ')
             logger.info('  %s: (%s, %s, %s)', description, sent, sent - errors, errors)
+            retried = umapi_connector.get_action_manager().get_retried_count()
+            if retried:
+                description = (umapi_retry_format % (spacer, name)).rjust(pad, ' ')
+                logger.info('  %s: %s', description, retried)
+        if logger.isEnabledFor(logging.DEBUG):
+            hits, misses, size = normalization_cache.get_statistics()
+            description = 'Name normalization cache (hits, misses, size)'.rjust(pad, ' ')
+            logger.debug('  %s: (%s, %s, %s)', description, hits, misses, size)
         logger.info('------------------------------------------------------------------------------------')
 
     def is_primary_org(self, umapi_info):
@@ -361,81 +451,91 @@ class RuleProcessor(object):
         directory_groups = set(six.iterkeys(mappings)) if self.will_process_groups() else set()
         if directory_group_filter is not None:
             directory_groups.update(directory_group_filter)
+        # a connector kept from an earlier run may still have that run's selection, so it is always set
+        if directory_connector.select_users(options['selected_usernames']):
+            self.logger.debug('Directory searches limited to the %d selected users', len(self.selected_usernames))
         directory_users = directory_connector.load_users_and_groups(groups=directory_groups,
                                                                     extended_attributes=extended_attributes,
                                                                     all_users=directory_group_filter is None)
+        changed_users = directory_connector.get_changed_users()
+        if changed_users is not None:
+            # keys are taken before any hook code can change the users
+            self.changed_user_keys = set(self.get_directory_user_key(user) for user in changed_users)
+            self.logger.debug('Directory users changed since last sync: %d', len(self.changed_user_keys))
+
+        # with a hook module, the users are mapped in batches, and their groups are added after each batch
+        hook_module = self.after_mapping_hook_module
+        hook_batch = []
+        hook_batch_limit = options['after_mapping_hook_batch_size'] * options['after_mapping_hook_processes']
+        hook_pool = None
+        if hook_module is not None and options['after_mapping_hook_processes'] > 1:
+            hook_pool = multiprocessing.Pool(options['after_mapping_hook_processes'],
+                                             initializer=init_after_mapping_hook_worker,
+                                             initargs=(options['after_mapping_hook_module'],))
+        try:
+            for directory_user in directory_users:
+                user_key = self.get_directory_user_key(directory_user)
+                if not user_key:
+                    self.logger.warning("Ignoring directory user with empty user key: %s", directory_user)
+                    continue
+                directory_user = self.record_compactor.compact_directory_user(directory_user)
+                directory_user_by_user_key[user_key] = directory_user
 
-        for directory_user in directory_users:
-            user_key = self.get_directory_user_key(directory_user)
-            if not user_key:
-                self.logger.warning("Ignoring directory user with empty user key: %s", directory_user)
-                continue
-            directory_user_by_user_key[user_key] = directory_user
+                if not self.is_directory_user_in_groups(directory_user, directory_group_filter):
+                    continue
+                if not self.is_selected_user_key(user_key):
+                    continue
+                if not self.is_selected_directory_user(directory_user):
+                    continue
 
-            if not self.is_directory_user_in_groups(directory_user, directory_group_filter):
-                continue
-            if not self.is_selected_user_key(user_key):
-                continue
+                filtered_directory_user_by_user_key[user_key] = directory_user
+                self.get_umapi_info(PRIMARY_UMAPI_NAME).add_desired_group_for(user_key, None)
+
+                # set up groups for the hook; the target groups will be used whether or not there's customer hook code
+                source_groups = set()
+                target_groups = set()
+                for group in directory_user['groups']:
+                    source_groups.add(group)  # this is a directory group name
+                    adobe_groups = mappings.get(group)
+                    if adobe_groups is not None:
+                        for adobe_group in adobe_groups:
+                            target_groups.add(adobe_group.get_qualified_name())
+
+                # only if there actually is hook code: set up rest of hook scope, invoke hook, update user attributes
+                if options['after_mapping_hook'] is not None:
+                    self.after_mapping_hook_scope['source_groups'] = source_groups
+                    self.after_mapping_hook_scope['target_groups'] = target_groups
+                    self.after_mapping_hook_scope['source_attributes'] = directory_user['source_attributes'].copy()
+                    self.after_mapping_hook_scope['target_attributes'] = self.get_target_attributes(directory_user)
+
+                    # invoke the customer's hook code
+                    self.log_after_mapping_hook_scope(before_call=True)
+                    exec(options['after_mapping_hook'], self.after_mapping_hook_scope)
+                    self.log_after_mapping_hook_scope(after_call=True)
+
+                    # copy modified attributes back to the user object
+                    directory_user.update(self.after_mapping_hook_scope['target_attributes'])
+                    target_groups = self.after_mapping_hook_scope['target_groups']
+                elif hook_module is not None:
+                    hook_user = {
+                        'source_attributes': directory_user['source_attributes'],
+                        'source_groups': source_groups,
+                        'target_attributes': self.get_target_attributes(directory_user),
+                        'target_groups': target_groups,
+                    }
+                    hook_batch.append((user_key, directory_user, hook_user))
+                    if len(hook_batch) >= hook_batch_limit:
+                        self.map_user_batch(hook_batch, hook_pool)
+                        hook_batch = []
+                    continue
 
-            filtered_directory_user_by_user_key[user_key] = directory_user
-            self.get_umapi_info(PRIMARY_UMAPI_NAME).add_desired_group_for(user_key, None)
-
-            # set up groups in hook scope; the target groups will be used whether or not there's customer hook code
-            self.after_mapping_hook_scope['source_groups'] = set()
-            self.after_mapping_hook_scope['target_groups'] = set()
-            for group in directory_user['groups']:
-                self.after_mapping_hook_scope['source_groups'].add(group)  # this is a directory group name
-                adobe_groups = mappings.get(group)
-                if adobe_groups is not None:
-                    for adobe_group in adobe_groups:
-                        self.after_mapping_hook_scope['target_groups'].add(adobe_group.get_qualified_name())
-
-            # only if there actually is hook code: set up rest of hook scope, invoke hook, update user attributes
-            if options['after_mapping_hook'] is not None:
-                self.after_mapping_hook_scope['source_attributes'] = directory_user['source_attributes'].copy()
-
-                target_attributes = dict()
-                target_attributes['email'] = directory_user.get('email')
-                target_attributes['username'] = directory_user.get('username')
-                target_attributes['domain'] = directory_user.get('domain')
-                target_attributes['firstname'] = directory_user.get('firstname')
-                target_attributes['lastname'] = directory_user.get('lastname')
-                target_attributes['country'] = directory_user.get('country')
-                self.after_mapping_hook_scope['target_attributes'] = target_attributes
-
-                # invoke the customer's hook code
-                self.log_after_mapping_hook_scope(before_call=True)
-                exec(options['after_mapping_hook'], self.after_mapping_hook_scope)
-                self.log_after_mapping_hook_scope(after_call=True)
-
-                # copy modified attributes back to the user object
-                directory_user.update(self.after_mapping_hook_scope['target_attributes'])
-
-            for target_group_qualified_name in self.after_mapping_hook_scope['target_groups']:
-                target_group = AdobeGroup.lookup(target_group_qualified_name)
-                if target_group is not None:
-                    umapi_info = self.get_umapi_info(target_group.get_umapi_name())
-                    umapi_info.add_desired_group_for(user_key, target_group.get_group_name())
-                else:
-                    self.logger.error('Target adobe group %s is not known; ignored', target_group_qualified_name)
-
-            additional_groups = self.options.get('additional_groups', [])
-            member_groups = directory_user.get('member_groups', [])
-            for member_group in member_groups:
-                for group_rule in additional_groups:
-                    source = group_rule['source']
-                    target = group_rule['target']
-                    target_name = target.get_group_name()
-                    umapi_info = self.get_umapi_info(target.get_umapi_name())
-                    if not group_rule['source'].match(member_group):
-                        continue
-                    try:
-                        rename_group = source.sub(target_name, member_group)
-                    except Exception as e:
-                        raise user_sync.error.AssertionException("Additional group resolution error: {}".format(str(e)))
-                    umapi_info.add_mapped_group(rename_group)
-                    umapi_info.add_additional_group(rename_group, member_group)
-                    umapi_info.add_desired_group_for(user_key, rename_group)
+                self.add_target_groups(user_key, directory_user, target_groups)
+            if hook_batch:
+                self.map_user_batch(hook_batch, hook_pool)
+        finally:
+            if hook_pool is not None:
+                hook_pool.terminate()
+                hook_pool.join()
 
         self.logger.debug('Total directory users after filtering: %d', len(filtered_directory_user_by_user_key))
         if self.logger.isEnabledFor(logging.DEBUG):
@@ -443,6 +543,92 @@ class RuleProcessor(object):
                                                            for umapi_name, umapi_info
                                                            in six.iteritems(self.umapi_info_by_name)]))
 
+    @staticmethod
+    def get_target_attributes(directory_user):
+        """
+        The attributes of a directory user that hook code can change
+        :type directory_user: dict
+        :rtype dict
+        """
+        target_attributes = dict()
+        target_attributes['email'] = directory_user.get('email')
+        target_attributes['username'] = directory_user.get('username')
+        target_attributes['domain'] = directory_user.get('domain')
+        target_attributes['firstname'] = directory_user.get('firstname')
+        target_attributes['lastname'] = directory_user.get('lastname')
+        target_attributes['country'] = directory_user.get('country')
+        return target_attributes
+
+    def map_user_batch(self, hook_batch, hook_pool=None):
+        """
+        Run the after-mapping hook module on a batch of users, in the pool if there is one,
+        then update the users and their groups as the hook left them.
+        :type hook_batch: list(tuple(str, dict, dict)): the user keys, directory users and hook users
+        :type hook_pool: multiprocessing.Pool
+        """
+        hook_users = [hook_user for _, _, hook_user in hook_batch]
+        if hook_pool is None:
+            run_after_mapping_hook(self.after_mapping_hook_module, hook_users)
+        else:
+            batch_size = self.options['after_mapping_hook_batch_size']
+            chunks = [hook_users[start:start + batch_size] for start in range(0, len(hook_users), batch_size)]
+            results = chain.from_iterable(hook_pool.map(run_after_mapping_hook_chunk, chunks))
+            for hook_user, (target_attributes, target_groups) in zip(hook_users, results):
+                hook_user['target_attributes'] = target_attributes
+                hook_user['target_groups'] = target_groups
+        for user_key, directory_user, hook_user in hook_batch:
+            directory_user.update(hook_user['target_attributes'])
+            self.add_target_groups(user_key, directory_user, hook_user['target_groups'])
+
+    def add_target_groups(self, user_key, directory_user, target_groups):
+        """
+        Add the mapped groups of a directory user, and the groups its member groups give, to its desired groups
+        :type user_key: str
+        :type directory_user: dict
+        :type target_groups: set(str): qualified adobe group names
+        """
+        for target_group_qualified_name in target_groups:
+            target_group = AdobeGroup.lookup(target_group_qualified_name)
+            if target_group is not None:
+                umapi_info = self.get_umapi_info(target_group.get_umapi_name())
+                umapi_info.add_desired_group_for(user_key, target_group.get_group_name())
+            else:
+                self.logger.error('Target adobe group %s is not known; ignored', target_group_qualified_name)
+
+        member_groups = directory_user.get('member_groups', [])
+        for member_group in member_groups:
+            for umapi_info, rename_group in self.get_additional_groups_for(member_group):
+                umapi_info.add_desired_group_for(user_key, rename_group)
+
+    def get_additional_groups_for(self, member_group):
+        """
+        Evaluate the additional_groups rules for a directory member group.  Many users share each
+        member group, so the rules are only evaluated the first time the group is seen: that is also
+        when the renamed groups are mapped and recorded for conflict detection.
+        :type member_group: str
+        :rtype list(tuple(UmapiTargetInfo, str)): the umapis and the names of the groups the member group gives
+        """
+        additional_groups = self.additional_groups_by_member_group.get(member_group)
+        if additional_groups is not None:
+            return additional_groups
+        additional_groups = []
+        for group_rule in self.options.get('additional_groups', []):
+            source = group_rule['source']
+            target = group_rule['target']
+            target_name = target.get_group_name()
+            umapi_info = self.get_umapi_info(target.get_umapi_name())
+            if not source.match(member_group):
+                continue
+            try:
+                rename_group = source.sub(target_name, member_group)
+            except Exception as e:
+                raise user_sync.error.AssertionException("Additional group resolution error: {}".format(str(e)))
+            umapi_info.add_mapped_group(rename_group)
+            umapi_info.add_additional_group(rename_group, member_group)
+            additional_groups.append((umapi_info, rename_group))
+        self.additional_groups_by_member_group[member_group] = additional_groups
+        return additional_groups
+
     def is_directory_user_in_groups(self, directory_user, groups):
         """
         :type directory_user: dict
@@ -526,11 +712,11 @@ class RuleProcessor(object):
             mapped_groups = umapi_info.get_non_normalize_mapped_groups()
 
             # pull all user groups from console
-            on_adobe_groups = [normalize_string(g['groupName']) for g in umapi_connector.get_groups()]
+            on_adobe_groups = [normalization_cache.normalize(g['groupName']) for g in umapi_connector.get_groups()]
 
             # verify if group exist and create
             for mapped_group in mapped_groups:
-                if normalize_string(mapped_group) in on_adobe_groups:
+                if normalization_cache.normalize(mapped_group) in on_adobe_groups:
                     continue
                 self.logger.info("Auto create user-group enabled: Creating '{}' on '{}'".format(
                     mapped_group, umapi_name if umapi_name else 'primary org'))
@@ -554,6 +740,35 @@ class RuleProcessor(object):
                 return False
         return True
 
+    def is_selected_directory_user(self, directory_user):
+        """
+        :type directory_user: dict
+        """
+        if self.selected_usernames is None:
+            return True
+        return (normalize_string(directory_user.get('username')) in self.selected_usernames or
+                normalize_string(directory_user.get('email')) in self.selected_usernames)
+
+    def iter_selected_umapi_users(self, umapi_connector):
+        """
+        Fetch the selected users one at a time, rather than reading the whole org: first the ones
+        found in the directory, then any other selected names that are emails, as those may be
+        Adobe-only users.
+        :type umapi_connector: user_sync.connector.umapi.UmapiConnector
+        """
+        emails = [directory_user.get('email') or directory_user.get('username')
+                  for directory_user in six.itervalues(self.filtered_directory_user_by_user_key)]
+        emails.extend(self.options['selected_usernames'])
+        fetched = set()
+        for email in emails:
+            if not email or '@' not in email or normalize_string(email) in fetched:
+                continue
+            fetched.add(normalize_string(email))
+            umapi_user = umapi_connector.get_user(email)
+            if umapi_user is not None:
+                yield umapi_user
+        self.logger.debug('Fetched %d selected users from %s', len(fetched), umapi_connector.name)
+
     def get_stray_keys(self, umapi_name=PRIMARY_UMAPI_NAME):
         return self.stray_key_map.get(umapi_name, {})
 
@@ -845,20 +1060,36 @@ class RuleProcessor(object):
         # compute all static options before looping over users
         in_primary_org = self.is_primary_org(umapi_info)
         update_user_info = self.will_update_user_info(umapi_info)
-        process_groups = self.will_process_groups()
+        group_engine = None
+        if self.options['group_diff_engine'] == 'bitset':
+            group_engine = GroupBitsetEngine(umapi_info, self.exclude_groups)
+            get_group_changes = group_engine.get_group_set_changes
+        else:
+            get_group_changes = umapi_info.get_group_changes
+        settings = UserDiffSettings(in_primary_org, self.exclude_identity_types, self.exclude_groups,
+                                    self.exclude_users, None if in_primary_org else self.included_user_keys,
+                                    update_user_info, self.will_process_groups(), self.changed_user_keys)
 
         # prepare the strays map if we are going to be processing them
         if self.will_process_strays:
             self.add_stray(umapi_info.get_name(), None)
 
-        if self.options['adobe_group_filter'] is not None:
+        if self.selected_usernames is not None:
+            umapi_users = self.iter_selected_umapi_users(umapi_connector)
+        elif self.options['adobe_group_filter'] is not None:
             umapi_users = self.get_umapi_user_in_groups(umapi_info, umapi_connector, self.options['adobe_group_filter'])
         else:
             umapi_users = umapi_connector.iter_users()
+
+        if self.options['diff_processes'] > 1:
+            self.compare_umapi_users_in_shards(umapi_info, umapi_connector, umapi_users, settings, user_to_group_map)
+            umapi_info.set_umapi_users_loaded()
+            return user_to_group_map
+
         # Walk all the adobe users, getting their group data, matching them with directory users,
         # and adjusting their attribute and group data accordingly.
         for umapi_user in umapi_users:
-            # get the basic data about this user; initialize change markers to "no change"
+            # get the basic data about this user
             user_key = self.get_umapi_user_key(umapi_user)
             if not user_key:
                 self.logger.warning("Ignoring umapi user with empty user key: %s", umapi_user)
@@ -866,56 +1097,187 @@ class RuleProcessor(object):
             if umapi_info.get_umapi_user(user_key) is not None:
                 self.logger.debug("Ignoring umapi user. This user has already been processed: %s", umapi_user)
                 continue
-            umapi_info.add_umapi_user(user_key, umapi_user)
-            attribute_differences = {}
-            current_groups = self.normalize_groups(umapi_user.get('groups'))
-            groups_to_add = set()
-            groups_to_remove = set()
+            umapi_info.add_umapi_user(user_key, self.record_compactor.compact_umapi_user(umapi_user))
+            if group_engine is not None:
+                current_groups = group_engine.decode(group_engine.encode_groups(umapi_user.get('groups')))
+            else:
+                current_groups = umapi_info.get_group_set(self.normalize_groups(umapi_user.get('groups')))
 
             # If this adobe user matches any directory user, pop them out of the
             # map because we know they don't need to be created.
             # Also, keep track of the mapped groups for the directory user
             # so we can update the adobe user's groups as needed.
-            desired_groups = user_to_group_map.pop(user_key, None) or set()
-
-            # check for excluded users
-            if self.is_umapi_user_excluded(in_primary_org, user_key, current_groups):
-                continue
-
-            self.map_email_override(umapi_user)
-
+            desired_groups = user_to_group_map.pop(user_key, None) or umapi_info.get_group_set(())
             directory_user = filtered_directory_user_by_user_key.get(user_key)
             if directory_user is None:
-                # There's no selected directory user matching this adobe user
-                # so we mark this adobe user as a stray, and we mark him
-                # for removal from any mapped groups.
-                if self.exclude_strays:
-                    self.logger.debug("Excluding Adobe-only user: %s", user_key)
-                    self.excluded_user_count += 1
-                elif self.will_process_strays:
-                    self.logger.debug("Found Adobe-only user: %s", user_key)
-                    self.add_stray(umapi_info.get_name(), user_key,
-                                   None if not process_groups else current_groups & umapi_info.get_mapped_groups())
+                directory_attributes = None
+            elif update_user_info:
+                directory_attributes = self.get_user_attributes(directory_user)
             else:
-                # There is a selected directory user who matches this adobe user,
-                # so mark any changed umapi attributes,
-                # and mark him for addition and removal of the appropriate mapped groups
-                if update_user_info or process_groups:
-                    self.logger.debug("Adobe user matched on customer side: %s", user_key)
-                if update_user_info:
-                    attribute_differences = self.get_user_attribute_difference(directory_user, umapi_user)
-                if process_groups:
-                    groups_to_add = desired_groups - current_groups
-                    groups_to_remove = (current_groups - desired_groups) & umapi_info.get_mapped_groups()
-
-            # Finally, execute the attribute and group adjustments
-            self.update_umapi_user(umapi_info, user_key, umapi_connector,
-                                   attribute_differences, groups_to_add, groups_to_remove, umapi_user)
+                directory_attributes = {}
+
+            result = compare_umapi_user(settings, get_group_changes, user_key, self.parse_user_key(user_key),
+                                        current_groups, desired_groups, directory_attributes, umapi_user)
+            self.apply_umapi_user_comparison(umapi_info, umapi_connector, user_key, umapi_user,
+                                             current_groups, result)
 
         # mark the umapi's adobe users as processed and return the remaining ones in the map
         umapi_info.set_umapi_users_loaded()
         return user_to_group_map
 
+    def compare_umapi_users_in_shards(self, umapi_info, umapi_connector, umapi_users, settings, user_to_group_map):
+        """
+        Compare the adobe users in diff_processes worker processes, each of which holds the directory users
+        whose keys hash to its shard.  The adobe users are read here and sent in batches to the shard
+        their username hashes to, and the workers work out their keys, groups and differences.  The results
+        of each batch are applied in the order the users were read, so the commands sent are the same
+        as when comparing in this process.
+        :type umapi_info: UmapiTargetInfo
+        :type umapi_connector: user_sync.connector.umapi.UmapiConnector
+        :type umapi_users: iterable(dict)
+        :type settings: UserDiffSettings
+        :type user_to_group_map: dict(str, frozenset(str)): the users not found yet, popped as they are found
+        """
+        shards = self.make_user_diff_shards(umapi_info, settings)
+        pools = [multiprocessing.Pool(1, initializer=init_user_diff_worker, initargs=(shard,)) for shard in shards]
+        try:
+            batch = []
+            for umapi_user in umapi_users:
+                if umapi_user.get('type') is None:
+                    # log the missing type here, the workers only use the default
+                    self.get_identity_type_from_umapi_user(umapi_user)
+                batch.append(umapi_user)
+                if len(batch) >= self.options['diff_batch_size']:
+                    self.compare_umapi_user_batch(pools, batch, umapi_info, umapi_connector, user_to_group_map)
+                    batch = []
+            if batch:
+                self.compare_umapi_user_batch(pools, batch, umapi_info, umapi_connector, user_to_group_map)
+        finally:
+            for pool in pools:
+                pool.terminate()
+                pool.join()
+
+    def make_user_diff_shards(self, umapi_info, settings):
+        """
+        Split the directory users selected for a umapi into diff_processes shards by the username in their keys.
+        :type umapi_info: UmapiTargetInfo
+        :type settings: UserDiffSettings
+        :rtype list(UserDiffShard)
+        """
+        shard_count = self.options['diff_processes']
+
+        def get_shard(user_key):
+            return get_user_key_shard(self.parse_user_key(user_key)[1], shard_count)
+
+        def split_keys(user_keys):
+            if user_keys is None:
+                return [None] * shard_count
+            keys_by_shard = [set() for _ in range(shard_count)]
+            for user_key in user_keys:
+                keys_by_shard[get_shard(user_key)].add(user_key)
+            return keys_by_shard
+
+        mapped_groups = frozenset(umapi_info.get_mapped_groups())
+        shards = []
+        for included_user_keys, changed_user_keys in zip(split_keys(settings.included_user_keys),
+                                                         split_keys(settings.changed_user_keys)):
+            shard_settings = UserDiffSettings(settings.in_primary_org, settings.exclude_identity_types,
+                                              settings.exclude_groups, settings.exclude_users, included_user_keys,
+                                              settings.update_user_info, settings.process_groups, changed_user_keys)
+            shards.append(UserDiffShard(shard_settings, self.options['new_account_type'], mapped_groups))
+        desired_groups_by_user_key = umapi_info.get_desired_groups_by_user_key() or {}
+        for user_key, desired_groups in six.iteritems(desired_groups_by_user_key):
+            shards[get_shard(user_key)].desired_groups_by_user_key[user_key] = desired_groups
+        for user_key, directory_user in six.iteritems(self.filtered_directory_user_by_user_key):
+            attributes = self.get_user_attributes(directory_user) if settings.update_user_info else {}
+            shards[get_shard(user_key)].directory_attributes_by_user_key[user_key] = attributes
+        return shards
+
+    def compare_umapi_user_batch(self, pools, umapi_users, umapi_info, umapi_connector, user_to_group_map):
+        """
+        Send each adobe user in a batch to its shard's worker, and apply the results in the batch's order.
+        :type pools: list(multiprocessing.Pool): one single-process pool for each shard
+        :type umapi_users: list(dict)
+        :type umapi_info: UmapiTargetInfo
+        :type umapi_connector: user_sync.connector.umapi.UmapiConnector
+        :type user_to_group_map: dict(str, frozenset(str))
+        """
+        records_by_shard = [[] for _ in pools]
+        for position, umapi_user in enumerate(umapi_users):
+            shard = get_user_key_shard(get_umapi_user_shard_username(umapi_user), len(pools))
+            record = dict((field, umapi_user.get(field)) for field in self.user_diff_fields)
+            records_by_shard[shard].append((position, record))
+        pending = [pool.apply_async(compare_umapi_user_shard, (records,))
+                   for pool, records in zip(pools, records_by_shard) if records]
+        comparisons = [None] * len(umapi_users)
+        for async_result in pending:
+            for position, comparison in async_result.get():
+                comparisons[position] = comparison
+
+        for umapi_user, comparison in zip(umapi_users, comparisons):
+            if comparison is None:
+                self.logger.warning("Ignoring umapi user with empty user key: %s", umapi_user)
+                continue
+            parsed_key, current_groups, result = comparison
+            user_key = self.user_key_table.intern(parsed_key)
+            if umapi_info.get_umapi_user(user_key) is not None:
+                self.logger.debug("Ignoring umapi user. This user has already been processed: %s", umapi_user)
+                continue
+            umapi_info.add_umapi_user(user_key, self.record_compactor.compact_umapi_user(umapi_user))
+            user_to_group_map.pop(user_key, None)
+            self.apply_umapi_user_comparison(umapi_info, umapi_connector, user_key, umapi_user,
+                                             current_groups, result)
+
+    def apply_umapi_user_comparison(self, umapi_info, umapi_connector, user_key, umapi_user, current_groups,
+                                    result):
+        """
+        Act on the result of compare_umapi_user: count and log exclusions, record strays,
+        and send the attribute and group changes.
+        :type umapi_info: UmapiTargetInfo
+        :type umapi_connector: user_sync.connector.umapi.UmapiConnector
+        :type user_key: str
+        :type umapi_user: dict
+        :type current_groups: frozenset(str)
+        :type result: tuple(str, dict, set, set)
+        """
+        outcome, attribute_differences, groups_to_add, groups_to_remove = result
+        in_primary_org = self.is_primary_org(umapi_info)
+        if in_primary_org:
+            self.primary_user_count += 1
+
+        # check for excluded users
+        if outcome in EXCLUSION_REASONS:
+            self.logger.debug("Excluding adobe user (due to %s): %s", outcome, user_key)
+            self.excluded_user_count += 1
+            return
+        if outcome == USER_UNMATCHED:
+            # in all other umapis, we exclude every user that
+            #  doesn't match an included user from the primary umapi
+            return
+        if in_primary_org:
+            self.included_user_keys.add(user_key)
+
+        self.map_email_override(umapi_user)
+
+        if outcome == USER_STRAY:
+            # There's no selected directory user matching this adobe user
+            # so we mark this adobe user as a stray, and we mark him
+            # for removal from any mapped groups.
+            if self.exclude_strays:
+                self.logger.debug("Excluding Adobe-only user: %s", user_key)
+                self.excluded_user_count += 1
+            elif self.will_process_strays:
+                self.logger.debug("Found Adobe-only user: %s", user_key)
+                self.add_stray(umapi_info.get_name(), user_key,
+                               None if not self.will_process_groups()
+                               else current_groups & umapi_info.get_mapped_groups())
+        elif self.will_update_user_info(umapi_info) or self.will_process_groups():
+            self.logger.debug("Adobe user matched on customer side: %s", user_key)
+
+        # Finally, execute the attribute and group adjustments
+        self.update_umapi_user(umapi_info, user_key, umapi_connector,
+                               attribute_differences, groups_to_add, groups_to_remove, umapi_user)
+
     def map_email_override(self, umapi_user):
         """
         for users with email-type usernames that don't match the email address, we need to add some
@@ -936,31 +1298,6 @@ class RuleProcessor(object):
                 umapi_users_iters.append(umapi_connector.iter_users(in_group=group.get_group_name()))
         return chain.from_iterable(umapi_users_iters)
 
-    def is_umapi_user_excluded(self, in_primary_org, user_key, current_groups):
-        if in_primary_org:
-            self.primary_user_count += 1
-            # in the primary umapi, we actually check the exclusion conditions
-            identity_type, username, domain = self.parse_user_key(user_key)
-            if identity_type in self.exclude_identity_types:
-                self.logger.debug("Excluding adobe user (due to type): %s", user_key)
-                self.excluded_user_count += 1
-                return True
-            if len(current_groups & self.exclude_groups) > 0:
-                self.logger.debug("Excluding adobe user (due to group): %s", user_key)
-                self.excluded_user_count += 1
-                return True
-            for re_ in self.exclude_users:
-                if re_.match(username):
-                    self.logger.debug("Excluding adobe user (due to name): %s", user_key)
-                    self.excluded_user_count += 1
-                    return True
-            self.included_user_keys.add(user_key)
-            return False
-        else:
-            # in all other umapis, we exclude every user that
-            #  doesn't match an included user from the primary umapi
-            return user_key not in self.included_user_keys
-
     @staticmethod
     def normalize_groups(group_names):
         """
@@ -970,23 +1307,13 @@ class RuleProcessor(object):
         result = set()
         if group_names is not None:
             for group_name in group_names:
-                normalized_group_name = normalize_string(group_name)
+                normalized_group_name = normalization_cache.normalize(group_name)
                 result.add(normalized_group_name)
         return result
 
 
     def get_user_attribute_difference(self, directory_user, umapi_user):
-        differences = {}
-        attributes = self.get_user_attributes(directory_user)
-        for key, value in six.iteritems(attributes):
-            umapi_value = umapi_user.get(key)
-            if key == 'email':
-                diff = normalize_string(value) != normalize_string(umapi_value)
-            else:
-                diff = value != umapi_value
-            if diff:
-                differences[key] = value
-        return differences
+        return get_attribute_difference(self.get_user_attributes(directory_user), umapi_user)
 
     def get_directory_user_key(self, directory_user):
         """
@@ -1002,10 +1329,8 @@ class RuleProcessor(object):
         :type umapi_user: dict
         """
         id_type = self.get_identity_type_from_umapi_user(umapi_user)
-        if id_type == user_sync.identity_type.ADOBEID_IDENTITY_TYPE:
-            return self.get_user_key(id_type, '', '', umapi_user['email'])
-        else:
-            return self.get_user_key(id_type, umapi_user['username'], umapi_user['domain'], umapi_user['email'])
+        parsed_key = get_umapi_user_key_parts(umapi_user, id_type)
+        return None if parsed_key is None else self.user_key_table.intern(parsed_key)
 
     def get_user_key(self, id_type, username, domain, email=None):
         """
@@ -1020,20 +1345,8 @@ class RuleProcessor(object):
         :return: string "id_type,username,domain" (or None)
         :rtype: str
         """
-        id_type = user_sync.identity_type.parse_identity_type(id_type)
-        email = normalize_string(email) if email else None
-        username = normalize_string(username) or email
-        domain = normalize_string(domain)
-
-        if not id_type:
-            return None
-        if not username:
-            return None
-        if username.find('@') >= 0:
-            domain = ""
-        elif not domain:
-            return None
-        return six.text_type(id_type) + u',' + six.text_type(username) + u',' + six.text_type(domain)
+        parsed_key = get_user_key_parts(id_type, username, domain, email)
+        return None if parsed_key is None else self.user_key_table.intern(parsed_key)
 
     def parse_user_key(self, user_key):
         """
@@ -1041,7 +1354,7 @@ class RuleProcessor(object):
         The domain part is empty except if the username is not an email address.
         :rtype: tuple
         """
-        return user_key.split(',')
+        return self.user_key_table.parse(user_key)
 
     def get_username_from_user_key(self, user_key):
         return self.parse_user_key(user_key)[1]
@@ -1133,6 +1446,310 @@ class RuleProcessor(object):
             self.logger.debug('Hook storage, %s: %s', when, self.after_mapping_hook_scope['hook_storage'])
 
 
+# the outcomes of compare_umapi_user
+USER_EXCLUDED_BY_TYPE = 'type'
+USER_EXCLUDED_BY_GROUP = 'group'
+USER_EXCLUDED_BY_NAME = 'name'
+EXCLUSION_REASONS = (USER_EXCLUDED_BY_TYPE, USER_EXCLUDED_BY_GROUP, USER_EXCLUDED_BY_NAME)
+USER_UNMATCHED = 'unmatched'
+USER_STRAY = 'stray'
+USER_MATCHED = 'matched'
+
+
+class UserDiffSettings(object):
+    """
+    What compare_umapi_user needs to know about the rules and the umapi being compared.
+    """
+
+    def __init__(self, in_primary_org, exclude_identity_types, exclude_groups, exclude_users, included_user_keys,
+                 update_user_info, process_groups, changed_user_keys):
+        """
+        :type in_primary_org: bool
+        :type exclude_identity_types: list(str)
+        :type exclude_groups: set(str)
+        :type exclude_users: ExclusionMatcher
+        :type included_user_keys: set(str): the included primary users, when comparing a secondary umapi
+        :type update_user_info: bool
+        :type process_groups: bool
+        :type changed_user_keys: set(str): None if any directory user might have changed
+        """
+        self.in_primary_org = in_primary_org
+        self.exclude_identity_types = exclude_identity_types
+        self.exclude_groups = exclude_groups
+        self.exclude_users = exclude_users
+        self.included_user_keys = included_user_keys
+        self.update_user_info = update_user_info
+        self.process_groups = process_groups
+        self.changed_user_keys = changed_user_keys
+
+
+def get_attribute_difference(attributes, umapi_user):
+    """
+    :type attributes: dict: the attributes of a directory user
+    :type umapi_user: dict
+    :rtype dict: the directory values of the attributes that differ
+    """
+    differences = {}
+    for key, value in six.iteritems(attributes):
+        umapi_value = umapi_user.get(key)
+        if key == 'email':
+            diff = normalize_string(value) != normalize_string(umapi_value)
+        else:
+            diff = value != umapi_value
+        if diff:
+            differences[key] = value
+    return differences
+
+
+def compare_umapi_user(settings, get_group_changes, user_key, parsed_key, current_groups, desired_groups,
+                       directory_attributes, umapi_user):
+    """
+    Compare an adobe user with the selected directory user that has the same key, if any.
+    This has no side effects: the caller acts on the result.
+    :type settings: UserDiffSettings
+    :type get_group_changes: callable(frozenset, frozenset): the group changes for the umapi
+    :type user_key: str
+    :type parsed_key: tuple(str, str, str): the identity type, username and domain in the user key
+    :type current_groups: frozenset(str)
+    :type desired_groups: frozenset(str)
+    :type directory_attributes: dict: None if there is no directory user, empty if attributes are not updated
+    :type umapi_user: dict: the adobe user, or at least its attributes
+    :rtype (str, dict, set, set): the outcome, the attributes to update, and the groups to add and remove
+    """
+    if settings.in_primary_org:
+        # in the primary umapi, we actually check the exclusion conditions
+        identity_type, username, domain = parsed_key
+        if identity_type in settings.exclude_identity_types:
+            return USER_EXCLUDED_BY_TYPE, {}, set(), set()
+        if current_groups & settings.exclude_groups:
+            return USER_EXCLUDED_BY_GROUP, {}, set(), set()
+        if settings.exclude_users.match(username):
+            return USER_EXCLUDED_BY_NAME, {}, set(), set()
+    elif user_key not in settings.included_user_keys:
+        return USER_UNMATCHED, {}, set(), set()
+
+    if directory_attributes is None:
+        return USER_STRAY, {}, set(), set()
+    attribute_differences = {}
+    groups_to_add = groups_to_remove = set()
+    if settings.update_user_info and (settings.changed_user_keys is None or user_key in settings.changed_user_keys):
+        attribute_differences = get_attribute_difference(directory_attributes, umapi_user)
+    if settings.process_groups:
+        groups_to_add, groups_to_remove = get_group_changes(desired_groups, current_groups)
+    return USER_MATCHED, attribute_differences, groups_to_add, groups_to_remove
+
+
+def get_user_key_parts(id_type, username, domain, email=None):
+    """
+    Work out the parts of the user key for a directory or adobe user, as described
+    in RuleProcessor.get_user_key.
+    :type id_type: str
+    :type username: str
+    :type domain: str
+    :type email: str
+    :rtype tuple(str, str, str): the identity type, username and domain (or None if they are invalid)
+    """
+    id_type = user_sync.identity_type.parse_identity_type(id_type)
+    email = normalize_string(email) if email else None
+    username = normalize_string(username) or email
+    domain = normalization_cache.normalize(domain)
+
+    if not id_type:
+        return None
+    if not username:
+        return None
+    if username.find('@') >= 0:
+        domain = ""
+    elif not domain:
+        return None
+    return id_type, username, domain
+
+
+def get_umapi_user_key_parts(umapi_user, id_type):
+    """
+    :type umapi_user: dict
+    :type id_type: str: the identity type of the user, or the default one if it has none
+    :rtype tuple(str, str, str): the identity type, username and domain (or None if they are invalid)
+    """
+    if id_type == user_sync.identity_type.ADOBEID_IDENTITY_TYPE:
+        return get_user_key_parts(id_type, '', '', umapi_user['email'])
+    return get_user_key_parts(id_type, umapi_user['username'], umapi_user['domain'], umapi_user['email'])
+
+
+def format_user_key(id_type, username, domain):
+    """
+    :rtype str: the user key with the given parts
+    """
+    return six.text_type(id_type) + u',' + six.text_type(username) + u',' + six.text_type(domain)
+
+
+def get_user_key_shard(username, shard_count):
+    """
+    Find the shard that compares the users with this username part in their user key.
+    It is a stable hash, so that a directory user and an adobe user with the same key
+    land in the same shard in every process.
+    :type username: str
+    :type shard_count: int
+    :rtype int
+    """
+    return zlib.crc32(username.encode('utf-8')) % shard_count
+
+
+def get_umapi_user_shard_username(umapi_user):
+    """
+    The username part of the user key of an adobe user, as far as get_user_key_shard needs it,
+    without the rest of the key derivation.  It is empty for users that have no key.
+    :type umapi_user: dict
+    :rtype str
+    """
+    username = None
+    if umapi_user.get('type') != user_sync.identity_type.ADOBEID_IDENTITY_TYPE:
+        username = normalize_string(umapi_user.get('username'))
+    return username or normalize_string(umapi_user.get('email')) or u''
+
+
+class UserDiffShard(object):
+    """
+    What a worker process needs to compare the adobe users in one shard: the settings and mapped
+    groups of the umapi, and the desired groups and attributes of just the directory users
+    whose keys fall in the shard.  It holds only plain values, so it can be sent to the worker.
+    """
+
+    def __init__(self, settings, default_identity_type, mapped_groups):
+        """
+        :type settings: UserDiffSettings: with the user key sets restricted to the shard
+        :type default_identity_type: str: used for adobe users with no identity type
+        :type mapped_groups: frozenset(str)
+        """
+        self.settings = settings
+        self.default_identity_type = default_identity_type
+        self.mapped_groups = mapped_groups
+        self.desired_groups_by_user_key = {}
+        self.directory_attributes_by_user_key = {}
+        self.group_changes = {}
+
+    def get_group_changes(self, desired_groups, current_groups):
+        """
+        The same as UmapiTargetInfo.get_group_changes, for the groups held by the shard.
+        :type desired_groups: frozenset(str)
+        :type current_groups: frozenset(str)
+        :rtype (frozenset(str), frozenset(str))
+        """
+        key = (desired_groups, current_groups)
+        changes = self.group_changes.get(key)
+        if changes is None:
+            changes = self.group_changes[key] = (desired_groups - current_groups,
+                                                 (current_groups - desired_groups) & self.mapped_groups)
+        return changes
+
+    def compare(self, umapi_user):
+        """
+        Work out the key and current groups of an adobe user, and compare it with the directory user
+        that has the same key, if any.
+        :type umapi_user: dict: the identity, group and attribute fields of the adobe user
+        :rtype (tuple(str, str, str), frozenset(str), tuple): the parsed key, the current groups, and
+            the result of compare_umapi_user (or None if the user has no key)
+        """
+        id_type = umapi_user.get('type')
+        if id_type is None:
+            id_type = self.default_identity_type
+        parsed_key = get_umapi_user_key_parts(umapi_user, id_type)
+        if parsed_key is None:
+            return None
+        user_key = format_user_key(*parsed_key)
+        current_groups = frozenset(RuleProcessor.normalize_groups(umapi_user.get('groups')))
+        desired_groups = self.desired_groups_by_user_key.get(user_key, frozenset())
+        directory_attributes = self.directory_attributes_by_user_key.get(user_key)
+        result = compare_umapi_user(self.settings, self.get_group_changes, user_key, parsed_key, current_groups,
+                                    desired_groups, directory_attributes, umapi_user)
+        return parsed_key, current_groups, result
+
+
+# the shard compared by a user diff worker process, set by init_user_diff_worker
+user_diff_shard = None
+
+
+def init_user_diff_worker(shard):
+    """
+    Initializer for the processes that compare adobe users: each holds one shard.
+    :type shard: UserDiffShard
+    """
+    global user_diff_shard
+    user_diff_shard = shard
+
+
+def compare_umapi_user_shard(records):
+    """
+    Compare a batch of the adobe users in the worker's shard.
+    :type records: list(tuple(int, dict)): the position of each user in the batch, and its fields
+    :rtype list(tuple(int, tuple)): the position of each user and the result of UserDiffShard.compare
+    """
+    return [(position, user_diff_shard.compare(umapi_user)) for position, umapi_user in records]
+
+
+def load_after_mapping_hook_module(path):
+    """
+    Load an after-mapping hook module, which must define map_user(user) or map_users(users).
+    :type path: str: the path of the module's python file
+    :rtype module
+    """
+    name = 'user_sync_after_mapping_hook'
+    try:
+        if six.PY2:
+            import imp
+            module = imp.load_source(name, path)
+        else:
+            import importlib.util
+            spec = importlib.util.spec_from_file_location(name, path)
+            module = importlib.util.module_from_spec(spec)
+            spec.loader.exec_module(module)
+    except Exception as e:
+        raise user_sync.error.AssertionException("Can't load after_mapping_hook_module %s: %s" % (path, e))
+    if not callable(getattr(module, 'map_users', None)) and not callable(getattr(module, 'map_user', None)):
+        raise user_sync.error.AssertionException("after_mapping_hook_module %s defines neither map_user nor map_users"
+                                                 % path)
+    return module
+
+
+def run_after_mapping_hook(module, hook_users):
+    """
+    Call the hook module's map_users with the whole batch if it has one, otherwise its map_user for each user.
+    The hook changes each user's target_attributes and target_groups in place.
+    :type module: module
+    :type hook_users: list(dict)
+    """
+    map_users = getattr(module, 'map_users', None)
+    if callable(map_users):
+        map_users(hook_users)
+    else:
+        map_user = module.map_user
+        for hook_user in hook_users:
+            map_user(hook_user)
+
+
+# the after-mapping hook module, in a worker process
+worker_hook_module = None
+
+
+def init_after_mapping_hook_worker(path):
+    """
+    Each worker process loads its own copy of the hook module, so its module state starts out fresh.
+    :type path: str
+    """
+    global worker_hook_module
+    worker_hook_module = load_after_mapping_hook_module(path)
+
+
+def run_after_mapping_hook_chunk(hook_users):
+    """
+    Run the hook module on a chunk of users in a worker process.
+    :type hook_users: list(dict)
+    :rtype list(tuple(dict, set)): the target attributes and target groups of each user
+    """
+    run_after_mapping_hook(worker_hook_module, hook_users)
+    return [(hook_user['target_attributes'], hook_user['target_groups']) for hook_user in hook_users]
+
+
 class UmapiConnectors(object):
     def __init__(self, primary_connector, secondary_connectors):
         """
@@ -1233,6 +1850,13 @@ class AdobeGroup(object):
     def iter_groups(cls):
         return six.itervalues(cls.index_map)
 
+    @classmethod
+    def clear_index(cls):
+        """
+        Forget all the indexed groups, before the configuration is loaded again
+        """
+        cls.index_map = {}
+
 
 class UmapiTargetInfo(object):
     def __init__(self, name):
@@ -1253,6 +1877,11 @@ class UmapiTargetInfo(object):
         # if feature is disabled, this dict will be empty
         self.additional_group_map = defaultdict(list)  # type: dict[str, list[str]]
 
+        # most users share one of a few combinations of groups, so each distinct combination
+        # is kept as one frozenset, and the group changes between two combinations are computed once
+        self.group_sets = {}  # type: dict[frozenset, frozenset]
+        self.group_changes = {}  # type: dict[tuple(frozenset, frozenset), tuple(frozenset, frozenset)]
+
     def get_name(self):
         return self.name
 
@@ -1260,12 +1889,12 @@ class UmapiTargetInfo(object):
         """
         :type group: str
         """
-        normalized_group_name = normalize_string(group)
+        normalized_group_name = normalization_cache.normalize(group)
         self.mapped_groups.add(normalized_group_name)
         self.non_normalize_mapped_groups.add(group)
 
     def add_additional_group(self, rename_group, member_group):
-        normalized_rename_group = normalize_string(rename_group)
+        normalized_rename_group = normalization_cache.normalize(rename_group)
         if member_group not in self.additional_group_map[normalized_rename_group]:
             self.additional_group_map[normalized_rename_group].append(member_group)
 
@@ -1296,10 +1925,48 @@ class UmapiTargetInfo(object):
         desired_groups = self.get_desired_groups(user_key)
         if desired_groups is None:
             self.desired_groups_by_user_key[user_key] = desired_groups = set()
+        elif isinstance(desired_groups, frozenset):
+            # the groups were finalized, so they are shared; this user needs its own set again
+            self.desired_groups_by_user_key[user_key] = desired_groups = set(desired_groups)
         if group is not None:
-            normalized_group_name = normalize_string(group)
+            normalized_group_name = normalization_cache.normalize(group)
             desired_groups.add(normalized_group_name)
 
+    def get_group_set(self, groups):
+        """
+        Get the one frozenset kept for this combination of (normalized) groups
+        :type groups: iterable(str)
+        :rtype frozenset(str)
+        """
+        groups = frozenset(groups)
+        return self.group_sets.setdefault(groups, groups)
+
+    def finalize_desired_groups(self):
+        """
+        Called when all the desired groups have been added: each user's desired groups are
+        replaced by the frozenset kept for that combination of groups.
+        """
+        desired_groups_by_user_key = self.desired_groups_by_user_key
+        for user_key, desired_groups in six.iteritems(desired_groups_by_user_key):
+            desired_groups_by_user_key[user_key] = self.get_group_set(desired_groups)
+        self.group_changes = {}
+
+    def get_group_changes(self, desired_groups, current_groups):
+        """
+        Work out the mapped groups to add and remove to take a user from the current groups to the
+        desired groups.  Both must come from get_group_set, and the results are shared between users,
+        so they must not be changed.
+        :type desired_groups: frozenset(str)
+        :type current_groups: frozenset(str)
+        :rtype (frozenset(str), frozenset(str))
+        """
+        key = (desired_groups, current_groups)
+        changes = self.group_changes.get(key)
+        if changes is None:
+            changes = self.group_changes[key] = (desired_groups - current_groups,
+                                                 (current_groups - desired_groups) & self.mapped_groups)
+        return changes
+
     def add_umapi_user(self, user_key, user):
         """
         :type user_key: str
@@ -1324,3 +1991,148 @@ class UmapiTargetInfo(object):
 
     def __repr__(self):
         return "UmapiTargetInfo('name': %s)" % self.name
+
+
+class GroupBitsetEngine(object):
+    """
+    Works out group changes for the users of one umapi with each combination of groups held as an int,
+    one bit per group.  Only the groups that can matter get a bit: the mapped groups, the excluded
+    groups, and all the desired groups.  An Adobe user's other groups are dropped when encoded, which
+    doesn't change any result, since they can't be added, removed or excluded.  Each raw group name is
+    only normalized the first time it is seen.
+    """
+
+    def __init__(self, umapi_info, exclude_groups=None):
+        """
+        :type umapi_info: UmapiTargetInfo
+        :type exclude_groups: set(str)
+        """
+        self.umapi_info = umapi_info
+        self.bit_by_group = {}
+        self.group_by_index = []
+        self.mask_by_raw_name = {}
+        self.mask_by_desired_groups = {}
+        self.groups_by_mask = {0: frozenset()}
+        self.mask_by_group_set = {frozenset(): 0}
+        self.group_changes = {}
+        self.mapped_mask = self.encode(umapi_info.get_mapped_groups())
+        self.encode(exclude_groups or ())
+        for desired_groups in six.itervalues(umapi_info.get_desired_groups_by_user_key()):
+            self.encode_desired(desired_groups)
+
+    def encode(self, groups):
+        """
+        Encode normalized group names, giving a bit to any that don't have one yet
+        :type groups: iterable(str)
+        :rtype int
+        """
+        mask = 0
+        for group in groups:
+            bit = self.bit_by_group.get(group)
+            if bit is None:
+                bit = self.bit_by_group[group] = 1 << len(self.group_by_index)
+                self.group_by_index.append(group)
+            mask |= bit
+        return mask
+
+    def encode_desired(self, desired_groups):
+        """
+        :type desired_groups: frozenset(str)
+        :rtype int
+        """
+        mask = self.mask_by_desired_groups.get(desired_groups)
+        if mask is None:
+            mask = self.mask_by_desired_groups[desired_groups] = self.encode(desired_groups)
+        return mask
+
+    def encode_groups(self, raw_groups):
+        """
+        Encode an Adobe user's group names, as they come from UMAPI
+        :type raw_groups: list(str)
+        :rtype int
+        """
+        mask = 0
+        if raw_groups is not None:
+            mask_by_raw_name = self.mask_by_raw_name
+            for raw_name in raw_groups:
+                bit = mask_by_raw_name.get(raw_name)
+                if bit is None:
+                    bit = mask_by_raw_name[raw_name] = self.bit_by_group.get(normalization_cache.normalize(raw_name), 0)
+                mask |= bit
+        return mask
+
+    def decode(self, mask):
+        """
+        :type mask: int
+        :rtype frozenset(str): shared between users, so must not be changed
+        """
+        groups = self.groups_by_mask.get(mask)
+        if groups is None:
+            group_names = []
+            remaining = mask
+            while remaining:
+                lowest_bit = remaining & -remaining
+                group_names.append(self.group_by_index[lowest_bit.bit_length() - 1])
+                remaining ^= lowest_bit
+            groups = self.groups_by_mask[mask] = self.umapi_info.get_group_set(group_names)
+            self.mask_by_group_set[groups] = mask
+        return groups
+
+    def get_group_set_changes(self, desired_groups, current_groups):
+        """
+        Same as UmapiTargetInfo.get_group_changes, for groups that this engine decoded
+        :type desired_groups: frozenset(str)
+        :type current_groups: frozenset(str)
+        :rtype (frozenset(str), frozenset(str))
+        """
+        return self.get_group_changes(self.encode_desired(desired_groups), self.mask_by_group_set[current_groups])
+
+    def get_group_changes(self, desired_mask, current_mask):
+        """
+        :type desired_mask: int
+        :type current_mask: int
+        :rtype (frozenset(str), frozenset(str)): the groups to add and to remove, shared between users
+        """
+        key = (desired_mask, current_mask)
+        changes = self.group_changes.get(key)
+        if changes is None:
+            changes = self.group_changes[key] = (self.decode(desired_mask & ~current_mask),
+                                                 self.decode(current_mask & ~desired_mask & self.mapped_mask))
+        return changes
+
+
+class UserKeyTable(object):
+    """
+    Interns user keys.  Each distinct key is built once, from its parsed (id_type, username, domain)
+    tuple, and then shared by every collection that holds it.  Later lookups go by that tuple,
+    so the key string is not built again, and the tuple is kept so that the key never has to be split.
+    """
+
+    def __init__(self):
+        self.user_key_by_parsed_key = {}
+        self.parsed_key_by_user_key = {}
+
+    def intern(self, parsed_key):
+        """
+        :type parsed_key: tuple(str, str, str): the identity type, username and domain
+        :rtype: str
+        """
+        user_key = self.user_key_by_parsed_key.get(parsed_key)
+        if user_key is None:
+            user_key = self.user_key_by_parsed_key[parsed_key] = format_user_key(*parsed_key)
+            self.parsed_key_by_user_key[user_key] = parsed_key
+        return user_key
+
+    def parse(self, user_key):
+        """
+        :type user_key: str
+        :rtype: tuple(str, str, str)
+        """
+        parsed_key = self.parsed_key_by_user_key.get(user_key)
+        if parsed_key is None:
+            # keys that were not interned here, e.g. from older stray files, are split as before
+            return tuple(user_key.split(','))
+        return parsed_key
+
+    def __len__(self):
+        return len(self.user_key_by_parsed_key)
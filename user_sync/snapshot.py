@@ -0,0 +1,387 @@
+# Copyright (c) 2016-2017 Adobe Inc.  All rights reserved.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""
+A compact columnar file format for sets of user records, such as the directory users made by
+create_blank_user and the user records read from UMAPI.
+
+A snapshot file is laid out as:
+    - a preamble: magic bytes, the format version and the length of the header
+    - a JSON header giving the record count and, for each column, its kind and where its arrays are
+    - the arrays, each aligned on 8 bytes, stored as little-endian unsigned ints (or bytes)
+
+Every string (values, list items, dict keys and values) is stored once in a shared string table,
+and referred to by code everywhere else, so repeated values like domains, countries and group
+names cost four bytes per use.  Loading maps the file into memory and only reads a column's
+arrays when that column is first used.
+"""
+
+import array
+import json
+import mmap
+import struct
+import sys
+
+import six
+
+from user_sync.error import AssertionException
+
+MAGIC = b'USYNCSNP'
+FORMAT_VERSION = 1
+
+# magic, format version, length of the JSON header that follows
+_PREAMBLE = struct.Struct('<8sHI')
+_ALIGNMENT = 8
+
+# string codes: 0 and 1 stand for a missing key and for None; other codes index the string table
+_ABSENT = 0
+_NONE = 1
+_FIRST_STRING = 2
+
+# presence codes for list and dict columns
+_PRESENT = 2
+
+# the array typecode for 4-byte unsigned ints differs between platforms
+_UINT32 = 'I' if array.array('I').itemsize == 4 else 'L'
+_UINT8 = 'B'
+
+
+def save_snapshot(file_path, records):
+    """
+    Write the records to a snapshot file.  Records are dicts whose values are strings, None,
+    lists of strings, or dicts of strings to strings or None; any other values are kept as JSON.
+    :type file_path: str
+    :type records: iterable(dict)
+    """
+    records = list(records)
+    writer = _SnapshotWriter()
+    column_names = []
+    seen = set()
+    for record in records:
+        for name in record:
+            if name not in seen:
+                seen.add(name)
+                column_names.append(name)
+    columns = [writer.add_column(name, [record.get(name, _missing) for record in records])
+               for name in column_names]
+    strings = writer.add_strings()
+    header = {
+        'count': len(records),
+        'columns': columns,
+        'strings': strings,
+    }
+    header_data = json.dumps(header, sort_keys=True).encode('utf8')
+    try:
+        with open(file_path, 'wb') as output_file:
+            output_file.write(_PREAMBLE.pack(MAGIC, FORMAT_VERSION, len(header_data)))
+            output_file.write(header_data)
+            output_file.write(b'\0' * _padding(_PREAMBLE.size + len(header_data)))
+            for section in writer.sections:
+                output_file.write(section)
+    except IOError as e:
+        raise AssertionException("Can't write snapshot '%s': %s" % (file_path, e))
+
+
+def load_snapshot(file_path):
+    """
+    Open a snapshot file for lazy reading.  The result should be closed when no longer needed,
+    or used as a context manager.
+    :type file_path: str
+    :rtype Snapshot
+    """
+    return Snapshot(file_path)
+
+
+class _Missing(object):
+    """Stands in for a key that a record doesn't have"""
+
+
+_missing = _Missing()
+
+
+def _padding(length):
+    return -length % _ALIGNMENT
+
+
+def _is_string(value):
+    return isinstance(value, six.string_types)
+
+
+def _is_string_list(value):
+    return isinstance(value, list) and all(_is_string(item) for item in value)
+
+
+def _is_string_dict(value):
+    return (isinstance(value, dict) and
+            all(_is_string(key) and (value[key] is None or _is_string(value[key])) for key in value))
+
+
+class _SnapshotWriter(object):
+    def __init__(self):
+        self.sections = []
+        self.offset = 0
+        self.string_codes = {}
+        self.strings = []
+
+    def encode_string(self, value):
+        if value is _missing:
+            return _ABSENT
+        if value is None:
+            return _NONE
+        code = self.string_codes.get(value)
+        if code is None:
+            code = self.string_codes[value] = len(self.strings) + _FIRST_STRING
+            self.strings.append(value)
+        return code
+
+    def add_array(self, typecode, values):
+        """
+        :rtype list(int): the offset and length of the array, in items
+        """
+        data = array.array(typecode, values)
+        if sys.byteorder == 'big':
+            data.byteswap()
+        data = data.tostring() if six.PY2 else data.tobytes()
+        return self.add_bytes(data, len(values))
+
+    def add_bytes(self, data, length):
+        location = [self.offset, length]
+        self.sections.append(data)
+        padding = _padding(len(data))
+        if padding:
+            self.sections.append(b'\0' * padding)
+        self.offset += len(data) + padding
+        return location
+
+    def add_column(self, name, values):
+        present = [value for value in values if value is not _missing and value is not None]
+        if all(_is_string(value) for value in present):
+            kind = 'string'
+            arrays = {'codes': self.add_array(_UINT32, [self.encode_string(value) for value in values])}
+        elif all(_is_string_list(value) for value in present):
+            kind = 'list'
+            arrays = self.add_sequence_arrays(values, lambda value: value, ('items',))
+        elif all(_is_string_dict(value) for value in present):
+            kind = 'dict'
+            arrays = self.add_sequence_arrays(values, lambda value: list(six.iteritems(value)), ('keys', 'values'))
+        else:
+            kind = 'json'
+            codes = [self.encode_string(value if value is _missing or value is None
+                                        else json.dumps(value, sort_keys=True))
+                     for value in values]
+            arrays = {'codes': self.add_array(_UINT32, codes)}
+        return {'name': name, 'kind': kind, 'arrays': arrays}
+
+    def add_sequence_arrays(self, values, get_items, item_array_names):
+        """
+        Lists and dicts are stored as a presence code per record, the start of each record's items
+        in the flattened item arrays, and the item arrays themselves (for dicts, keys and values).
+        """
+        presence = []
+        starts = [0]
+        items = [[] for _ in item_array_names]
+        for value in values:
+            if value is _missing:
+                presence.append(_ABSENT)
+            elif value is None:
+                presence.append(_NONE)
+            else:
+                presence.append(_PRESENT)
+                for item in get_items(value):
+                    if len(item_array_names) == 1:
+                        item = (item,)
+                    for item_list, part in zip(items, item):
+                        item_list.append(self.encode_string(part))
+            starts.append(len(items[0]))
+        arrays = {
+            'presence': self.add_array(_UINT8, presence),
+            'starts': self.add_array(_UINT32, starts),
+        }
+        for array_name, item_list in zip(item_array_names, items):
+            arrays[array_name] = self.add_array(_UINT32, item_list)
+        return arrays
+
+    def add_strings(self):
+        encoded = [value.encode('utf8') for value in self.strings]
+        starts = [0]
+        for data in encoded:
+            starts.append(starts[-1] + len(data))
+        if starts[-1] > 0xFFFFFFFF:
+            raise AssertionException("Snapshot string table is too large: %d bytes" % starts[-1])
+        return {
+            'starts': self.add_array(_UINT32, starts),
+            'data': self.add_bytes(b''.join(encoded), starts[-1]),
+        }
+
+
+class Snapshot(object):
+    """
+    A snapshot file opened for reading.  Records are rebuilt on demand, by index or by iteration,
+    and single columns can be read without rebuilding records.
+    """
+
+    def __init__(self, file_path):
+        """
+        :type file_path: str
+        """
+        self.file_path = file_path
+        try:
+            with open(file_path, 'rb') as input_file:
+                self.data = mmap.mmap(input_file.fileno(), 0, access=mmap.ACCESS_READ)
+        except (IOError, OSError, ValueError) as e:
+            raise AssertionException("Can't open snapshot '%s': %s" % (file_path, e))
+        try:
+            magic, version, header_length = _PREAMBLE.unpack_from(self.data, 0)
+        except struct.error:
+            magic, version, header_length = None, None, 0
+        if magic != MAGIC:
+            self.close()
+            raise AssertionException("Not a snapshot file: '%s'" % file_path)
+        if version > FORMAT_VERSION:
+            self.close()
+            raise AssertionException("Snapshot '%s' has format version %d; this version of User Sync reads "
+                                     "up to version %d" % (file_path, version, FORMAT_VERSION))
+        header_end = _PREAMBLE.size + header_length
+        header = json.loads(self.data[_PREAMBLE.size:header_end].decode('utf8'))
+        self.data_start = header_end + _padding(header_end)
+        self.count = header['count']
+        self.columns = [(column['name'], column) for column in header['columns']]
+        self.column_by_name = dict(self.columns)
+        self.string_table = header['strings']
+        self.arrays = {}
+        self.string_by_code = {}
+
+    def close(self):
+        if self.data is not None:
+            self.data.close()
+            self.data = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def __len__(self):
+        return self.count
+
+    def __iter__(self):
+        for index in range(self.count):
+            yield self.get_record(index)
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += self.count
+        if not 0 <= index < self.count:
+            raise IndexError('snapshot record index out of range')
+        return self.get_record(index)
+
+    def get_column_names(self):
+        """
+        :rtype list(str)
+        """
+        return [name for name, _ in self.columns]
+
+    def get_record(self, index):
+        """
+        :type index: int
+        :rtype dict
+        """
+        record = {}
+        for name, column in self.columns:
+            value = self.get_value(column, index)
+            if value is not _missing:
+                record[name] = value
+        return record
+
+    def get_column(self, name, default=None):
+        """
+        Read one column for all records, without rebuilding the records
+        :type name: str
+        :param default: the value used for records that don't have the column
+        :rtype list
+        """
+        column = self.column_by_name.get(name)
+        if column is None:
+            return [default] * self.count
+        values = []
+        for index in range(self.count):
+            value = self.get_value(column, index)
+            values.append(default if value is _missing else value)
+        return values
+
+    def get_value(self, column, index):
+        kind = column['kind']
+        if kind == 'string':
+            return self.decode_string(self.get_array(column, 'codes')[index])
+        if kind == 'json':
+            value = self.decode_string(self.get_array(column, 'codes')[index])
+            return value if value is _missing or value is None else json.loads(value)
+        presence = self.get_array(column, 'presence')[index]
+        if presence == _ABSENT:
+            return _missing
+        if presence == _NONE:
+            return None
+        starts = self.get_array(column, 'starts')
+        start, end = starts[index], starts[index + 1]
+        if kind == 'list':
+            items = self.get_array(column, 'items')
+            return [self.decode_string(code) for code in items[start:end]]
+        keys = self.get_array(column, 'keys')
+        values = self.get_array(column, 'values')
+        return dict((self.decode_string(keys[i]), self.decode_string(values[i])) for i in range(start, end))
+
+    def get_array(self, column, array_name):
+        key = (column['name'], array_name)
+        result = self.arrays.get(key)
+        if result is None:
+            typecode = _UINT8 if array_name == 'presence' else _UINT32
+            offset, length = column['arrays'][array_name]
+            result = self.arrays[key] = self.read_array(typecode, offset, length)
+        return result
+
+    def read_array(self, typecode, offset, length):
+        result = array.array(typecode)
+        start = self.data_start + offset
+        data = self.data[start:start + length * result.itemsize]
+        if six.PY2:
+            result.fromstring(data)
+        else:
+            result.frombytes(data)
+        if sys.byteorder == 'big':
+            result.byteswap()
+        return result
+
+    def decode_string(self, code):
+        if code == _ABSENT:
+            return _missing
+        if code == _NONE:
+            return None
+        value = self.string_by_code.get(code)
+        if value is None:
+            starts = self.arrays.get(('', 'strings'))
+            if starts is None:
+                offset, length = self.string_table['starts']
+                starts = self.arrays[('', 'strings')] = self.read_array(_UINT32, offset, length)
+            index = code - _FIRST_STRING
+            data_start = self.data_start + self.string_table['data'][0]
+            value = self.data[data_start + starts[index]:data_start + starts[index + 1]].decode('utf8')
+            self.string_by_code[code] = value
+        return value
@@ -0,0 +1,238 @@
+# Copyright (c) 2016-2017 Adobe Inc.  All rights reserved.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+"""
+A small HTTP listener that lets other systems ask a running daemon to sync particular users or
+directory groups right away, rather than at the next scheduled run.
+
+    POST /sync     with a JSON body such as {"users": ["jdoe@example.com"], "groups": ["Sales"]}
+    GET /metrics   queue depth and propagation latency, in the Prometheus text format
+
+Requests are coalesced: the first one waits for a short window, and every request that arrives in
+the meantime is handled by the same targeted sync.
+"""
+
+import json
+import logging
+import threading
+import time
+
+import six
+from six.moves import BaseHTTPServer
+
+import user_sync.helper
+
+logger = logging.getLogger('trigger')
+
+
+class TriggerBatch(object):
+    """
+    The requests taken from the queue together, merged
+    """
+    def __init__(self, requests):
+        """
+        :type requests: list(tuple(float, list(str), list(str))): receipt time, users and groups of each request
+        """
+        self.received_times = [received for received, _, _ in requests]
+        self.users = sorted(set(user_sync.helper.normalize_string(user) for _, users, _ in requests for user in users))
+        self.groups = sorted(set(group for _, _, groups in requests for group in groups))
+
+    def __len__(self):
+        return len(self.received_times)
+
+
+class TriggerQueue(object):
+    """
+    The sync requests waiting for a targeted sync, and the statistics about them.
+    Requests are added by the listener's thread and taken by the daemon's.
+    """
+    def __init__(self, window):
+        """
+        :type window: float: how long to wait after a request for others to come in
+        """
+        self.window = window
+        self.condition = threading.Condition()
+        self.pending = []
+        self.requests_received = 0
+        self.requests_handled = 0
+        self.runs = 0
+        self.last_latency = 0.0
+        self.max_latency = 0.0
+        self.total_latency = 0.0
+
+    def add(self, users, groups):
+        """
+        :type users: list(str)
+        :type groups: list(str)
+        """
+        with self.condition:
+            self.pending.append((time.time(), list(users), list(groups)))
+            self.requests_received += 1
+            self.condition.notify_all()
+
+    def take(self, timeout):
+        """
+        Wait up to timeout seconds for a request.  Once there is one, wait out the window after it
+        and take it with all the requests that came in meanwhile.
+        :type timeout: float
+        :rtype TriggerBatch: the requests, or None if there were none before the timeout
+        """
+        deadline = time.time() + timeout
+        with self.condition:
+            while not self.pending:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return None
+                self.condition.wait(remaining)
+            window_end = self.pending[0][0] + self.window
+            while True:
+                remaining = window_end - time.time()
+                if remaining <= 0:
+                    break
+                self.condition.wait(remaining)
+            requests, self.pending = self.pending, []
+        return TriggerBatch(requests)
+
+    def record_run(self, batch):
+        """
+        Note that the requests in the batch have been synced
+        :type batch: TriggerBatch
+        """
+        now = time.time()
+        with self.condition:
+            self.runs += 1
+            for received in batch.received_times:
+                latency = now - received
+                self.requests_handled += 1
+                self.last_latency = latency
+                self.max_latency = max(self.max_latency, latency)
+                self.total_latency += latency
+
+    def get_metrics(self):
+        """
+        :rtype list(tuple(str, str, float)): name, help text and value of each metric
+        """
+        with self.condition:
+            return [
+                ('user_sync_trigger_queue_depth', 'Requests waiting for a targeted sync', len(self.pending)),
+                ('user_sync_trigger_requests_received_total', 'Requests received', self.requests_received),
+                ('user_sync_trigger_requests_handled_total', 'Requests synced', self.requests_handled),
+                ('user_sync_trigger_runs_total', 'Targeted syncs run', self.runs),
+                ('user_sync_trigger_latency_seconds_last', 'Time from receipt to sync of the last request',
+                 self.last_latency),
+                ('user_sync_trigger_latency_seconds_max', 'Longest time from receipt to sync', self.max_latency),
+                ('user_sync_trigger_latency_seconds_sum', 'Total time from receipt to sync', self.total_latency),
+            ]
+
+    def format_metrics(self):
+        """
+        :rtype str
+        """
+        lines = []
+        for name, description, value in self.get_metrics():
+            lines.append('# HELP %s %s' % (name, description))
+            lines.append('# TYPE %s %s' % (name, 'counter' if name.endswith('_total') else 'gauge'))
+            lines.append('%s %s' % (name, value))
+        return '\n'.join(lines) + '\n'
+
+
+class TriggerRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    max_body_size = 1024 * 1024
+
+    def do_GET(self):
+        if self.path != '/metrics':
+            return self.send_text(404, 'Not found\n')
+        self.send_text(200, self.server.trigger_queue.format_metrics())
+
+    def do_POST(self):
+        if self.path != '/sync':
+            return self.send_text(404, 'Not found\n')
+        try:
+            length = int(self.headers.get('Content-Length') or 0)
+        except ValueError:
+            length = -1
+        if length < 0 or length > self.max_body_size:
+            return self.send_text(400, 'Bad Content-Length\n')
+        try:
+            body = json.loads(self.rfile.read(length).decode('utf8'))
+        except ValueError as e:
+            return self.send_text(400, 'Body is not JSON: %s\n' % e)
+        users, groups = self.parse_sync_request(body)
+        if users is None or (not users and not groups):
+            return self.send_text(400, 'Body must be an object with a list of "users" and/or a list of "groups"\n')
+        self.server.trigger_queue.add(users, groups)
+        logger.info('Sync requested for %d users and %d groups', len(users), len(groups))
+        self.send_text(202, 'Queued\n')
+
+    @staticmethod
+    def parse_sync_request(body):
+        """
+        :type body: object: the decoded JSON body
+        :rtype (list(str), list(str)): the users and groups, or (None, None) if the body isn't valid
+        """
+        if not isinstance(body, dict):
+            return None, None
+        lists = []
+        for key in ('users', 'groups'):
+            values = body.get(key) or []
+            if not isinstance(values, list) or not all(isinstance(v, six.string_types) and v for v in values):
+                return None, None
+            lists.append(values)
+        return tuple(lists)
+
+    def send_text(self, status, text):
+        data = text.encode('utf8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'text/plain; charset=utf-8')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, message_format, *args):
+        logger.debug('%s - %s', self.address_string(), message_format % args)
+
+
+class TriggerServer(BaseHTTPServer.HTTPServer):
+    """
+    Serves trigger requests on a background thread.  It only listens on the local host by default,
+    as the requests aren't authenticated.
+    """
+    def __init__(self, trigger_queue, port, host='127.0.0.1'):
+        """
+        :type trigger_queue: TriggerQueue
+        :type port: int: 0 picks a free port
+        :type host: str
+        """
+        BaseHTTPServer.HTTPServer.__init__(self, (host, port), TriggerRequestHandler)
+        self.trigger_queue = trigger_queue
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self.serve_forever, name='trigger-listener')
+        self.thread.daemon = True
+        self.thread.start()
+        logger.info('Listening for sync requests on %s:%d', *self.server_address[:2])
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+        if self.thread is not None:
+            self.thread.join()